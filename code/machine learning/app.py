@@ -1,91 +1,395 @@
 import os
 import io
 import json
-import torch
-import torch.nn as nn
-import torchvision.models as models
-import torchvision.transforms as transforms
-from PIL import Image
+import threading
 from flask import Flask, request, jsonify
+from serving import load_serving_config
+from request_profiling import RequestProfiler
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# torch, torchvision and the model code are imported on first use, so the process can
+# answer health checks quickly after start. Models load on the first request for their
+# type, or up front through warmup() (POST /warmup, or gunicorn with WARMUP_MODELS=1).
 
-def get_inference_transform(model_type):
+# Thread counts and micro-batching from autotune.py
+SERVING_CONFIG = load_serving_config()
+# mode=tiled settings (tiled_inference.TiledPredictor); max_tiles bounds its latency
+TILED_CONFIG = {"long_side": 1024, "tile": 224, "overlap": 0.25, "max_tiles": 16, "pooling": "max",
+                **SERVING_CONFIG.get("tiled", {})}
+
+# normalization is the (mean, std) the model was trained with (model_info['normalization'])
+def get_inference_transform(model_type, single_channel=False, normalization=None):
+    import torchvision.transforms as transforms
+    if single_channel:
+        # 1xHxW float input; the model's first-layer hook broadcasts and normalises
+        return transforms.Resize((224,224), antialias=True)
+    mean, std = normalization or ([0.485,0.456,0.406], [0.229,0.224,0.225])
     if model_type == "chest":
-        return transforms.Compose([transforms.Resize((224,224)), transforms.ToTensor(), transforms.Normalize([0.485,0.456,0.406], [0.229,0.224,0.225])])
+        return transforms.Compose([transforms.Resize((224,224)), transforms.ToTensor(), transforms.Normalize(mean, std)])
     elif model_type == "brain":
-        return transforms.Compose([transforms.Resize((224,224)), transforms.ToTensor(), transforms.Normalize([0.485,0.456,0.406], [0.229,0.224,0.225])])
+        return transforms.Compose([transforms.Resize((224,224)), transforms.ToTensor(), transforms.Normalize(mean, std)])
     elif model_type == "scan_type":
-        return transforms.Compose([transforms.Resize((224,224)), transforms.ToTensor(), transforms.Normalize([0.485,0.456,0.406], [0.229,0.224,0.225])])
-    else:
-        raise ValueError("Unknown model type")
-
-def get_model_architecture(model_type, num_classes):
-    if model_type in ["chest", "brain", "scan_type"]:
-        model = models.densenet121(weights=models.DenseNet121_Weights.DEFAULT)
-        num_features = model.classifier.in_features
-        model.classifier = nn.Sequential(nn.Dropout(0.3), nn.Linear(num_features, num_classes))
-        return model
+        return transforms.Compose([transforms.Resize((224,224)), transforms.ToTensor(), transforms.Normalize(mean, std)])
     else:
         raise ValueError("Unknown model type")
 
+# Prefers the weights-only artifact from export_model.py (memory-mapped, no optimizer
+# state) while it matches the training checkpoint; falls back to the checkpoint
 def load_model(model_type, checkpoints_dir="model_checkpoints"):
+    import torch
+    from model_utils import get_model_architecture, enable_single_channel_input, normalization_from_info, device
+    from export_model import artifact_paths, artifact_staleness, load_serving_model
     info_path = os.path.join(checkpoints_dir, f"{model_type}_model_info.json")
     ckpt_path = os.path.join(checkpoints_dir, f"best_{model_type}_model.pth")
+    if os.path.exists(artifact_paths(model_type, checkpoints_dir)[1]):
+        stale = artifact_staleness(model_type, checkpoints_dir)
+        if stale is None:
+            model, model_info = load_serving_model(model_type, checkpoints_dir)
+            # Temperature and other post-export updates come from the current model_info
+            if os.path.exists(info_path):
+                with open(info_path, "r") as f:
+                    model_info = json.load(f)
+            class_to_idx = model_info['class_to_idx']
+            return model, class_to_idx, {v: k for k, v in class_to_idx.items()}, model_info
+        print(f"Not serving the exported {model_type} artifact ({stale}); re-run export_model.py. "
+              f"Loading the training checkpoint instead")
     if not os.path.exists(info_path) or not os.path.exists(ckpt_path):
         raise FileNotFoundError(f"Model info or checkpoint for {model_type} not found")
     with open(info_path, "r") as f:
         model_info = json.load(f)
     num_classes = model_info['num_classes']
     class_to_idx = model_info['class_to_idx']
-    model = get_model_architecture(model_type, num_classes)
-    checkpoint = torch.load(ckpt_path, map_location=device)
+    # Distilled students record their architecture in model_info; older checkpoints are DenseNet121
+    # The checkpoint overwrites every weight, so skip the ImageNet download
+    model = get_model_architecture(model_type, num_classes, pretrained=False,
+                                   architecture=model_info.get('architecture', 'densenet121'))
+    if model_info.get('input_channels', 3) == 1:
+        enable_single_channel_input(model, *normalization_from_info(model_info))
+    checkpoint = torch.load(ckpt_path, map_location=device, weights_only=True)
     model.load_state_dict(checkpoint['model_state_dict'])
     model.to(device)
     model.eval()
     idx_to_class = {v: k for k, v in class_to_idx.items()}
-    return model, class_to_idx, idx_to_class
+    return model, class_to_idx, idx_to_class, model_info
 
 loaded_models = {}
 MODEL_TYPES = ["chest", "brain", "scan_type"]
-CHECKPOINTS_DIR = "model_checkpoints"
-for m_type in MODEL_TYPES:
-    try:
-        model, class_to_idx, idx_to_class = load_model(m_type, checkpoints_dir=CHECKPOINTS_DIR)
-        loaded_models[m_type] = {"model": model, "class_to_idx": class_to_idx, "idx_to_class": idx_to_class, "transform": get_inference_transform(m_type)}
-    except Exception as e:
-        print(f"Failed to load model {m_type}: {e}")
+# Overridable so benchmarks and tests can start the app without trained checkpoints
+CHECKPOINTS_DIR = os.environ.get("CHECKPOINTS_DIR", "model_checkpoints")
+# Streaming drift sketches per model type (drift_monitor.py), compared by /drift
+DRIFT_DIR = os.environ.get("DRIFT_DIR", "drift_state")
+drift_monitors = {}
+# Backbone embedding of every analysed scan, per model type, for /similar. Off unless
+# EMBEDDING_INDEX_DIR is set, since it keeps a record of every patient scan; at most
+# EMBEDDING_INDEX_MAX_SCANS scans per model type are stored
+EMBEDDING_INDEX_DIR = os.environ.get("EMBEDDING_INDEX_DIR", "")
+EMBEDDING_INDEX_MAX_SCANS = int(os.environ.get("EMBEDDING_INDEX_MAX_SCANS", "100000"))
+scan_indexes = {}
+_load_lock = threading.Lock()
+_attempted = set()
+_threads_applied = False
+
+# Thread settings must be in place before the first forward pass
+def _apply_threads_once():
+    global _threads_applied
+    if not _threads_applied:
+        from serving import apply_thread_settings
+        apply_thread_settings(SERVING_CONFIG)
+        _threads_applied = True
+
+# Serve `model` for m_type; also used by benchmark.py to inject randomly initialised models
+def register_model(m_type, model, model_info):
+    from model_utils import normalization_from_info
+    from serving import MicroBatcher
+    _apply_threads_once()
+    class_to_idx = model_info['class_to_idx']
+    single_channel = model_info.get('input_channels', 3) == 1
+    entry = {"model": model, "class_to_idx": class_to_idx,
+             "idx_to_class": {v: k for k, v in class_to_idx.items()},
+             "transform": get_inference_transform(m_type, single_channel=single_channel,
+                                                  normalization=normalization_from_info(model_info)),
+             "temperature": model_info.get('temperature', 1.0), "single_channel": single_channel,
+             "normalization": normalization_from_info(model_info), "model_info": model_info,
+             "batcher": None, "tiled": None, "ensemble": None}
+    batching = SERVING_CONFIG.get("models", {}).get(m_type, {})
+    if batching.get("max_batch_size", 1) > 1:
+        entry["batcher"] = MicroBatcher(model, max_batch_size=batching["max_batch_size"],
+                                        max_wait_ms=batching.get("max_wait_ms", 5.0))
+    loaded_models[m_type] = entry
+
+# Loads m_type on first use; a missing or broken checkpoint is only tried once
+def ensure_model(m_type):
+    if m_type in loaded_models:
+        return True
+    with _load_lock:
+        if m_type not in loaded_models and m_type not in _attempted:
+            _attempted.add(m_type)
+            try:
+                _apply_threads_once()
+                model, class_to_idx, idx_to_class, model_info = load_model(m_type, checkpoints_dir=CHECKPOINTS_DIR)
+                register_model(m_type, model, model_info)
+            except Exception as e:
+                print(f"Failed to load model {m_type}: {e}")
+    return m_type in loaded_models
+
+# Built on the first mode=tiled request for m_type
+def tiled_predictor(m_type):
+    from tiled_inference import TiledPredictor
+    entry = loaded_models[m_type]
+    with _load_lock:
+        if entry["tiled"] is None:
+            mean, std = entry["normalization"]
+            entry["tiled"] = TiledPredictor(entry["model"], mean, std, single_channel=entry["single_channel"],
+                                            **TILED_CONFIG)
+    return entry["tiled"]
+
+# Built on the first ensemble=1 request from <CHECKPOINTS_DIR>/ensemble/<type>/; None when
+# there are no member checkpoints
+def ensemble_for(m_type):
+    from ensemble import ensemble_checkpoints, build_ensemble
+    entry = loaded_models[m_type]
+    with _load_lock:
+        if entry["ensemble"] is None:
+            paths = ensemble_checkpoints(m_type, CHECKPOINTS_DIR)
+            if paths:
+                entry["ensemble"] = build_ensemble(m_type, paths, entry["model_info"])
+    return entry["ensemble"]
+
+# DenseNet models only: the embedding is the pooled input of model.classifier
+def scan_index(m_type):
+    from embedding_index import ScanIndex
+    from mc_dropout import head_layers
+    if not EMBEDDING_INDEX_DIR:
+        return None
+    with _load_lock:
+        if m_type not in scan_indexes:
+            try:
+                dim = head_layers(loaded_models[m_type]["model"])[1].in_features
+                scan_indexes[m_type] = ScanIndex(os.path.join(EMBEDDING_INDEX_DIR, m_type), dim=dim,
+                                                 max_scans=EMBEDDING_INDEX_MAX_SCANS)
+            except ValueError:
+                scan_indexes[m_type] = None
+    return scan_indexes[m_type]
+
+def drift_monitor(m_type):
+    from drift_monitor import DriftMonitor
+    with _load_lock:
+        if m_type not in drift_monitors:
+            drift_monitors[m_type] = DriftMonitor(m_type, DRIFT_DIR,
+                                                  window_seconds=int(os.environ.get("DRIFT_WINDOW_SECONDS", 3600)),
+                                                  keep_windows=int(os.environ.get("DRIFT_KEEP_WINDOWS", 24)))
+    return drift_monitors[m_type]
+
+# Input size and intensity of the decoded scan plus the served prediction; no pixels kept
+def observe_drift(m_type, image, input_tensor, predicted_class, confidence):
+    from drift_monitor import input_intensity
+    size = (image.shape[-1], image.shape[-2]) if hasattr(image, "shape") else image.size
+    mean, std = input_intensity(input_tensor[0], loaded_models[m_type]["normalization"])
+    drift_monitor(m_type).observe(size, mean, std, predicted_class, confidence)
+
+# Load every model and run one forward pass each, so the first real request is fast
+def warmup(model_types=MODEL_TYPES):
+    import torch
+    from model_utils import device
+    for m_type in model_types:
+        if ensure_model(m_type):
+            entry = loaded_models[m_type]
+            channels = 1 if entry["single_channel"] else 3
+            with torch.no_grad():
+                entry["model"](torch.zeros(1, channels, 224, 224, device=device))
+    return sorted(loaded_models)
 
 app = Flask(__name__)
+profiler = RequestProfiler()
 
 @app.route("/")
 def index():
     return "<h1>Medical Image Classification Deployment</h1><p>Use the /predict endpoint.</p>"
 
+@app.route("/warmup", methods=["POST"])
+def warmup_models():
+    return jsonify({"loaded_models": warmup()})
+
 @app.route("/predict", methods=["POST"])
 def predict():
     model_type = request.args.get("model_type")
-    if model_type not in loaded_models:
+    if model_type not in MODEL_TYPES or not ensure_model(model_type):
+        return jsonify({"error": "Invalid or missing model_type. Provide one of: chest, brain, scan_type"}), 400
+    if "image" not in request.files:
+        return jsonify({"error": "No image file provided. Use key 'image'."}), 400
+    # mode=tiled runs overlapping tiles of an aspect-preserving high-resolution resize
+    mode = request.args.get("mode", "standard")
+    pooling = request.args.get("pooling")
+    if mode not in ("standard", "tiled") or pooling not in (None, "max", "attention"):
+        return jsonify({"error": "mode must be standard or tiled; pooling must be max or attention"}), 400
+    # ensemble=1 averages every checkpoint under <CHECKPOINTS_DIR>/ensemble/<type>/
+    use_ensemble = request.args.get("ensemble", "0").lower() in ("1", "true", "yes")
+    if use_ensemble and (mode == "tiled" or ensemble_for(model_type) is None):
+        return jsonify({"error": f"No ensemble checkpoints for {model_type} (or combined with mode=tiled)"}), 400
+    # mc_samples=N adds MC-dropout uncertainty from N head samples on the same backbone features
+    try:
+        mc_samples = min(int(request.args.get("mc_samples", 0)), 256)
+    except ValueError:
+        return jsonify({"error": "mc_samples must be an integer"}), 400
+    import torch
+    from model_utils import device
+    from image_io import load_rgb, load_grayscale_tensor
+    # Opt-in profiling (PROFILE_TOKEN header or 1-in-PROFILE_SAMPLE_EVERY); spans are no-ops otherwise
+    with profiler.request(f"predict_{model_type}", request.headers) as profile:
+        with profile.span("fetch"):
+            image_bytes = request.files["image"].read()
+        try:
+            with profile.span("decode"):
+                # DICOM and 16-bit PNG uploads are decoded through image_io
+                if loaded_models[model_type]["single_channel"]:
+                    image = load_grayscale_tensor(io.BytesIO(image_bytes))
+                else:
+                    image = load_rgb(io.BytesIO(image_bytes))
+        except Exception as e:
+            return jsonify({"error": f"Could not read image file: {e}"}), 400
+        idx_to_class = loaded_models[model_type]["idx_to_class"]
+        input_tensor, index = None, None
+        if mode != "tiled":
+            with profile.span("transform"):
+                transform = loaded_models[model_type]["transform"]
+                input_tensor = transform(image).unsqueeze(0).to(device)
+        if mode == "tiled":
+            with profile.span("forward"):
+                result = tiled_predictor(model_type).predict(image, device=device, pooling=pooling,
+                                                             temperature=loaded_models[model_type]["temperature"])
+            with profile.span("postprocess"):
+                pred_idx = result["prediction_index"]
+                probs = result["probabilities"].tolist()
+                response = {"model_type": model_type, "mode": mode, "predicted_class": idx_to_class.get(pred_idx, "Unknown"),
+                            "prediction_index": pred_idx, "confidence": probs[pred_idx],
+                            "probabilities": {idx_to_class.get(i, str(i)): p for i, p in enumerate(probs)},
+                            **{k: result[k] for k in ("pooling", "resized_to", "tile_size", "tile_grid", "tile_map",
+                                                      "tile_boxes", "attention") if k in result}}
+        elif use_ensemble:
+            members = loaded_models[model_type]["ensemble"]
+            with profile.span("forward"):
+                result = members.predict(input_tensor, loaded_models[model_type]["temperature"])
+            with profile.span("postprocess"):
+                probs = result["probabilities"][0].tolist()
+                pred_idx = max(range(len(probs)), key=probs.__getitem__)
+                response = {"model_type": model_type, "predicted_class": idx_to_class.get(pred_idx, "Unknown"),
+                            "prediction_index": pred_idx, "confidence": probs[pred_idx],
+                            "probabilities": {idx_to_class.get(i, str(i)): p for i, p in enumerate(probs)},
+                            "ensemble": {"members": members.num_members, "strategy": members.strategy,
+                                         "agreement": float(result["agreement"][0]),
+                                         "mutual_information": float(result["mutual_information"][0]),
+                                         "predictive_entropy": float(result["predictive_entropy"][0]),
+                                         "probability_std": {idx_to_class.get(i, str(i)): float(v) for i, v in
+                                                             enumerate(result["probability_std"][0].tolist())},
+                                         "member_predictions": [idx_to_class.get(i, str(i)) for i in
+                                                                result["member_predictions"][0].tolist()]}}
+        else:
+            model = loaded_models[model_type]["model"]
+            batcher = loaded_models[model_type]["batcher"]
+            index = scan_index(model_type)
+            uncertainty, features = None, None
+            with torch.no_grad():
+                with profile.span("forward"):
+                    if mc_samples > 0:
+                        from mc_dropout import predict_with_uncertainty
+                        try:
+                            uncertainty = predict_with_uncertainty(model, input_tensor, mc_samples,
+                                                                   loaded_models[model_type]["temperature"])
+                        except ValueError as e:
+                            return jsonify({"error": str(e)}), 400
+                        features = uncertainty["features"]
+                    elif index is not None and batcher is not None:
+                        outputs, features = batcher.infer(input_tensor, return_features=True)
+                    elif index is not None:
+                        # Same computation as model(input_tensor), keeping the pooled features
+                        from model_utils import backbone_features
+                        features = backbone_features(model, input_tensor)
+                        outputs = model.classifier(features)
+                    else:
+                        outputs = batcher.infer(input_tensor) if batcher is not None else model(input_tensor)
+                with profile.span("postprocess"):
+                    # Temperature-scaled (calibrated) probabilities; T=1.0 when no calibration was fitted
+                    if uncertainty is not None:
+                        probs = uncertainty["probabilities"][0]
+                    else:
+                        probs = torch.softmax(outputs / loaded_models[model_type]["temperature"], dim=1)[0]
+                    confidence, pred_idx = torch.max(probs, 0)
+                    pred_idx = pred_idx.item()
+                    probabilities = {idx_to_class.get(i, str(i)): float(p) for i, p in enumerate(probs.tolist())}
+            response = {"model_type": model_type, "predicted_class": idx_to_class.get(pred_idx, "Unknown"),
+                        "prediction_index": pred_idx, "confidence": float(confidence.item()),
+                        "probabilities": probabilities}
+            if uncertainty is not None:
+                from mc_dropout import uncertainty_summary
+                response["uncertainty"] = uncertainty_summary(uncertainty, idx_to_class)
+        # Every mode records drift here, outside its forward/postprocess timings
+        with profile.span("drift"):
+            if input_tensor is None:
+                # Tiled requests: intensity is measured on the standard 224x224 input, as in the reference
+                input_tensor = loaded_models[model_type]["transform"](image).unsqueeze(0)
+            observe_drift(model_type, image, input_tensor, response["predicted_class"], response["confidence"])
+        if index is not None:
+            with profile.span("index"):
+                import uuid
+                from datetime import datetime
+                scan_id = request.form.get("scan_id") or uuid.uuid4().hex
+                row = index.add(scan_id, features[0].float().cpu().numpy(),
+                                {"predicted_class": response["predicted_class"], "confidence": response["confidence"],
+                                 "probabilities": probabilities, "timestamp": datetime.now().isoformat()})
+                if row is not None:
+                    response["scan_id"] = scan_id
+        return jsonify(response)
+
+# Drift of the last `windows` windows against the model type's reference snapshot
+@app.route("/drift", methods=["GET"])
+def drift():
+    model_type = request.args.get("model_type")
+    if model_type not in MODEL_TYPES:
         return jsonify({"error": "Invalid or missing model_type. Provide one of: chest, brain, scan_type"}), 400
+    try:
+        windows = max(1, int(request.args.get("windows", 1)))
+    except ValueError:
+        return jsonify({"error": "windows must be an integer"}), 400
+    report = drift_monitor(model_type).report(windows)
+    return jsonify(report), (404 if "error" in report else 200)
+
+# Top-k previously analysed scans closest to a stored scan (GET ?scan_id=) or to an
+# uploaded image (POST with 'image', which is not stored)
+@app.route("/similar", methods=["GET", "POST"])
+def similar():
+    model_type = request.args.get("model_type")
+    if model_type not in MODEL_TYPES or not ensure_model(model_type):
+        return jsonify({"error": "Invalid or missing model_type. Provide one of: chest, brain, scan_type"}), 400
+    index = scan_index(model_type)
+    if index is None:
+        return jsonify({"error": f"No embedding index for {model_type}"}), 400
+    try:
+        k = max(1, min(int(request.args.get("k", 10)), 100))
+        nprobe = int(request.args["nprobe"]) if "nprobe" in request.args else None
+    except ValueError:
+        return jsonify({"error": "k and nprobe must be integers"}), 400
+    scan_id = request.args.get("scan_id")
+    if request.method == "GET":
+        if not scan_id:
+            return jsonify({"error": "Provide scan_id, or POST an image"}), 400
+        try:
+            results = index.similar_to(scan_id, k, nprobe=nprobe)
+        except KeyError:
+            return jsonify({"error": f"Unknown scan_id {scan_id}"}), 404
+        return jsonify({"model_type": model_type, "scan_id": scan_id, "similar": results})
     if "image" not in request.files:
         return jsonify({"error": "No image file provided. Use key 'image'."}), 400
-    image_file = request.files["image"]
+    import torch
+    from model_utils import device, backbone_features
+    from image_io import load_rgb, load_grayscale_tensor
+    entry = loaded_models[model_type]
     try:
-        image_bytes = image_file.read()
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        source = io.BytesIO(request.files["image"].read())
+        image = load_grayscale_tensor(source) if entry["single_channel"] else load_rgb(source)
     except Exception as e:
         return jsonify({"error": f"Could not read image file: {e}"}), 400
-    transform = loaded_models[model_type]["transform"]
-    input_tensor = transform(image).unsqueeze(0).to(device)
-    model = loaded_models[model_type]["model"]
     with torch.no_grad():
-        outputs = model(input_tensor)
-        _, pred_idx = torch.max(outputs, 1)
-        pred_idx = pred_idx.item()
-    idx_to_class = loaded_models[model_type]["idx_to_class"]
-    pred_class = idx_to_class.get(pred_idx, "Unknown")
-    response = {"model_type": model_type, "predicted_class": pred_class, "prediction_index": pred_idx}
-    return jsonify(response)
+        features = backbone_features(entry["model"], entry["transform"](image).unsqueeze(0).to(device))
+    return jsonify({"model_type": model_type, "similar": index.similar(features[0].float().cpu().numpy(), k, nprobe=nprobe)})
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,145 @@
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from sweep import available_cores
+from serving import DEFAULT_CONFIG_PATH
+
+# Serving autotuner for the current host. For every (worker processes, torch threads,
+# inter-op threads) combination it runs all workers concurrently on synthetic inputs
+# with randomly initialised models, times each candidate micro-batch size, and keeps
+# the highest-throughput setting whose p99 request latency (batch forward + batching
+# wait) meets the target. The result is written to serving_config.json, which app.py
+# and gunicorn.conf.py read on startup.
+#
+#   python autotune.py --model-types chest brain scan_type --p99-ms 250
+
+NUM_CLASSES = {'chest': 4, 'brain': 4, 'scan_type': 2}
+
+def candidate_workers(total_cores):
+    workers, w = [], 1
+    while w <= total_cores:
+        workers.append(w)
+        w *= 2
+    return workers
+
+# One serving process: fixed thread settings, every model type and batch size measured
+# in the same order as its sibling processes, aligned by a barrier
+def _measure_worker(model_types, architecture, threads, interop, batch_sizes, iterations, barrier):
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(interop)
+    from model_utils import get_model_architecture
+    results = {}
+    with torch.no_grad():
+        for model_type in model_types:
+            model = get_model_architecture(model_type, NUM_CLASSES[model_type], pretrained=False,
+                                           architecture=architecture).eval()
+            for batch_size in batch_sizes:
+                x = torch.randn(batch_size, 3, 224, 224)
+                model(x)
+                barrier.wait()
+                timings = []
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    t0 = time.perf_counter()
+                    model(x)
+                    timings.append((time.perf_counter() - t0) * 1000)
+                results[(model_type, batch_size)] = (timings, time.perf_counter() - start)
+    return results
+
+def measure(model_types, architecture, workers, threads, interop, batch_sizes, iterations):
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        barrier = manager.Barrier(workers)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [executor.submit(_measure_worker, model_types, architecture, threads, interop,
+                                       batch_sizes, iterations, barrier) for _ in range(workers)]
+            per_worker = [f.result() for f in futures]
+    measurements = {}
+    for key in per_worker[0]:
+        timings = np.concatenate([w[key][0] for w in per_worker])
+        images_per_sec = sum(key[1] * iterations / w[key][1] for w in per_worker)
+        measurements[key] = {'p99_forward_ms': float(np.percentile(timings, 99)),
+                             'p50_forward_ms': float(np.percentile(timings, 50)),
+                             'images_per_sec': images_per_sec}
+    return measurements
+
+def autotune(model_types, architecture='densenet121', p99_ms=250.0, max_wait_ms=5.0, batch_sizes=(1, 2, 4, 8, 16),
+             iterations=20, total_cores=None, out_path=DEFAULT_CONFIG_PATH):
+    total_cores = total_cores or available_cores()
+    trials = []
+    for workers in candidate_workers(total_cores):
+        threads = max(1, total_cores // workers)
+        for interop in (1, 2):
+            print(f"Measuring {workers} worker(s) x {threads} thread(s), {interop} inter-op thread(s)")
+            measurements = measure(model_types, architecture, workers, threads, interop, batch_sizes, iterations)
+            trials.append({'workers': workers, 'torch_threads': threads, 'interop_threads': interop,
+                           'measurements': measurements})
+
+    # Per model: best batch size of each host setting under the latency target. A
+    # request can wait max_wait_ms for its batch to fill before the forward pass starts.
+    def best_batch(trial, model_type):
+        feasible = [(m['images_per_sec'], bs, m) for (mt, bs), m in trial['measurements'].items()
+                    if mt == model_type and m['p99_forward_ms'] + max_wait_ms * (bs > 1) <= p99_ms]
+        return max(feasible, key=lambda f: f[0]) if feasible else None
+
+    peak = {mt: max((best_batch(t, mt) or (0.0,))[0] for t in trials) for mt in model_types}
+    # Thread and worker settings are per process and shared by all models, so pick the
+    # setting with the best throughput relative to each model's own peak
+    scored = []
+    for trial in trials:
+        choices = {mt: best_batch(trial, mt) for mt in model_types}
+        if any(c is None for c in choices.values()):
+            continue
+        score = sum(choices[mt][0] / peak[mt] for mt in model_types if peak[mt] > 0)
+        scored.append((score, trial, choices))
+    if not scored:
+        print(f"No setting meets p99 <= {p99_ms} ms; falling back to the lowest-latency single-image setting")
+        trial = min(trials, key=lambda t: max(t['measurements'][(mt, batch_sizes[0])]['p99_forward_ms']
+                                              for mt in model_types))
+        choices = {mt: (trial['measurements'][(mt, batch_sizes[0])]['images_per_sec'], batch_sizes[0],
+                        trial['measurements'][(mt, batch_sizes[0])]) for mt in model_types}
+    else:
+        _, trial, choices = max(scored, key=lambda s: s[0])
+
+    config = {
+        'host': {'cores': total_cores, 'torch': torch.__version__, 'architecture': architecture},
+        'p99_target_ms': p99_ms,
+        'workers': trial['workers'],
+        'torch_threads': trial['torch_threads'],
+        'interop_threads': trial['interop_threads'],
+        'models': {mt: {'max_batch_size': bs, 'max_wait_ms': max_wait_ms if bs > 1 else 0.0,
+                        'images_per_sec': m['images_per_sec'],
+                        'p99_ms': m['p99_forward_ms'] + (max_wait_ms if bs > 1 else 0.0)}
+                   for mt, (_, bs, m) in choices.items()},
+        'trials': [{'workers': t['workers'], 'torch_threads': t['torch_threads'], 'interop_threads': t['interop_threads'],
+                    'measurements': {f"{mt}/{bs}": m for (mt, bs), m in t['measurements'].items()}} for t in trials],
+    }
+    with open(out_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    print(f"Chosen: {config['workers']} worker(s) x {config['torch_threads']} thread(s), "
+          f"{config['interop_threads']} inter-op thread(s)")
+    for mt, m in config['models'].items():
+        print(f"  {mt}: batch {m['max_batch_size']}, {m['images_per_sec']:.1f} img/s, p99 {m['p99_ms']:.1f} ms")
+    print(f"Serving config written to {out_path}")
+    return config
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune serving threads, workers and batch size for this host")
+    parser.add_argument('--model-types', nargs='+', default=['chest', 'brain', 'scan_type'], choices=list(NUM_CLASSES))
+    parser.add_argument('--architecture', default='densenet121')
+    parser.add_argument('--p99-ms', type=float, default=250.0, help="Target p99 request latency")
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help="Micro-batching wait for a batch to fill")
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 2, 4, 8, 16])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--cores', type=int, default=None)
+    parser.add_argument('--out', default=DEFAULT_CONFIG_PATH)
+    args = parser.parse_args()
+    autotune(args.model_types, architecture=args.architecture, p99_ms=args.p99_ms, max_wait_ms=args.max_wait_ms,
+             batch_sizes=tuple(args.batch_sizes), iterations=args.iterations, total_cores=args.cores, out_path=args.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+
+# Offline inference benchmark. Models are built with random weights (pretrained=False,
+# no ImageNet download) and inputs are synthetic chest/brain-sized images, so it runs on
+# air-gapped machines without datasets or checkpoints. Measures single-image latency,
+# batched throughput, decode+transform cost, BrainTumorClassifier.predict and
+# end-to-end /predict latency over HTTP at several concurrency levels, and writes JSON
+# that can be compared against a previous run.
+#
+#   python benchmark.py --out bench_results.json
+#   python benchmark.py --out new.json --baseline bench_results.json
+
+# Typical source resolutions: chest X-ray exports and brain MRI slices
+IMAGE_SIZES = {'chest': (1024, 1024), 'brain': (512, 512), 'scan_type': (1024, 1024)}
+NUM_CLASSES = {'chest': 4, 'brain': 4, 'scan_type': 2}
+HIGHER_IS_BETTER = ('images_per_sec', 'requests_per_sec')
+
+# Smooth structure plus noise, so JPEG/PNG sizes and decode cost resemble real scans
+def synthetic_image(size, seed=0):
+    rng = np.random.RandomState(seed)
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    cy, cx = height / 2, width / 2
+    body = np.exp(-(((x - cx) / (0.35 * width)) ** 2 + ((y - cy) / (0.4 * height)) ** 2))
+    gray = np.clip(body * 200 + rng.normal(0, 12, size=(height, width)), 0, 255).astype(np.uint8)
+    return Image.fromarray(gray, mode='L').convert('RGB')
+
+def encode(image, fmt):
+    buffer = io.BytesIO()
+    options = {'quality': 90} if fmt == 'JPEG' else {}
+    image.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+def percentiles(samples_ms):
+    samples = np.asarray(samples_ms)
+    return {'p50_ms': float(np.percentile(samples, 50)), 'p95_ms': float(np.percentile(samples, 95)),
+            'p99_ms': float(np.percentile(samples, 99)), 'mean_ms': float(samples.mean())}
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+def random_model(model_type, architecture='densenet121'):
+    from model_utils import get_model_architecture, device
+    model = get_model_architecture(model_type, NUM_CLASSES[model_type], pretrained=False, architecture=architecture)
+    return model.to(device).eval()
+
+def bench_latency(model, iterations=50, warmup=5):
+    from model_utils import device
+    x = torch.randn(1, 3, 224, 224, device=device)
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            start = time.perf_counter()
+            model(x)
+            _sync()
+            if i >= warmup:
+                timings.append((time.perf_counter() - start) * 1000)
+    return percentiles(timings)
+
+def bench_throughput(model, batch_sizes=(1, 8, 32), iterations=10, warmup=2):
+    from model_utils import device
+    results = {}
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, 3, 224, 224, device=device)
+            for _ in range(warmup):
+                model(x)
+            _sync()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                model(x)
+            _sync()
+            elapsed = time.perf_counter() - start
+            results[str(batch_size)] = {'images_per_sec': batch_size * iterations / elapsed}
+    return results
+
+# Bytes -> normalised tensor, the CPU work /predict does before the forward pass
+def bench_decode(model_type, iterations=30):
+    from image_io import load_rgb
+    from model_utils import get_transforms
+    transform = get_transforms(model_type)['val']
+    image = synthetic_image(IMAGE_SIZES[model_type])
+    results = {}
+    for fmt in ['JPEG', 'PNG']:
+        data = encode(image, fmt)
+        decode_ms, transform_ms = [], []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            img = load_rgb(io.BytesIO(data))
+            img.load()
+            decoded = time.perf_counter()
+            transform(img)
+            decode_ms.append((decoded - start) * 1000)
+            transform_ms.append((time.perf_counter() - decoded) * 1000)
+        results[fmt.lower()] = {'bytes': len(data), 'decode': percentiles(decode_ms), 'transform': percentiles(transform_ms)}
+    return results
+
+def bench_brain_classifier(iterations=200):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'brain'))
+    from models.brain_tumor_classifier import BrainTumorClassifier
+    classifier = BrainTumorClassifier()
+    image = np.zeros((224, 224, 3), dtype=np.float32)
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        classifier.predict(image)
+        timings.append((time.perf_counter() - start) * 1000)
+    return percentiles(timings)
+
+def _multipart(data, filename):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+# Starts app.py on a local port with randomly initialised models injected into
+# app.loaded_models; CHECKPOINTS_DIR points at an empty directory so nothing else loads,
+# the embedding index stays off, as in a default deployment, and drift sketches of the
+# synthetic traffic go to a throwaway directory instead of the real drift state
+def start_app_server(model_types, architecture='densenet121'):
+    os.environ['CHECKPOINTS_DIR'] = tempfile.mkdtemp(prefix='bench_checkpoints_')
+    os.environ['EMBEDDING_INDEX_DIR'] = ''
+    os.environ['DRIFT_DIR'] = tempfile.mkdtemp(prefix='bench_drift_')
+    import app as serving_app
+    from werkzeug.serving import make_server
+    for model_type in model_types:
+        classes = [f'class_{i}' for i in range(NUM_CLASSES[model_type])]
+        model_info = {'num_classes': len(classes), 'classes': classes,
+                      'class_to_idx': {c: i for i, c in enumerate(classes)}}
+        serving_app.register_model(model_type, random_model(model_type, architecture), model_info)
+    server = make_server('127.0.0.1', 0, serving_app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def bench_http(port, model_type, concurrency_levels=(1, 4, 16), requests_per_level=64):
+    body, content_type = _multipart(encode(synthetic_image(IMAGE_SIZES[model_type]), 'JPEG'), 'scan.jpg')
+
+    def one_request(_):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        start = time.perf_counter()
+        conn.request('POST', f'/predict?model_type={model_type}', body=body, headers={'Content-Type': content_type})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return (time.perf_counter() - start) * 1000, response.status
+
+    one_request(0)
+    results = {}
+    for concurrency in concurrency_levels:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(one_request, range(requests_per_level)))
+        elapsed = time.perf_counter() - start
+        errors = sum(1 for _, status in outcomes if status != 200)
+        results[str(concurrency)] = {**percentiles([ms for ms, _ in outcomes]),
+                                     'requests_per_sec': requests_per_level / elapsed, 'errors': errors}
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'torch': torch.__version__,
+            'device': 'cuda' if torch.cuda.is_available() else 'cpu', 'torch_threads': torch.get_num_threads(),
+            'machine': platform.machine(), 'cpu_count': os.cpu_count()}
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+# Metrics that got worse than the baseline by more than `tolerance` (relative)
+def compare(results, baseline, tolerance=0.10):
+    current, previous = flatten(results['results']), flatten(baseline['results'])
+    regressions = []
+    for name, value in sorted(current.items()):
+        old = previous.get(name)
+        if not old or not (name.endswith('_ms') or name.endswith(HIGHER_IS_BETTER)):
+            continue
+        change = (value - old) / old
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        if worse > tolerance:
+            regressions.append({'metric': name, 'baseline': old, 'current': value, 'change': change})
+    return regressions
+
+def run_benchmarks(model_types=('chest', 'brain'), architecture='densenet121', concurrency_levels=(1, 4, 16),
+                   requests_per_level=64, skip_http=False):
+    torch.manual_seed(0)
+    results = {}
+    for model_type in model_types:
+        print(f"Benchmarking {model_type} ({architecture}, random weights)")
+        model = random_model(model_type, architecture)
+        results[model_type] = {'latency': bench_latency(model), 'throughput': bench_throughput(model),
+                               'decode': bench_decode(model_type)}
+    results['brain_tumor_classifier'] = bench_brain_classifier()
+    if not skip_http:
+        server = start_app_server(model_types, architecture)
+        try:
+            for model_type in model_types:
+                print(f"HTTP /predict for {model_type} at concurrency {list(concurrency_levels)}")
+                results[model_type]['http'] = bench_http(server.server_port, model_type, concurrency_levels,
+                                                         requests_per_level)
+        finally:
+            server.shutdown()
+    return {'environment': environment(), 'architecture': architecture, 'results': results}
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline inference benchmark with random weights and synthetic images")
+    parser.add_argument('--model-types', nargs='+', default=['chest', 'brain'], choices=list(IMAGE_SIZES))
+    parser.add_argument('--architecture', default='densenet121')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=64, help="HTTP requests per concurrency level")
+    parser.add_argument('--skip-http', action='store_true')
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="Previous results JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="Relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.model_types, args.architecture, tuple(args.concurrency), args.requests, args.skip_http)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    for model_type in args.model_types:
+        r = results['results'][model_type]
+        print(f"{model_type}: latency p50 {r['latency']['p50_ms']:.1f} ms, "
+              f"batch-32 {r['throughput']['32']['images_per_sec']:.1f} img/s, "
+              f"JPEG decode p50 {r['decode']['jpeg']['decode']['p50_ms']:.1f} ms")
+        for concurrency, h in r.get('http', {}).items():
+            print(f"  HTTP c={concurrency}: p50 {h['p50_ms']:.1f} p95 {h['p95_ms']:.1f} p99 {h['p99_ms']:.1f} ms, "
+                  f"{h['requests_per_sec']:.1f} req/s")
+    print(f"Results written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r['metric']}: {r['baseline']:.2f} -> {r['current']:.2f} ({r['change']:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,80 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
+import sys
 from datetime import datetime
 import json
-import numpy as np
 from dotenv import load_dotenv
 from utils.image_processing import preprocess_image
 from models.brain_tumor_classifier import BrainTumorClassifier
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from request_profiling import RequestProfiler
+
 # Load environment variables
 load_dotenv()
 
 # Initialize the brain tumor classifier
 classifier = BrainTumorClassifier()
 
+# Opt-in request profiling (PROFILE_TOKEN header or 1-in-PROFILE_SAMPLE_EVERY sampling)
+profiler = RequestProfiler()
+
+# MC-dropout uncertainty from the trained brain model (best_brain_model.pth), reported
+# under 'trained_model_uncertainty' when a checkpoint exists. It describes that model's
+# prediction, not the BrainTumorClassifier one in 'predictions'. torch is only imported
+# in that case.
+CHECKPOINTS_DIR = os.getenv('CHECKPOINTS_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                            'model_checkpoints'))
+MC_DROPOUT_SAMPLES = int(os.getenv('MC_DROPOUT_SAMPLES', 32))
+_uncertainty_model = None
+
+# (model, transform, idx_to_class, single_channel, temperature, model description), or None without a checkpoint
+def uncertainty_model():
+    global _uncertainty_model
+    if _uncertainty_model is None:
+        _uncertainty_model = False
+        if os.path.exists(os.path.join(CHECKPOINTS_DIR, 'best_brain_model.pth')):
+            try:
+                from model_utils import load_trained_model, get_transforms, normalization_from_info
+                model, model_info = load_trained_model('brain', CHECKPOINTS_DIR)
+                single_channel = model_info.get('input_channels', 3) == 1
+                transform = get_transforms('brain', single_channel=single_channel,
+                                           normalization=normalization_from_info(model_info))['val']
+                idx_to_class = {v: k for k, v in model_info['class_to_idx'].items()}
+                description = {'checkpoint': os.path.join(CHECKPOINTS_DIR, 'best_brain_model.pth'),
+                               'architecture': model_info.get('architecture', 'densenet121'),
+                               'training_mode': model_info.get('training_mode')}
+                _uncertainty_model = (model, transform, idx_to_class, single_channel,
+                                      model_info.get('temperature', 1.0), description)
+            except Exception as e:
+                print(f"MC-dropout uncertainty unavailable: {e}")
+    return _uncertainty_model or None
+
+# The trained model's own prediction with its MC-dropout uncertainty and confidence
+# metrics, all computed from that model's probabilities
+def estimate_uncertainty(image):
+    loaded = uncertainty_model()
+    if loaded is None:
+        return None
+    import torchvision.transforms.functional as TF
+    from model_utils import device
+    from mc_dropout import predict_with_uncertainty, uncertainty_summary
+    from utils.metrics import calculate_confidence_metrics
+    model, transform, idx_to_class, single_channel, temperature, description = loaded
+    inputs = transform(TF.to_tensor(image.convert('L')) if single_channel else image).unsqueeze(0).to(device)
+    result = predict_with_uncertainty(model, inputs, MC_DROPOUT_SAMPLES, temperature)
+    summary = uncertainty_summary(result, idx_to_class)
+    probabilities = {idx_to_class.get(i, str(i)): p for i, p in enumerate(result['probabilities'][0].tolist())}
+    return {
+        'model': description,
+        'predicted_class': max(probabilities, key=probabilities.get),
+        'class_probabilities': probabilities,
+        'uncertainty': summary,
+        'confidence_metrics': calculate_confidence_metrics({'class_probabilities': probabilities,
+                                                            'uncertainty': summary}),
+    }
+
 app = Flask(__name__)
 # Configure CORS to allow requests from your frontend
 CORS(app, resources={
@@ -94,46 +155,54 @@ def analyze_brain():
 
         # Process the image
         try:
-            # Preprocess the image
-            preprocessed_image = preprocess_image(image_url)
+            with profiler.request('brain_analyze', request.headers) as profile:
+                # Preprocess the image
+                preprocessed_image = preprocess_image(image_url, profile)
 
-            # Make predictions
-            prediction_results = classifier.predict(preprocessed_image)
+                # Make predictions
+                with profile.span('forward'):
+                    prediction_results = classifier.predict(preprocessed_image)
 
-            # Determine if tumor is present
-            tumor_present = prediction_results['tumor_type'] != 'normal'
+                with profile.span('uncertainty'):
+                    uncertainty = estimate_uncertainty(preprocessed_image)
 
-            # Prepare results
-            results = {
-                'scan_id': scan_id,
-                'timestamp': datetime.now().isoformat(),
-                'predictions': {
-                    'tumor_present': tumor_present,
-                    'tumor_type': prediction_results['tumor_type'] if tumor_present else None,
-                    'tumor_grade': prediction_results['tumor_grade'] if tumor_present else None,
-                    'tumor_probability': prediction_results['tumor_probability'],
-                    'class_probabilities': prediction_results['class_probabilities']
-                },
-                'location': {
-                    'bounding_box': [100, 100, 200, 200],  # Placeholder
-                    'heatmap': 'heatmap_data',  # Placeholder
-                    'dimensions': prediction_results['tumor_dimensions'],
-                    'volume': prediction_results['tumor_volume']
-                },
-                'confidence_metrics': {
-                    'model_confidence': prediction_results['tumor_probability'],
-                    'prediction_stability': 0.88  # Placeholder
-                },
-                'longitudinal_analysis': None,  # Placeholder
-                'research_metrics': {
-                    'image_quality_score': prediction_results['image_quality_score'],
-                    'segmentation_quality': 0.90  # Placeholder
-                },
-                'metadata': {
-                    'processing_time': prediction_results['processing_time'],
-                    'model_version': classifier.version
-                }
-            }
+                with profile.span('postprocess'):
+                    # Determine if tumor is present
+                    tumor_present = prediction_results['tumor_type'] != 'normal'
+
+                    # Prepare results
+                    results = {
+                        'scan_id': scan_id,
+                        'timestamp': datetime.now().isoformat(),
+                        'predictions': {
+                            'tumor_present': tumor_present,
+                            'tumor_type': prediction_results['tumor_type'] if tumor_present else None,
+                            'tumor_grade': prediction_results['tumor_grade'] if tumor_present else None,
+                            'tumor_probability': prediction_results['tumor_probability'],
+                            'class_probabilities': prediction_results['class_probabilities']
+                        },
+                        'location': {
+                            'bounding_box': [100, 100, 200, 200],  # Placeholder
+                            'heatmap': 'heatmap_data',  # Placeholder
+                            'dimensions': prediction_results['tumor_dimensions'],
+                            'volume': prediction_results['tumor_volume']
+                        },
+                        'confidence_metrics': {
+                            'model_confidence': prediction_results['tumor_probability'],
+                            'prediction_stability': 0.88  # Placeholder without a trained checkpoint
+                        },
+                        'longitudinal_analysis': None,  # Placeholder
+                        'research_metrics': {
+                            'image_quality_score': prediction_results['image_quality_score'],
+                            'segmentation_quality': 0.90  # Placeholder
+                        },
+                        'metadata': {
+                            'processing_time': prediction_results['processing_time'],
+                            'model_version': classifier.version
+                        }
+                    }
+                    if uncertainty is not None:
+                        results['trained_model_uncertainty'] = uncertainty
         except Exception as e:
             # If image processing fails, return mock results with error message
             return jsonify({
@@ -1,47 +1,179 @@
 import os
 import numpy as np
 import cv2
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.model_selection import train_test_split
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def _store(dest, pixels):
+    if dest.dtype == np.uint8:
+        dest[...] = pixels
+    else:
+        np.multiply(pixels, 1.0 / 255.0, out=dest, casting='unsafe')
+
+# Decode one chunk of images as uint8. Memory-mapped outputs are written in place by the
+# worker; otherwise the uint8 chunk is returned and scaled into the parent's array.
+def _load_chunk(paths, img_size, mmap_path=None, start=0):
+    cv2.setNumThreads(1)
+    width, height = img_size
+    pixels = np.zeros((len(paths), height, width, 3), dtype=np.uint8)
+    failed = []
+    for i, img_path in enumerate(paths):
+        try:
+            img = cv2.imread(img_path)
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            pixels[i] = cv2.resize(img, img_size)
+        except Exception as e:
+            print(f"Error processing {img_path}: {str(e)}")
+            failed.append(i)
+    if mmap_path is not None:
+        data = np.load(mmap_path, mmap_mode='r+')
+        _store(data[start:start + len(paths)], pixels)
+        data.flush()
+        return None, failed
+    return pixels, failed
+
+# Rewrites the .npy header of `path` to declare only the first `rows` rows and drops
+# the rest of the file. The header keeps its length, so the data offset is unchanged.
+def _truncate_npy(path, rows):
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                       'shape': (rows,) + tuple(shape[1:])}).encode('latin1')
+        # magic string, version bytes and the header-length field
+        start = 8 + (2 if version == (1, 0) else 4)
+        f.seek(start)
+        f.write(header + b' ' * (offset - start - len(header) - 1) + b'\n')
+        f.truncate(offset + rows * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+
+# Rows `indices` of `data` without copying them: rows are only read when indexed, so a
+# memory-mapped dataset stays on disk. np.asarray(view) materialises the whole view.
+class RowView:
+    def __init__(self, data, indices):
+        self.data = data
+        self.indices = np.asarray(indices)
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + tuple(self.data.shape[1:])
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        rows, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        idx = self.indices[rows]
+        if np.ndim(idx) == 0:
+            return self.data[int(idx)][rest]
+        return self.data[idx][(slice(None),) + rest]
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.data[int(i)]
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.data[self.indices]
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
 class BrainTumorDataProcessor:
     def __init__(self, base_path):
         self.base_path = base_path
         self.classes = ['glioma', 'meningioma', 'notumor', 'pituitary']
         self.data = []
         self.labels = []
-        
-    def load_and_preprocess_images(self, img_size=(224, 224)):
-        for class_idx, class_name in enumerate(self.classes):
-            class_path = os.path.join(self.base_path, 'Testing', class_name)
-            for img_name in os.listdir(class_path):
-                img_path = os.path.join(class_path, img_name)
-                try:
-                    img = cv2.imread(img_path)
-                    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                    img = cv2.resize(img, img_size)
-                    img = img / 255.0
-                    self.data.append(img)
-                    self.labels.append(class_idx)
-                except Exception as e:
-                    print(f"Error processing {img_path}: {str(e)}")
-        
-        self.data = np.array(self.data)
-        self.labels = np.array(self.labels)
-        
-    def split_data(self, test_size=0.2, random_state=42):
+        self.paths = []
+
+    def list_images(self, splits=('Testing',)):
+        paths, labels = [], []
+        for split in splits:
+            for class_idx, class_name in enumerate(self.classes):
+                class_path = os.path.join(self.base_path, split, class_name)
+                if not os.path.isdir(class_path):
+                    continue
+                for entry in sorted(os.scandir(class_path), key=lambda e: e.name):
+                    if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.append(entry.path)
+                        labels.append(class_idx)
+        return paths, labels
+
+    # Loads the selected splits into one preallocated array of shape (N, H, W, 3).
+    # dtype=np.float32 keeps the old [0, 1] scaling at a quarter of the float64 size;
+    # np.uint8 keeps raw pixels. With mmap_path the array is a .npy file on disk, so
+    # datasets larger than RAM can still be loaded and explored.
+    def load_and_preprocess_images(self, img_size=(224, 224), splits=('Testing',), dtype=np.float32,
+                                   num_workers=None, mmap_path=None, chunk_size=64):
+        dtype = np.dtype(dtype).type
+        paths, labels = self.list_images(splits)
+        width, height = img_size
+        shape = (len(paths), height, width, 3)
+        if mmap_path is not None:
+            data = np.lib.format.open_memmap(mmap_path, mode='w+', dtype=dtype, shape=shape)
+        else:
+            data = np.empty(shape, dtype=dtype)
+
+        failed = []
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [(start, executor.submit(_load_chunk, paths[start:start + chunk_size], img_size,
+                                               mmap_path, start))
+                       for start in range(0, len(paths), chunk_size)]
+            for start, future in futures:
+                chunk, chunk_failed = future.result()
+                if chunk is not None:
+                    _store(data[start:start + len(chunk)], chunk)
+                failed.extend(start + i for i in chunk_failed)
+
+        keep = np.ones(len(paths), dtype=bool)
+        keep[failed] = False
+        if failed:
+            # Compact in place so no second full-size copy is made
+            write = 0
+            for read in np.flatnonzero(keep):
+                if read != write:
+                    data[write] = data[read]
+                write += 1
+            data = data[:write]
+        if mmap_path is not None:
+            data.flush()
+            if failed:
+                # The file still declares every listed image; make np.load see only the kept rows
+                del data
+                _truncate_npy(mmap_path, int(keep.sum()))
+                data = np.load(mmap_path, mmap_mode='r+')
+
+        self.data = data
+        self.labels = np.asarray(labels, dtype=np.int64)[keep]
+        self.paths = [p for p, k in zip(paths, keep) if k]
+
+    # Stratified index split; works on memory-mapped data without materialising it
+    def split_indices(self, test_size=0.2, random_state=42):
         return train_test_split(
-            self.data, 
-            self.labels, 
-            test_size=test_size, 
+            np.arange(len(self.labels)),
+            test_size=test_size,
             random_state=random_state,
             stratify=self.labels
         )
-    
+
+    # X_train and X_test are RowViews over self.data, not copies; index them per batch
+    def split_data(self, test_size=0.2, random_state=42):
+        train_idx, test_idx = self.split_indices(test_size=test_size, random_state=random_state)
+        return (RowView(self.data, train_idx), RowView(self.data, test_idx),
+                self.labels[train_idx], self.labels[test_idx])
+
     def get_class_names(self):
         return self.classes
-    
+
     def get_data_shape(self):
         return self.data.shape
-    
+
     def get_unique_labels(self):
-        return np.unique(self.labels, return_counts=True)
\ No newline at end of file
+        return np.unique(self.labels, return_counts=True)
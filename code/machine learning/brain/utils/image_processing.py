@@ -1,45 +1,67 @@
-import requests
 from io import BytesIO
 import random
-from PIL import Image
 import os
 import time
+from contextlib import nullcontext
 
-def preprocess_image(image_url):
+def fetch_image(image_url):
+    """
+    Read the raw image bytes from a URL or a local path
+    """
+    # Check if the URL is a local file path
+    if image_url.startswith('http'):
+        # Download image from URL (requests is only imported when a URL is fetched)
+        import requests
+        response = requests.get(image_url)
+        return response.content
+
+    # Remove leading slash if present
+    if image_url.startswith('/'):
+        image_url = image_url[1:]
+
+    # Handle relative paths
+    if not os.path.isabs(image_url):
+        # Assume the path is relative to the backend directory
+        base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+        image_path = os.path.join(base_dir, image_url)
+    else:
+        image_path = image_url
+
+    # Read the local file
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+def decode_image(image_bytes):
+    """
+    Decode image bytes into a 224x224 RGB image
+    """
+    from PIL import Image
+    image = Image.open(BytesIO(image_bytes))
+
+    # Convert to RGB if necessary
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # Resize to standard size
+    return image.resize((224, 224))
+
+def preprocess_image(image_url, profile=None):
     """
     Download and preprocess an image from a URL
+
+    profile is an optional request_profiling profile; fetch and decode are
+    recorded as separate spans
     """
+    span = profile.span if profile is not None else (lambda name: nullcontext())
     try:
-        # Check if the URL is a local file path
-        if image_url.startswith('http'):
-            # Download image from URL
-            response = requests.get(image_url)
-            image = Image.open(BytesIO(response.content))
-        else:
-            # Remove leading slash if present
-            if image_url.startswith('/'):
-                image_url = image_url[1:]
-
-            # Handle relative paths
-            if not os.path.isabs(image_url):
-                # Assume the path is relative to the backend directory
-                base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-                image_path = os.path.join(base_dir, image_url)
-            else:
-                image_path = image_url
-
-            # Open the local file
-            image = Image.open(image_path)
-
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-
-        # Resize to standard size
-        image = image.resize((224, 224))
+        with span('fetch'):
+            image_bytes = fetch_image(image_url)
+        with span('decode'):
+            image = decode_image(image_bytes)
 
         # Simulate processing delay
-        time.sleep(random.uniform(0.1, 0.5))
+        with span('transform'):
+            time.sleep(random.uniform(0.1, 0.5))
 
         # Return the image (in a real system, we would convert to numpy array)
         return image
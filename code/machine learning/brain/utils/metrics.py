@@ -1,9 +1,12 @@
 import numpy as np
-from scipy import stats
 
-def calculate_confidence_metrics(predictions):
+def calculate_confidence_metrics(predictions, max_mutual_information=0.1):
     """
     Calculate confidence metrics for the predictions
+
+    When predictions carry an 'uncertainty' entry (MC-dropout, see
+    mc_dropout.uncertainty_summary), its variance, mutual information and
+    stability are added, and high mutual information also flags the case for review
     """
     # Get class probabilities
     probs = predictions['class_probabilities']
@@ -29,7 +32,7 @@ def calculate_confidence_metrics(predictions):
         margin < 0.2       # Close probabilities
     )
     
-    return {
+    metrics = {
         'entropy': float(entropy),
         'max_probability': float(max_prob),
         'probability_margin': float(margin),
@@ -37,6 +40,15 @@ def calculate_confidence_metrics(predictions):
         'needs_human_review': bool(needs_review)
     }
 
+    mc = predictions.get('uncertainty')
+    if mc:
+        metrics['predictive_variance'] = float(max(mc['predictive_variance'].values()))
+        metrics['mutual_information'] = mc['mutual_information']
+        metrics['prediction_stability'] = mc['prediction_stability']
+        metrics['needs_human_review'] = bool(needs_review or mc['mutual_information'] > max_mutual_information)
+
+    return metrics
+
 def calculate_tumor_growth_rate(historical_data):
     """
     Calculate tumor growth rate from historical data
@@ -1,13 +1,15 @@
 import numpy as np
-import cv2
-import matplotlib.pyplot as plt
 from io import BytesIO
 import base64
 
+# cv2 and matplotlib are imported inside the functions that use them: together they
+# cost more start-up time than the rest of the service.
+
 def generate_heatmap(image, predictions):
     """
     Generate a heatmap showing the model's attention
     """
+    import cv2
     # Convert image to grayscale
     gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
     
@@ -37,6 +39,7 @@ def create_bounding_box(image, predictions):
     """
     Create a bounding box around the tumor
     """
+    import cv2
     # Get tumor dimensions
     dimensions = predictions['tumor_dimensions']
     
@@ -62,6 +65,7 @@ def create_visualization_report(image, predictions):
     """
     Create a comprehensive visualization report
     """
+    import matplotlib.pyplot as plt
     # Create figure with subplots
     fig, axes = plt.subplots(2, 2, figsize=(12, 12))
     
@@ -108,6 +112,7 @@ def generate_trend_visualization(historical_data):
     """
     Generate visualization of tumor growth/regression over time
     """
+    import matplotlib.pyplot as plt
     dates = [d['date'] for d in historical_data]
     volumes = [d['volume'] for d in historical_data]
     
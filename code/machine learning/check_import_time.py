@@ -0,0 +1,74 @@
+import os
+import sys
+import argparse
+import subprocess
+
+# Start-up import budget for the Flask services. Each app module is imported in a fresh
+# interpreter with -X importtime; the check fails when the cumulative import time goes
+# over its budget or when a heavy module that should load lazily shows up at import.
+#
+#   python check_import_time.py
+#   python check_import_time.py --budget-ms app=500 brain_app=400
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# name -> (working directory, module imported)
+TARGETS = {
+    'app': (ROOT, 'app'),
+    'brain_app': (os.path.join(ROOT, 'brain'), 'app'),
+}
+DEFAULT_BUDGET_MS = {'app': 600.0, 'brain_app': 600.0}
+LAZY_MODULES = ['torch', 'torchvision', 'matplotlib', 'cv2', 'scipy', 'requests']
+
+# "import time: self [us] | cumulative | imported package" lines -> [(module, self_us, cumulative_us, depth)]
+def parse_importtime(stderr):
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+def measure_import(cwd, module, runs=3):
+    best = None
+    for _ in range(runs):
+        env = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'}
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=cwd, env=env,
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"import {module} failed in {cwd}:\n{proc.stderr[-2000:]}")
+        rows = parse_importtime(proc.stderr)
+        # Cumulative time of the target module itself; interpreter start-up (site) is excluded
+        total_us = sum(cumulative for name, _, cumulative, depth in rows if name == module and depth == 0)
+        if best is None or total_us < best[0]:
+            best = (total_us, rows)
+    return best
+
+def check(budgets, top=10, runs=3):
+    failed = False
+    for name, (cwd, module) in TARGETS.items():
+        total_us, rows = measure_import(cwd, module, runs=runs)
+        imported = {row[0] for row in rows}
+        eager = sorted(m for m in LAZY_MODULES if m in imported)
+        budget = budgets.get(name, DEFAULT_BUDGET_MS[name])
+        ok = total_us / 1000 <= budget and not eager
+        failed |= not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: {total_us / 1000:.0f} ms (budget {budget:.0f} ms)")
+        if eager:
+            print(f"     imported at start-up but should load lazily: {', '.join(eager)}")
+        for module_name, _, cumulative, depth in sorted(rows, key=lambda r: -r[2])[:top] if not ok else []:
+            print(f"     {cumulative / 1000:8.1f} ms  {'  ' * depth}{module_name}")
+    return not failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail when service start-up imports exceed their time budget")
+    parser.add_argument('--budget-ms', nargs='*', default=[], metavar='NAME=MS',
+                        help=f"Override budgets for {', '.join(TARGETS)}")
+    parser.add_argument('--runs', type=int, default=3, help="Best of N fresh interpreters")
+    args = parser.parse_args()
+    budgets = {name: float(ms) for name, ms in (spec.split('=', 1) for spec in args.budget_ms)}
+    sys.exit(0 if check(budgets, runs=args.runs) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -2,28 +2,16 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
-from PIL import Image
 from setup import CLASSES
+from medical_datasets import IndexedImageDataset
 
-class LungXrayDataset(Dataset):
+# Paths and labels are copied out of the dataframe once into a shared-memory index,
+# so __getitem__ does no per-item pandas lookups
+class LungXrayDataset(IndexedImageDataset):
     def __init__(self, dataframe, transform=None):
-        self.dataframe = dataframe
-        self.transform = transform
-        
-    def __len__(self):
-        return len(self.dataframe)
-    
-    def __getitem__(self, idx):
-        img_path = self.dataframe.iloc[idx]['path']
-        image = Image.open(img_path).convert('RGB')
-        class_id = self.dataframe.iloc[idx]['class_id']
-        
-        if self.transform:
-            image = self.transform(image)
-            
-        return image, class_id
+        super().__init__(dataframe['path'].tolist(), dataframe['class_id'].tolist(), transform=transform)
 
 def create_data_loaders(train_df, val_df, test_df, target_size=(224, 224), batch_size=32):
     # Define transformations
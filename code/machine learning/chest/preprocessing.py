@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 import cv2
 from sklearn.model_selection import train_test_split
 from setup import CLASSES
+from dedup import group_aware_split
 
 def preprocess_image(image_path, target_size=(224, 224)):
     img = cv2.imread(image_path)
@@ -20,20 +21,33 @@ def preprocess_image(image_path, target_size=(224, 224)):
     return img
 
 def create_dataset(data_df, target_size=(224, 224), batch_size=32, test_size=0.2, val_size=0.1):
-    train_df, temp_df = train_test_split(
-        data_df, 
-        test_size=test_size + val_size,
-        stratify=data_df['class_id'],
-        random_state=42
-    )
+    # Drop files the manifest flagged as unreadable before they reach a split
+    if 'ok' in data_df.columns:
+        bad = ~data_df['ok'].astype(bool)
+        if bad.any():
+            print(f"Excluding {int(bad.sum())} unreadable images")
+        data_df = data_df[~bad]
     
-    val_size_adjusted = val_size / (test_size + val_size)
-    val_df, test_df = train_test_split(
-        temp_df,
-        test_size=1 - val_size_adjusted,
-        stratify=temp_df['class_id'],
-        random_state=42
-    )
+    if 'group' in data_df.columns:
+        # Near-duplicate groups from dedup.py never straddle two splits
+        train_idx, val_idx, test_idx = group_aware_split(data_df['class_id'].values, data_df['group'].values,
+                                                         test_size=test_size, val_size=val_size, random_state=42)
+        train_df, val_df, test_df = data_df.iloc[train_idx], data_df.iloc[val_idx], data_df.iloc[test_idx]
+    else:
+        train_df, temp_df = train_test_split(
+            data_df, 
+            test_size=test_size + val_size,
+            stratify=data_df['class_id'],
+            random_state=42
+        )
+        
+        val_size_adjusted = val_size / (test_size + val_size)
+        val_df, test_df = train_test_split(
+            temp_df,
+            test_size=1 - val_size_adjusted,
+            stratify=temp_df['class_id'],
+            random_state=42
+        )
     
     print(f"Training set: {len(train_df)} images")
     print(f"Validation set: {len(val_df)} images")
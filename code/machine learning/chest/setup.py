@@ -1,11 +1,14 @@
 import os
+import sys
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import cv2
 from sklearn.model_selection import train_test_split
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from manifest import build_manifest
+
 BASE_DIR = 'dataset/chest'
 
 CLASSES = [
@@ -21,24 +24,16 @@ CLASSES = [
 ]
 
 def load_and_explore_data():
-    class_counts = {}
-    all_files = []
-    
-    for class_name in CLASSES:
-        class_path = os.path.join(BASE_DIR, class_name)
-        if os.path.exists(class_path):
-            files = os.listdir(class_path)
-            image_files = [f for f in files if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-            class_counts[class_name] = len(image_files)
-            
-            for file in image_files:
-                all_files.append({
-                    'path': os.path.join(class_path, file),
-                    'class': class_name,
-                    'class_id': CLASSES.index(class_name)
-                })
+    # Scanned through the dataset manifest: headers are probed once and only new or
+    # changed files are re-read on later runs
+    manifest = build_manifest(BASE_DIR, classes=CLASSES)
+    class_counts = manifest.class_counts()
+    data_df = manifest.to_dataframe()
+    data_df['class_id'] = [CLASSES.index(c) for c in data_df['class']]
     
-    data_df = pd.DataFrame(all_files)
+    bad_count = int((~data_df['ok']).sum())
+    if bad_count:
+        print(f"Warning: {bad_count} unreadable images flagged in the manifest; they are excluded from the splits")
     
     print("Class distribution:")
     for class_name, count in class_counts.items():
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from sklearn.metrics import precision_recall_fscore_support
+from model_utils import get_transforms, get_model_architecture
+from manifest import build_manifest
+from decoded_cache import build_decoded_cache, DecodedImageDataset
+from medical_datasets import stratified_split
+from training_controller import TrainingController, run_epoch
+from sweep import DEFAULT_PARAMS, TRIAL_DEVICE, partition_cores, init_worker_threads
+
+# Stratified k-fold cross-validation. The pooled samples of the given splits (from
+# their manifests) are decoded once into a shared cache, and folds train concurrently
+# in a process pool with the CPU cores partitioned between them, as in sweep.py.
+# Within a fold, an inner stratified validation split of the training part picks the
+# checkpoint and drives early stopping; the held-out fold is only used for scoring.
+# A fold that fails is recorded with its error and the other folds carry on.
+#
+#   python cross_validation.py --model-type brain --folds 5 --parallel 5 --epochs 10
+
+# Round-robin assignment of each class's shuffled samples -> fold id per sample
+def stratified_folds(labels, num_folds, seed=42):
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    fold_of = np.empty(len(labels), dtype=np.int64)
+    offset = 0
+    for label in np.unique(labels):
+        idx = rng.permutation(np.flatnonzero(labels == label))
+        # Rotating the start keeps fold sizes even when class counts don't divide by k
+        fold_of[idx] = (np.arange(len(idx)) + offset) % num_folds
+        offset += len(idx)
+    return fold_of
+
+def pooled_samples(data_dir, model_type, splits=('train', 'val')):
+    train_manifest = build_manifest(os.path.join(data_dir, model_type, splits[0]))
+    class_to_idx = train_manifest.class_to_idx
+    samples = train_manifest.samples()
+    for split in splits[1:]:
+        samples += build_manifest(os.path.join(data_dir, model_type, split)).samples(class_to_idx)
+    return samples, class_to_idx
+
+# Fold's training part -> (inner train, inner validation) pooled indices, stratified by label
+def inner_split(train_idx, labels, val_size=0.1, seed=42):
+    parts = stratified_split(labels[train_idx], val_size=val_size, test_size=0.0, seed=seed)
+    return train_idx[parts['train']], train_idx[parts['val']]
+
+# select_idx picks the best epoch and stops training; test_idx (the held-out fold) is scored
+def run_fold(fold, model_type, params, cache_prefix, train_idx, select_idx, test_idx, out_dir):
+    params = {**DEFAULT_PARAMS, **params}
+    torch.manual_seed(42 + fold)
+    transforms_dict = get_transforms(model_type)
+    train_dataset = DecodedImageDataset(cache_prefix, transform=transforms_dict['train'], indices=train_idx)
+    val_dataset = DecodedImageDataset(cache_prefix, transform=transforms_dict['val'], indices=select_idx)
+    test_dataset = DecodedImageDataset(cache_prefix, transform=transforms_dict['val'], indices=test_idx)
+    # Cores are partitioned by thread count, so data loading stays in-process
+    train_loader = DataLoader(train_dataset, batch_size=params['batch_size'], shuffle=True, num_workers=0)
+    val_loader = DataLoader(val_dataset, batch_size=params['batch_size'], shuffle=False, num_workers=0)
+    test_loader = DataLoader(test_dataset, batch_size=params['batch_size'], shuffle=False, num_workers=0)
+
+    num_classes = len(train_dataset.classes)
+    model = get_model_architecture(model_type, num_classes).to(TRIAL_DEVICE)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=params['lr'], weight_decay=1e-5)
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=3, factor=0.1)
+    controller = TrainingController(scheduler, params['epochs'], patience=params['patience'],
+                                    cpu_cores=torch.get_num_threads())
+
+    fold_dir = os.path.join(out_dir, f"fold_{fold}")
+    os.makedirs(fold_dir, exist_ok=True)
+    best_path = os.path.join(fold_dir, f'best_{model_type}_model.pth')
+    start = time.perf_counter()
+    best_acc, best_epoch = 0.0, -1
+    for epoch in range(params['epochs']):
+        controller.start_epoch()
+        run_epoch(model, train_loader, criterion, optimizer, run_device=TRIAL_DEVICE)
+        val_loss, val_acc, _ = run_epoch(model, val_loader, criterion, run_device=TRIAL_DEVICE)
+        if val_acc > best_acc or best_epoch < 0:
+            best_acc, best_epoch = val_acc, epoch
+            torch.save({
+                'model_state_dict': model.state_dict(),
+                'acc': best_acc,
+                'epoch': epoch,
+                'class_to_idx': train_dataset.class_to_idx
+            }, best_path)
+        if controller.end_epoch(val_loss):
+            break
+    train_seconds = time.perf_counter() - start
+
+    # Per-class metrics of the fold's best checkpoint on its held-out part
+    model.load_state_dict(torch.load(best_path, map_location=TRIAL_DEVICE)['model_state_dict'])
+    model.eval()
+    preds = np.empty(len(test_dataset), dtype=np.int64)
+    labels = np.empty(len(test_dataset), dtype=np.int64)
+    pos = 0
+    with torch.no_grad():
+        for inputs, targets in test_loader:
+            n = len(targets)
+            preds[pos:pos + n] = model(inputs).argmax(dim=1).numpy()
+            labels[pos:pos + n] = targets.numpy()
+            pos += n
+    precision, recall, f1, support = precision_recall_fscore_support(labels, preds, labels=np.arange(num_classes),
+                                                                     zero_division=0)
+    result = {
+        'fold': fold,
+        'train_size': len(train_idx),
+        'selection_size': len(select_idx),
+        'test_size': len(test_idx),
+        'best_epoch': best_epoch,
+        'selection_accuracy': best_acc,
+        'accuracy': float(np.mean(preds == labels)),
+        'precision': precision.tolist(),
+        'recall': recall.tolist(),
+        'f1': f1.tolist(),
+        'support': support.tolist(),
+        'train_seconds': train_seconds,
+        'wall_seconds': time.perf_counter() - start,
+    }
+    with open(os.path.join(fold_dir, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+# Statistics over the folds that finished; failed folds are listed with their error
+def summarize(results, classes, failures=()):
+    results = sorted(results, key=lambda r: r['fold'])
+    failures = sorted(failures, key=lambda r: r['fold'])
+    summary = {
+        'num_folds': len(results) + len(failures),
+        'completed_folds': len(results),
+        'per_class': {},
+        'fold_wall_seconds': [r['wall_seconds'] for r in results],
+        'folds': results,
+        'failed_folds': failures,
+    }
+    for r in failures:
+        print(f"  Fold {r['fold']}: FAILED ({r['error']})")
+    if not results:
+        print("\nNo fold completed")
+        return summary
+    acc = np.array([r['accuracy'] for r in results])
+    summary['accuracy_mean'] = float(acc.mean())
+    summary['accuracy_std'] = float(acc.std(ddof=1)) if len(acc) > 1 else 0.0
+    for metric in ['precision', 'recall', 'f1']:
+        values = np.array([r[metric] for r in results])
+        for c, cls_name in enumerate(classes):
+            entry = summary['per_class'].setdefault(cls_name, {})
+            entry[f'{metric}_mean'] = float(values[:, c].mean())
+            entry[f'{metric}_std'] = float(values[:, c].std(ddof=1)) if len(values) > 1 else 0.0
+
+    print(f"\nAccuracy over {len(results)} folds: {summary['accuracy_mean']:.4f} +/- {summary['accuracy_std']:.4f}")
+    for r in results:
+        print(f"  Fold {r['fold']}: acc {r['accuracy']:.4f} (best epoch {r['best_epoch'] + 1}), {r['wall_seconds']:.1f}s")
+    print(f"{'Class':<20}{'Precision':>18}{'Recall':>18}{'F1':>18}")
+    for cls_name, entry in summary['per_class'].items():
+        cells = [f"{entry[f'{m}_mean']:.3f} +/- {entry[f'{m}_std']:.3f}" for m in ['precision', 'recall', 'f1']]
+        print(f"{cls_name:<20}" + ''.join(f"{cell:>18}" for cell in cells))
+    return summary
+
+def cross_validate(model_type, num_folds=5, params=None, data_dir='medical_images', splits=('train', 'val'),
+                   out_dir='cross_validation', cache_dir='decoded_cache', parallel=None, seed=42,
+                   inner_val_size=0.1):
+    out_dir = os.path.join(out_dir, model_type)
+    os.makedirs(out_dir, exist_ok=True)
+    samples, class_to_idx = pooled_samples(data_dir, model_type, splits)
+    # One decoded cache for the pooled samples; every fold reads it through index subsets
+    cache_prefix = build_decoded_cache(samples, class_to_idx, os.path.join(cache_dir, f"{model_type}_{'_'.join(splits)}"))
+    labels = np.array([label for _, label in samples])
+    fold_of = stratified_folds(labels, num_folds, seed=seed)
+    # Fetch the ImageNet weights once so folds don't race on the download
+    get_model_architecture(model_type, 2)
+
+    parallel, threads = partition_cores(parallel or num_folds)
+    print(f"{len(samples)} samples, {num_folds} folds, {parallel} at a time with {threads} threads each")
+    context = multiprocessing.get_context('spawn')
+    results, failures = [], []
+    with ProcessPoolExecutor(max_workers=parallel, mp_context=context,
+                             initializer=init_worker_threads, initargs=(threads,)) as executor:
+        futures = {}
+        for fold in range(num_folds):
+            train_idx, select_idx = inner_split(np.flatnonzero(fold_of != fold), labels, inner_val_size, seed + fold)
+            futures[executor.submit(run_fold, fold, model_type, params or {}, cache_prefix, train_idx, select_idx,
+                                    np.flatnonzero(fold_of == fold), out_dir)] = fold
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Fold {futures[future]} failed: {e}")
+                failures.append({'fold': futures[future], 'error': f"{type(e).__name__}: {e}"})
+                continue
+            print(f"Fold {result['fold']} done: acc {result['accuracy']:.4f} in {result['wall_seconds']:.1f}s")
+            results.append(result)
+    summary = summarize(results, list(class_to_idx.keys()), failures)
+    summary['params'] = {**DEFAULT_PARAMS, **(params or {})}
+    with open(os.path.join(out_dir, 'cv_results.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel stratified k-fold cross-validation")
+    parser.add_argument('--model-type', required=True, choices=['chest', 'brain', 'scan_type'])
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--data-dir', default='medical_images')
+    parser.add_argument('--splits', nargs='+', default=['train', 'val'], help="Splits pooled before folding")
+    parser.add_argument('--out-dir', default='cross_validation')
+    parser.add_argument('--cache-dir', default='decoded_cache')
+    parser.add_argument('--parallel', type=int, default=None, help="Folds run concurrently (default: all)")
+    parser.add_argument('--epochs', type=int, default=DEFAULT_PARAMS['epochs'])
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_PARAMS['batch_size'])
+    parser.add_argument('--lr', type=float, default=DEFAULT_PARAMS['lr'])
+    parser.add_argument('--patience', type=int, default=DEFAULT_PARAMS['patience'])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--inner-val-size', type=float, default=0.1,
+                        help="Share of each fold's training part used for checkpoint selection and early stopping")
+    args = parser.parse_args()
+    params = {'epochs': args.epochs, 'batch_size': args.batch_size, 'lr': args.lr, 'patience': args.patience}
+    cross_validate(args.model_type, num_folds=args.folds, params=params, data_dir=args.data_dir,
+                   splits=tuple(args.splits), out_dir=args.out_dir, cache_dir=args.cache_dir,
+                   parallel=args.parallel, seed=args.seed, inner_val_size=args.inner_val_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from manifest import build_manifest, default_manifest_path
+from image_io import load_rgb, load_grayscale
+
+# One-pass dataset statistics: per-channel mean/std, intensity histograms, image size
+# distribution and class counts for every split of a class-folder dataset. Workers
+# decode disjoint chunks and return mergeable accumulators, so the pass is parallel and
+# the result does not depend on the chunking. Results are cached as
+# <split>.stats.json next to the split's manifest and rebuilt only when it changes.
+# Datasets that are not one folder (the composite scan_type split) use compute_paths_stats.
+#
+#   python dataset_stats.py medical_images/brain
+#   python dataset_stats.py medical_images/chest --single-channel
+
+HIST_BINS = 256
+STATS_SIZE = (224, 224)
+
+# Mergeable per-channel mean/variance (Welford updates, Chan et al. pairwise merge)
+class RunningStats:
+    def __init__(self, channels):
+        self.count = 0
+        self.mean = np.zeros(channels, dtype=np.float64)
+        self.m2 = np.zeros(channels, dtype=np.float64)
+
+    # pixels: (N, C) batch of values
+    def update(self, pixels):
+        n = len(pixels)
+        if n == 0:
+            return
+        batch = RunningStats(pixels.shape[1])
+        batch.count = n
+        batch.mean = pixels.mean(axis=0, dtype=np.float64)
+        batch.m2 = ((pixels - batch.mean) ** 2).sum(axis=0, dtype=np.float64)
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / total)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / total)
+        self.count = total
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+# Pixels in [0, 1] at training resolution as (H*W, C); resizing first weights every
+# image equally, as the training transforms do
+def _image_pixels(path, single_channel):
+    if single_channel:
+        gray = Image.fromarray(load_grayscale(path), mode='F').resize(STATS_SIZE, Image.BILINEAR)
+        return np.asarray(gray, dtype=np.float32).reshape(-1, 1)
+    rgb = load_rgb(path).resize(STATS_SIZE, Image.BILINEAR)
+    return (np.asarray(rgb, dtype=np.float32) / 255.0).reshape(-1, 3)
+
+def _stats_chunk(paths, single_channel):
+    channels = 1 if single_channel else 3
+    stats = RunningStats(channels)
+    hist = np.zeros((channels, HIST_BINS), dtype=np.int64)
+    failed = 0
+    for path in paths:
+        try:
+            pixels = _image_pixels(path, single_channel)
+        except Exception as e:
+            print(f"Error reading {path}: {e}")
+            failed += 1
+            continue
+        stats.update(pixels)
+        bins = np.minimum((pixels * HIST_BINS).astype(np.int64), HIST_BINS - 1)
+        for c in range(channels):
+            hist[c] += np.bincount(bins[:, c], minlength=HIST_BINS)
+    return stats, hist, failed
+
+def default_stats_path(root_dir, single_channel=False):
+    suffix = '.gray.stats.json' if single_channel else '.stats.json'
+    return default_manifest_path(root_dir)[:-len('.manifest.npz')] + suffix
+
+def manifest_key(manifest):
+    h = hashlib.sha1()
+    for path, size, mtime, ok in zip(manifest.paths, manifest.sizes, manifest.mtimes, manifest.ok):
+        h.update(f"{path}:{size}:{mtime}:{ok}\n".encode())
+    return h.hexdigest()
+
+def size_distribution(widths, heights):
+    if len(widths) == 0:
+        return {}
+    percentiles = [0, 5, 25, 50, 75, 95, 100]
+    return {
+        'width_percentiles': dict(zip(map(str, percentiles), np.percentile(widths, percentiles).tolist())),
+        'height_percentiles': dict(zip(map(str, percentiles), np.percentile(heights, percentiles).tolist())),
+        'aspect_ratio_mean': float(np.mean(widths / np.maximum(heights, 1))),
+        'unique_sizes': int(len(set(zip(widths.tolist(), heights.tolist())))),
+    }
+
+# Mean/std accumulator, histograms and failure count over `paths`, in parallel chunks
+def pooled_stats(paths, single_channel=False, num_workers=None, chunk_size=64):
+    channels = 1 if single_channel else 3
+    stats = RunningStats(channels)
+    hist = np.zeros((channels, HIST_BINS), dtype=np.int64)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_stats_chunk, paths[i:i + chunk_size], single_channel)
+                   for i in range(0, len(paths), chunk_size)]
+        for future in futures:
+            chunk_stats, chunk_hist, chunk_failed = future.result()
+            stats.merge(chunk_stats)
+            hist += chunk_hist
+            failed += chunk_failed
+    return stats, hist, failed
+
+# Statistics of one class-folder split, served from the cache when the manifest is unchanged
+def compute_split_stats(root_dir, single_channel=False, num_workers=None, chunk_size=64, stats_path=None):
+    stats_path = stats_path or default_stats_path(root_dir, single_channel)
+    manifest = build_manifest(root_dir)
+    key = manifest_key(manifest)
+    if os.path.exists(stats_path):
+        with open(stats_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return cached
+
+    paths = [path for path, _ in manifest.samples()]
+    stats, hist, failed = pooled_stats(paths, single_channel, num_workers, chunk_size)
+
+    ok = manifest.ok
+    result = {
+        'key': key,
+        'root_dir': root_dir,
+        'single_channel': single_channel,
+        'num_images': len(paths),
+        'failed': failed,
+        'mean': stats.mean.tolist(),
+        'std': stats.std.tolist(),
+        'histogram_bins': HIST_BINS,
+        'histograms': hist.tolist(),
+        'sizes': size_distribution(manifest.widths[ok], manifest.heights[ok]),
+        'class_counts': manifest.class_counts(),
+        'unreadable': len(manifest) - int(ok.sum()),
+    }
+    with open(stats_path, 'w') as f:
+        json.dump(result, f)
+    print(f"Stats for {root_dir}: {len(paths)} images, mean {np.round(stats.mean, 4).tolist()}, "
+          f"std {np.round(stats.std, 4).tolist()} -> {stats_path}")
+    return result
+
+def dataset_stats(data_dir, splits=('train', 'val', 'test'), single_channel=False, num_workers=None):
+    return {split: compute_split_stats(os.path.join(data_dir, split), single_channel=single_channel,
+                                       num_workers=num_workers)
+            for split in splits if os.path.isdir(os.path.join(data_dir, split))}
+
+# Statistics of an explicit image list, cached in stats_path under a hash of the list
+def compute_paths_stats(paths, stats_path, single_channel=False, num_workers=None, chunk_size=64):
+    key = hashlib.sha1(''.join(f"{path}\n" for path in paths).encode()).hexdigest()
+    if os.path.exists(stats_path):
+        with open(stats_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('key') == key and cached.get('single_channel') == single_channel:
+            return cached
+    stats, hist, failed = pooled_stats(paths, single_channel, num_workers, chunk_size)
+    result = {
+        'key': key,
+        'single_channel': single_channel,
+        'num_images': len(paths),
+        'failed': failed,
+        'mean': stats.mean.tolist(),
+        'std': stats.std.tolist(),
+        'histogram_bins': HIST_BINS,
+        'histograms': hist.tolist(),
+    }
+    with open(stats_path, 'w') as f:
+        json.dump(result, f)
+    print(f"Stats for {len(paths)} images: mean {np.round(stats.mean, 4).tolist()}, "
+          f"std {np.round(stats.std, 4).tolist()} -> {stats_path}")
+    return result
+
+# (mean, std) for transforms.Normalize from a split's statistics (normally the training
+# split), computing them on first use
+def load_normalization(root_dir, single_channel=False, num_workers=None):
+    if not os.path.isdir(root_dir):
+        raise FileNotFoundError(f"No split folder {root_dir} to compute normalisation statistics from")
+    stats = compute_split_stats(root_dir, single_channel=single_channel, num_workers=num_workers)
+    return stats['mean'], stats['std']
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute cached per-split statistics of a class-folder dataset")
+    parser.add_argument('data_dir', help="Dataset directory with train/val/test class folders (e.g. medical_images/brain)")
+    parser.add_argument('--splits', nargs='+', default=['train', 'val', 'test'])
+    parser.add_argument('--single-channel', action='store_true', help="Statistics of the single-channel (image_io) pipeline")
+    parser.add_argument('--num-workers', type=int, default=None)
+    args = parser.parse_args()
+    results = dataset_stats(args.data_dir, splits=args.splits, single_channel=args.single_channel,
+                            num_workers=args.num_workers)
+    for split, stats in results.items():
+        counts = ', '.join(f"{c}={n}" for c, n in stats['class_counts'].items())
+        median = stats['sizes'].get('width_percentiles', {}).get('50'), stats['sizes'].get('height_percentiles', {}).get('50')
+        print(f"{split}: {stats['num_images']} images ({counts}); median size {median[0]}x{median[1]}; "
+              f"mean {np.round(stats['mean'], 4).tolist()} std {np.round(stats['std'], 4).tolist()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+
+# Decode-once image cache: every image is decoded, resized and stored as uint8 rows of
+# one memory-mapped .npy array. Many processes (sweep trials, CV folds) can then read
+# the same decoded pixels through the page cache instead of decoding JPEGs again.
+
+def cache_paths(cache_prefix):
+    return cache_prefix + "_images.npy", cache_prefix + "_labels.npy", cache_prefix + "_meta.json"
+
+def samples_key(samples, size):
+    h = hashlib.sha1(f"{size[0]}x{size[1]}".encode())
+    for path, label in samples:
+        h.update(f"{path}:{label}\n".encode())
+    return h.hexdigest()
+
+def decode_image(path, size):
+    with Image.open(path) as img:
+        return np.asarray(img.convert('RGB').resize(size), dtype=np.uint8)
+
+# Worker: decode a contiguous chunk and write it straight into the shared memmap
+def _decode_chunk(images_path, start, paths, size):
+    images = np.load(images_path, mmap_mode='r+')
+    failed = []
+    for offset, path in enumerate(paths):
+        try:
+            images[start + offset] = decode_image(path, size)
+        except Exception as e:
+            print(f"Error decoding {path}: {e}. Using placeholder image.")
+            images[start + offset] = 128
+            failed.append(start + offset)
+    images.flush()
+    return failed
+
+def build_decoded_cache(samples, class_to_idx, cache_prefix, size=(224, 224), num_workers=None, chunk_size=256):
+    images_path, labels_path, meta_path = cache_paths(cache_prefix)
+    key = samples_key(samples, size)
+    if os.path.exists(meta_path) and os.path.exists(images_path):
+        with open(meta_path, 'r') as f:
+            if json.load(f).get('key') == key:
+                return cache_prefix
+    os.makedirs(os.path.dirname(cache_prefix) or '.', exist_ok=True)
+    width, height = size
+    images = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8,
+                                       shape=(len(samples), height, width, 3))
+    del images
+    paths = [path for path, _ in samples]
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_decode_chunk, images_path, start, paths[start:start + chunk_size], size)
+                   for start in range(0, len(paths), chunk_size)]
+        for future in futures:
+            failed.extend(future.result())
+    np.save(labels_path, np.array([label for _, label in samples], dtype=np.int64))
+    with open(meta_path, 'w') as f:
+        json.dump({'key': key, 'size': list(size), 'num_samples': len(samples),
+                   'class_to_idx': class_to_idx, 'failed': failed}, f)
+    print(f"Decoded {len(samples)} images into {images_path} ({len(failed)} failed)")
+    return cache_prefix
+
+# Dataset over a decoded cache; `indices` selects a subset (e.g. a CV fold) without copying
+class DecodedImageDataset(Dataset):
+    def __init__(self, cache_prefix, transform=None, indices=None):
+        self.cache_prefix = cache_prefix
+        self.transform = transform
+        images_path, labels_path, meta_path = cache_paths(cache_prefix)
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        self.class_to_idx = meta['class_to_idx']
+        self.classes = list(self.class_to_idx.keys())
+        self.labels = np.load(labels_path)
+        self.indices = np.arange(len(self.labels)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self._images = None
+
+    @property
+    def images(self):
+        # Opened lazily so each DataLoader worker maps the file itself
+        if self._images is None:
+            self._images = np.load(cache_paths(self.cache_prefix)[0], mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        row = self.indices[idx]
+        image = Image.fromarray(np.asarray(self.images[row]))
+        if self.transform:
+            image = self.transform(image)
+        return image, int(self.labels[row])
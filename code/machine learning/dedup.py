@@ -0,0 +1,240 @@
+import os
+import csv
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from manifest import build_manifest
+
+# Near-duplicate detection across dataset splits. Each image is decoded once into a
+# 32x32 grayscale thumbnail (kept in a cache next to the hashes), hashed with a DCT
+# perceptual hash into 64 bit-packed bits, and pairs are found with a blocked,
+# vectorised Hamming-distance search instead of Python pair loops.
+#
+#   python dedup.py --split train=medical_images/brain/train --split val=medical_images/brain/val \
+#                   --split test=medical_images/brain/test --threshold 6 --group-split brain_groups
+
+THUMB_SIZE = 32
+HASH_SIZE = 8
+POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def thumbnail(path, size=THUMB_SIZE):
+    with Image.open(path) as img:
+        # JPEG draft mode decodes at a reduced scale, which is all a 32x32 thumbnail needs
+        img.draft('L', (size * 4, size * 4))
+        return np.asarray(img.convert('L').resize((size, size), Image.BILINEAR), dtype=np.uint8)
+
+def _thumbnail_chunk(paths):
+    thumbs = np.zeros((len(paths), THUMB_SIZE, THUMB_SIZE), dtype=np.uint8)
+    ok = np.ones(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        try:
+            thumbs[i] = thumbnail(path)
+        except Exception as e:
+            print(f"Error hashing {path}: {e}")
+            ok[i] = False
+    return thumbs, ok
+
+def dct_matrix(n):
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m.astype(np.float32)
+
+# DCT perceptual hash of a stack of thumbnails -> (N, 8) uint8, 64 bits per image
+def phash(thumbs, hash_size=HASH_SIZE):
+    d = dct_matrix(thumbs.shape[1])
+    coeffs = np.einsum('ij,njk,lk->nil', d, thumbs.astype(np.float32), d)[:, :hash_size, :hash_size]
+    coeffs = coeffs.reshape(len(thumbs), -1)
+    # The DC term only carries mean brightness, so it is left out of the median
+    median = np.median(coeffs[:, 1:], axis=1, keepdims=True)
+    return np.packbits(coeffs > median, axis=1)
+
+# Thumbnails and hashes keyed by path, size and mtime so reruns only decode new files
+class HashCache:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as data:
+                for i, path in enumerate(data['paths']):
+                    self.entries[str(path)] = (int(data['sizes'][i]), int(data['mtimes'][i]),
+                                               data['thumbs'][i], data['hashes'][i], bool(data['ok'][i]))
+
+    def compute(self, paths, num_workers=None, chunk_size=256):
+        stats = [os.stat(p) for p in paths]
+        missing = [i for i, (p, st) in enumerate(zip(paths, stats))
+                   if p not in self.entries or self.entries[p][:2] != (st.st_size, st.st_mtime_ns)]
+        if missing:
+            print(f"Decoding {len(missing)} thumbnails")
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+                results = executor.map(_thumbnail_chunk, [[paths[i] for i in chunk] for chunk in chunks])
+                for chunk, (thumbs, ok) in zip(chunks, results):
+                    hashes = phash(thumbs)
+                    for j, i in enumerate(chunk):
+                        self.entries[paths[i]] = (stats[i].st_size, stats[i].st_mtime_ns, thumbs[j], hashes[j], bool(ok[j]))
+            self.save()
+        hashes = np.stack([self.entries[p][3] for p in paths]) if paths else np.zeros((0, 8), np.uint8)
+        ok = np.array([self.entries[p][4] for p in paths], dtype=bool)
+        return hashes, ok
+
+    def save(self):
+        paths = list(self.entries.keys())
+        values = [self.entries[p] for p in paths]
+        tmp_path = self.cache_path + '.partial.npz'
+        np.savez(tmp_path, paths=np.array(paths, dtype=str),
+                 sizes=np.array([v[0] for v in values], dtype=np.int64),
+                 mtimes=np.array([v[1] for v in values], dtype=np.int64),
+                 thumbs=np.stack([v[2] for v in values]), hashes=np.stack([v[3] for v in values]),
+                 ok=np.array([v[4] for v in values], dtype=bool))
+        os.replace(tmp_path, self.cache_path)
+
+def hamming_distances(a, b):
+    if hasattr(np, 'bitwise_count'):
+        x = np.bitwise_xor(a.view('>u8')[:, None, 0], b.view('>u8')[None, :, 0])
+        return np.bitwise_count(x).astype(np.uint8)
+    x = np.bitwise_xor(a[:, None, :], b[None, :, :])
+    return POPCOUNT8[x].sum(axis=2, dtype=np.uint8)
+
+# All pairs (i, j), i < j, within `threshold` bits; rows are processed in blocks so
+# the distance matrix never exceeds roughly block_bytes
+def find_near_duplicates(hashes, threshold=6, block_bytes=256 * 1024 * 1024):
+    hashes = np.ascontiguousarray(hashes, dtype=np.uint8)
+    n = len(hashes)
+    rows_per_block = max(1, block_bytes // max(n * 8, 1))
+    pairs = []
+    for start in range(0, n, rows_per_block):
+        stop = min(start + rows_per_block, n)
+        dist = hamming_distances(hashes[start:stop], hashes[start:])
+        i, j = np.nonzero(dist <= threshold)
+        keep = j > i
+        i, j = i[keep], j[keep]
+        pairs.append(np.stack([i + start, j + start, dist[i, j]], axis=1))
+    if not pairs:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.concatenate(pairs).astype(np.int64)
+
+def connected_groups(n, pairs):
+    parent = np.arange(n)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j, _ in pairs:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return np.array([find(i) for i in range(n)])
+
+# Stratified split that keeps every near-duplicate group inside a single split.
+# Groups are placed largest first into the split furthest below its target share of
+# the group's majority label.
+def group_aware_split(labels, groups, test_size=0.2, val_size=0.1, random_state=42):
+    labels = np.asarray(labels)
+    groups = np.asarray(groups)
+    fractions = np.array([1 - test_size - val_size, val_size, test_size])
+    num_labels = labels.max() + 1 if len(labels) else 0
+    label_totals = np.bincount(labels, minlength=num_labels)
+    counts = np.zeros((3, num_labels))
+    _, inverse = np.unique(groups, return_inverse=True)
+    members = np.split(np.argsort(inverse, kind='stable'), np.cumsum(np.bincount(inverse))[:-1])
+    rng = np.random.RandomState(random_state)
+    shuffled = rng.permutation(len(members))
+    order = shuffled[np.argsort([-len(members[g]) for g in shuffled], kind='stable')]
+    assignment = np.empty(len(labels), dtype=np.int64)
+    for g in order:
+        idx = members[g]
+        majority = np.bincount(labels[idx], minlength=num_labels).argmax()
+        deficit = fractions * label_totals[majority] - counts[:, majority]
+        split = int(np.argmax(deficit))
+        assignment[idx] = split
+        np.add.at(counts[split], labels[idx], 1)
+    return [np.flatnonzero(assignment == s) for s in range(3)]
+
+# One class_to_idx for every split: the sorted union of the class folders of the
+# directory splits. CSV splits already carry class_id and are taken as-is.
+def shared_class_to_idx(sources):
+    classes = set()
+    for source in sources:
+        if not source.lower().endswith('.csv'):
+            with os.scandir(source) as it:
+                classes.update(entry.name for entry in it if entry.is_dir() and not entry.name.startswith('.'))
+    return {cls_name: i for i, cls_name in enumerate(sorted(classes))}
+
+def load_split(source, class_to_idx):
+    if source.lower().endswith('.csv'):
+        import pandas as pd
+        df = pd.read_csv(source)
+        return list(df['path']), list(df['class_id'])
+    samples = build_manifest(source).samples(class_to_idx)
+    return [p for p, _ in samples], [label for _, label in samples]
+
+def check_leakage(splits, threshold=6, cache_path='phash_cache.npz', num_workers=None, report_path='leaks.csv'):
+    paths, labels, split_ids = [], [], []
+    names = list(splits.keys())
+    class_to_idx = shared_class_to_idx(splits.values())
+    for s, name in enumerate(names):
+        split_paths, split_labels = load_split(splits[name], class_to_idx)
+        paths += split_paths
+        labels += split_labels
+        split_ids += [s] * len(split_paths)
+    split_ids = np.array(split_ids)
+    hashes, ok = HashCache(cache_path).compute(paths, num_workers=num_workers)
+    valid = np.flatnonzero(ok)
+    pairs = find_near_duplicates(hashes[valid], threshold=threshold)
+    if len(pairs):
+        pairs[:, 0] = valid[pairs[:, 0]]
+        pairs[:, 1] = valid[pairs[:, 1]]
+    cross = pairs[split_ids[pairs[:, 0]] != split_ids[pairs[:, 1]]] if len(pairs) else pairs
+
+    with open(report_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path_a', 'split_a', 'path_b', 'split_b', 'distance'])
+        for i, j, d in cross:
+            writer.writerow([paths[i], names[split_ids[i]], paths[j], names[split_ids[j]], int(d)])
+    print(f"{len(paths)} images, {len(pairs)} near-duplicate pairs (<= {threshold} bits), "
+          f"{len(cross)} across splits -> {report_path}")
+    for a in range(len(names)):
+        for b in range(a + 1, len(names)):
+            n = int(np.sum(((split_ids[cross[:, 0]] == a) & (split_ids[cross[:, 1]] == b)) |
+                           ((split_ids[cross[:, 0]] == b) & (split_ids[cross[:, 1]] == a)))) if len(cross) else 0
+            print(f"  {names[a]} <-> {names[b]}: {n} leaked pairs")
+    return paths, np.array(labels), pairs, cross
+
+def write_group_split(paths, labels, pairs, out_prefix, test_size=0.2, val_size=0.1):
+    groups = connected_groups(len(paths), pairs)
+    split_indices = group_aware_split(labels, groups, test_size=test_size, val_size=val_size)
+    for name, idx in zip(['train', 'val', 'test'], split_indices):
+        out_path = f"{out_prefix}_{name}.csv"
+        with open(out_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['path', 'class_id', 'group'])
+            for i in idx:
+                writer.writerow([paths[i], int(labels[i]), int(groups[i])])
+        print(f"Wrote {len(idx)} images to {out_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Find near-duplicate images leaking across dataset splits")
+    parser.add_argument('--split', action='append', required=True, metavar='NAME=PATH',
+                        help="Class-folder directory or CSV with path/class_id columns; repeat per split")
+    parser.add_argument('--threshold', type=int, default=6, help="Max Hamming distance (of 64 bits) for a near duplicate")
+    parser.add_argument('--cache', default='phash_cache.npz')
+    parser.add_argument('--report', default='leaks.csv')
+    parser.add_argument('--num-workers', type=int, default=None)
+    parser.add_argument('--group-split', metavar='PREFIX', help="Also write a group-aware PREFIX_{train,val,test}.csv split")
+    parser.add_argument('--test-size', type=float, default=0.2)
+    parser.add_argument('--val-size', type=float, default=0.1)
+    args = parser.parse_args()
+    splits = dict(spec.split('=', 1) for spec in args.split)
+    paths, labels, pairs, _ = check_leakage(splits, threshold=args.threshold, cache_path=args.cache,
+                                            num_workers=args.num_workers, report_path=args.report)
+    if args.group_split:
+        write_group_split(paths, labels, pairs, args.group_split, test_size=args.test_size, val_size=args.val_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+from model_utils import (device, get_transforms, get_model_architecture, enable_single_channel_input,
+                         normalization_from_info, checkpoint_paths, load_trained_model, save_model_info)
+from medical_datasets import MedicalImageDataset
+from evaluation import collect_logits, logits_cache_key
+from training_controller import TrainingController, run_epoch
+
+# Knowledge distillation from best_<type>_model.pth (DenseNet121 teacher) into a small
+# CPU-friendly student. Teacher logits for the training set are computed once on the
+# un-augmented images and cached, so the teacher never runs inside the epoch loop.
+#
+#   python distillation.py --model-type chest --student mobilenet_v3_large --out-dir model_checkpoints_student
+
+STUDENTS = ["mobilenet_v3_small", "mobilenet_v3_large", "resnet18"]
+
+# Returns the sample index with each item so cached teacher logits can be looked up
+class IndexedDataset(Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, label = self.dataset[idx]
+        return image, label, idx
+
+# Keyed on the teacher checkpoint, the sample list and the input pipeline, like evaluation.py's logit caches
+def cache_teacher_logits(teacher, dataset, num_classes, cache_path, checkpoint_path, normalization, single_channel,
+                         batch_size=64, num_workers=4):
+    key = logits_cache_key(checkpoint_path, dataset, normalization, single_channel)
+    meta_path = cache_path + ".json"
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            if json.load(f).get('key') == key:
+                print(f"Using cached teacher logits from {cache_path}")
+                return torch.from_numpy(np.load(cache_path))
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    logits, _ = collect_logits(teacher, loader, num_classes, desc='Teacher logits')
+    np.save(cache_path, logits.numpy())
+    with open(meta_path, 'w') as f:
+        json.dump({'key': key}, f)
+    return logits
+
+# Hinton et al. soft-target loss blended with the usual hard-label cross entropy
+def distillation_loss(student_logits, teacher_logits, labels, temperature=4.0, alpha=0.7):
+    soft = F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                    F.softmax(teacher_logits / temperature, dim=1),
+                    reduction='batchmean') * temperature * temperature
+    hard = F.cross_entropy(student_logits, labels)
+    return alpha * soft + (1 - alpha) * hard
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+def state_dict_megabytes(model):
+    return sum(t.numel() * t.element_size() for t in model.state_dict().values()) / (1024 * 1024)
+
+# Median single-image CPU latency in milliseconds
+def measure_latency(model, runs=50, warmup=5, batch_size=1, image_size=224):
+    model = model.to('cpu').eval()
+    inputs = torch.randn(batch_size, 3, image_size, image_size)
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            model(inputs)
+            if i >= warmup:
+                timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+def comparison_table(rows):
+    header = ['model', 'architecture', 'test_acc', 'params_m', 'size_mb', 'cpu_latency_ms']
+    lines = ['  '.join(f"{h:>14}" for h in header)]
+    for row in rows:
+        lines.append('  '.join(f"{row[h]:>14.4f}" if isinstance(row[h], float) else f"{str(row[h]):>14}" for h in header))
+    return '\n'.join(lines)
+
+def distill(data_dir, model_type, student_arch='mobilenet_v3_large', teacher_dir='model_checkpoints',
+            out_dir='model_checkpoints_student', cache_dir='feature_cache', num_epochs=30, batch_size=32,
+            learning_rate=0.001, temperature=4.0, alpha=0.7, patience=5, num_workers=4):
+    os.makedirs(out_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    teacher, teacher_info = load_trained_model(model_type, teacher_dir)
+    _, teacher_ckpt = checkpoint_paths(model_type, teacher_dir)
+    class_to_idx = teacher_info['class_to_idx']
+    num_classes = teacher_info['num_classes']
+    # The student sees the teacher's inputs, so it inherits the teacher's normalisation and channels
+    normalization = normalization_from_info(teacher_info)
+    single_channel = teacher_info.get('input_channels', 3) == 1
+    transforms_dict = get_transforms(model_type, single_channel=single_channel, normalization=normalization)
+
+    train_dir = os.path.join(data_dir, model_type, 'train')
+    clean_train = MedicalImageDataset(train_dir, transform=transforms_dict['val'], class_to_idx=class_to_idx,
+                                      single_channel=single_channel)
+    teacher_logits = cache_teacher_logits(teacher, clean_train, num_classes,
+                                          os.path.join(cache_dir, f"{model_type}_teacher_logits.npy"),
+                                          teacher_ckpt, normalization, single_channel, num_workers=num_workers)
+    # Same sample order as clean_train, so the index lines up with teacher_logits
+    train_dataset = IndexedDataset(MedicalImageDataset(train_dir, transform=transforms_dict['train'], class_to_idx=class_to_idx,
+                                                       single_channel=single_channel))
+    val_dataset = MedicalImageDataset(os.path.join(data_dir, model_type, 'val'), transform=transforms_dict['val'],
+                                      class_to_idx=class_to_idx, single_channel=single_channel)
+    test_dataset = MedicalImageDataset(os.path.join(data_dir, model_type, 'test'), transform=transforms_dict['val'],
+                                       class_to_idx=class_to_idx, single_channel=single_channel)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True)
+    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+
+    student = get_model_architecture(model_type, num_classes, architecture=student_arch)
+    if single_channel:
+        enable_single_channel_input(student, *normalization)
+    student.to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(student.parameters(), lr=learning_rate, weight_decay=1e-5)
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=3, factor=0.1)
+    controller = TrainingController(scheduler, num_epochs, patience=patience,
+                                    cpu_cores=torch.get_num_threads() + num_workers)
+    _, student_ckpt = checkpoint_paths(model_type, out_dir)
+    best_acc, best_epoch = 0.0, -1
+    for epoch in range(num_epochs):
+        controller.start_epoch()
+        student.train()
+        running_loss, seen = 0.0, 0
+        for inputs, labels, idx in tqdm(train_loader, desc=f'Distill Epoch {epoch+1}/{num_epochs}'):
+            inputs, labels = inputs.to(device), labels.to(device)
+            targets = teacher_logits[idx].to(device)
+            optimizer.zero_grad()
+            loss = distillation_loss(student(inputs), targets, labels, temperature, alpha)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * inputs.size(0)
+            seen += inputs.size(0)
+        val_loss, val_acc, _ = run_epoch(student, val_loader, criterion)
+        print(f'Train KD Loss: {running_loss / max(seen, 1):.4f}  Val Loss: {val_loss:.4f} Acc: {val_acc:.4f}')
+        if val_acc > best_acc or best_epoch < 0:
+            best_acc, best_epoch = val_acc, epoch
+            torch.save({
+                'model_state_dict': student.state_dict(),
+                'acc': best_acc,
+                'epoch': epoch,
+                'class_to_idx': class_to_idx
+            }, student_ckpt)
+        if controller.end_epoch(val_loss):
+            print(f'Early stopping after epoch {epoch+1}')
+            break
+    controller.report(os.path.join(out_dir, f'{model_type}_training_summary.json'))
+
+    if best_epoch < 0 or not os.path.exists(student_ckpt):
+        raise RuntimeError(f"No student checkpoint at {student_ckpt}: no distillation epoch completed")
+    student.load_state_dict(torch.load(student_ckpt, map_location=device)['model_state_dict'])
+    model_info = {
+        'model_type': model_type,
+        'num_classes': num_classes,
+        'classes': teacher_info['classes'],
+        'class_to_idx': class_to_idx,
+        'best_acc': best_acc,
+        'best_epoch': best_epoch,
+        'architecture': student_arch,
+        'distilled_from': teacher_ckpt,
+        'distillation': {'temperature': temperature, 'alpha': alpha},
+        'normalization': {'mean': list(normalization[0]), 'std': list(normalization[1])},
+        'input_channels': 1 if single_channel else 3,
+    }
+    save_model_info(model_info, model_type, out_dir)
+
+    rows = []
+    for name, model, arch in [('teacher', teacher, teacher_info.get('architecture', 'densenet121')),
+                              ('student', student, student_arch)]:
+        logits, labels = collect_logits(model.to(device), test_loader, num_classes, desc=f'Testing {name}')
+        rows.append({
+            'model': name,
+            'architecture': arch,
+            'test_acc': float((logits.argmax(1) == labels).float().mean().item()),
+            'params_m': count_parameters(model) / 1e6,
+            'size_mb': state_dict_megabytes(model),
+            'cpu_latency_ms': measure_latency(model),
+        })
+    print(comparison_table(rows))
+    with open(os.path.join(out_dir, f'{model_type}_distillation_report.json'), 'w') as f:
+        json.dump(rows, f, indent=2)
+    return model_info, rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Distil best_<type>_model.pth into a small CPU-friendly student")
+    parser.add_argument('--model-type', required=True, choices=['chest', 'brain', 'scan_type'])
+    parser.add_argument('--student', default='mobilenet_v3_large', choices=STUDENTS)
+    parser.add_argument('--data-dir', default='medical_images')
+    parser.add_argument('--teacher-dir', default='model_checkpoints')
+    parser.add_argument('--out-dir', default='model_checkpoints_student')
+    parser.add_argument('--cache-dir', default='feature_cache')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.7)
+    parser.add_argument('--patience', type=int, default=5)
+    parser.add_argument('--num-workers', type=int, default=4)
+    args = parser.parse_args()
+    distill(args.data_dir, args.model_type, student_arch=args.student, teacher_dir=args.teacher_dir,
+            out_dir=args.out_dir, cache_dir=args.cache_dir, num_epochs=args.epochs, batch_size=args.batch_size,
+            learning_rate=args.lr, temperature=args.temperature, alpha=args.alpha, patience=args.patience,
+            num_workers=args.num_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+import os
+import json
+import math
+import time
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Streaming input and prediction drift monitoring for app.py. Every /predict updates
+# small mergeable sketches of its model type in O(1) time and memory: t-digests of the
+# per-image intensity mean and std (measured on the 224x224 model input), histograms
+# of the uploaded image width, height and aspect ratio and of the confidence, and
+# predicted-class counts. No pixels are stored. Sketches are kept per time window and
+# each worker saves them every few seconds; /drift merges the recent windows (of every
+# gunicorn worker, through their saved state) and compares them with a reference snapshot built from the
+# training manifest and dataset statistics, reporting PSI, KS and Jensen-Shannon scores.
+#
+#   python drift_monitor.py --model-type chest --train-dir medical_images/chest/train
+
+SIZE_EDGES = [0, 128, 256, 384, 512, 768, 1024, 1536, 2048, 3072, 4096, 8192]
+# Width / height; square, 4:3 and 3:4 scans each fall well inside one bin
+ASPECT_EDGES = [0.0, 0.5, 0.67, 0.74, 0.8, 0.9, 0.98, 1.02, 1.1, 1.25, 1.36, 1.5, 2.0, 4.0]
+CONFIDENCE_EDGES = np.linspace(0.0, 1.0, 21).tolist()
+PSI_WARNING, PSI_DRIFT = 0.1, 0.25
+MIN_OBSERVATIONS = 50
+
+# Merging t-digest (Dunning): values are buffered and folded into at most ~compression
+# centroids whose size is bounded by the k1 scale function, so the tails stay precise
+class TDigest:
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.count = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+
+    def update(self, value, weight=1.0):
+        value = float(value)
+        self._buffer.append((value, weight))
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) >= 5 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        self._buffer.extend(zip(other.means.tolist(), other.weights.tolist()))
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _k_inverse(self, k):
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        values, weights = zip(*self._buffer)
+        means = np.concatenate([self.means, values])
+        weights = np.concatenate([self.weights, weights])
+        self._buffer = []
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order].tolist(), weights[order].tolist()
+        total = sum(weights)
+        merged_means, merged_weights = [], []
+        cur_mean, cur_weight, so_far = means[0], weights[0], 0.0
+        q_limit = self._k_inverse(self._k(0.0) + 1)
+        for mean, weight in zip(means[1:], weights[1:]):
+            if (so_far + cur_weight + weight) / total <= q_limit:
+                cur_weight += weight
+                cur_mean += (mean - cur_mean) * weight / cur_weight
+            else:
+                merged_means.append(cur_mean)
+                merged_weights.append(cur_weight)
+                so_far += cur_weight
+                q_limit = self._k_inverse(self._k(so_far / total) + 1)
+                cur_mean, cur_weight = mean, weight
+        merged_means.append(cur_mean)
+        merged_weights.append(cur_weight)
+        self.means, self.weights = np.array(merged_means), np.array(merged_weights)
+
+    # Interpolation knots: (cumulative weight at each centroid's midpoint, mean), with min/max as ends
+    def _knots(self):
+        self._compress()
+        positions = np.cumsum(self.weights) - self.weights / 2
+        return (np.concatenate([[0.0], positions, [self.count]]),
+                np.concatenate([[self.min], self.means, [self.max]]))
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+        positions, values = self._knots()
+        return np.interp(np.asarray(q) * self.count, positions, values)
+
+    # Right-continuous at the maximum, so a constant stream has all its mass at its value
+    def cdf(self, x):
+        if self.count == 0:
+            return math.nan
+        positions, values = self._knots()
+        return np.where(np.asarray(x) >= self.max, 1.0, np.interp(x, values, positions) / self.count)
+
+    def to_dict(self):
+        self._compress()
+        return {'type': 'tdigest', 'compression': self.compression, 'count': self.count,
+                'min': self.min if self.count else None, 'max': self.max if self.count else None,
+                'means': self.means.tolist(), 'weights': self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        digest = cls(d['compression'])
+        digest.means, digest.weights = np.array(d['means'], dtype=float), np.array(d['weights'], dtype=float)
+        digest.count = d['count']
+        digest.min = d['min'] if d['min'] is not None else math.inf
+        digest.max = d['max'] if d['max'] is not None else -math.inf
+        return digest
+
+# Fixed-edge histogram; values outside the edges go to the first or last bin
+class Histogram:
+    def __init__(self, edges):
+        self.edges = list(edges)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def update(self, value):
+        i = int(np.searchsorted(self.edges, value, side='right')) - 1
+        self.counts[min(max(i, 0), len(self.counts) - 1)] += 1
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def to_dict(self):
+        return {'type': 'histogram', 'edges': self.edges, 'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        histogram = cls(d['edges'])
+        histogram.counts = np.array(d['counts'], dtype=np.int64)
+        return histogram
+
+class Counts:
+    def __init__(self):
+        self.counts = {}
+
+    @property
+    def count(self):
+        return sum(self.counts.values())
+
+    def update(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, n in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+        return self
+
+    def to_dict(self):
+        return {'type': 'counts', 'counts': dict(self.counts)}
+
+    @classmethod
+    def from_dict(cls, d):
+        counts = cls()
+        counts.counts = dict(d['counts'])
+        return counts
+
+SKETCH_TYPES = {'tdigest': TDigest, 'histogram': Histogram, 'counts': Counts}
+
+def new_sketches():
+    return {
+        'intensity_mean': TDigest(),
+        'intensity_std': TDigest(),
+        'aspect_ratio': Histogram(ASPECT_EDGES),
+        'width': Histogram(SIZE_EDGES),
+        'height': Histogram(SIZE_EDGES),
+        'confidence': Histogram(CONFIDENCE_EDGES),
+        'predicted_class': Counts(),
+    }
+
+def sketches_to_dict(sketches):
+    return {name: sketch.to_dict() for name, sketch in sketches.items()}
+
+# Saved sketches must have exactly the names and types of new_sketches()
+def sketches_from_dict(d):
+    expected = {name: sketch.to_dict()['type'] for name, sketch in new_sketches().items()}
+    for name, s in d.items():
+        if s.get('type') != expected.get(name):
+            raise TypeError(f"Drift sketch '{name}' has type {s.get('type')}, expected {expected.get(name)}")
+    return {name: SKETCH_TYPES[s['type']].from_dict(s) for name, s in d.items()}
+
+def merge_sketches(parts):
+    merged = new_sketches()
+    for part in parts:
+        for name, sketch in part.items():
+            merged[name].merge(sketch)
+    return merged
+
+# Per-image intensity mean and std of a model input tensor, in [0, 1] pixel units.
+# RGB inputs are un-normalised with the model's (mean, std); 1-channel inputs are raw.
+def input_intensity(input_tensor, normalization=None):
+    x = input_tensor.detach().float().reshape(input_tensor.shape[-3], -1)
+    channel_mean, channel_var = x.mean(dim=1), x.var(dim=1, unbiased=False)
+    if normalization is not None and x.shape[0] > 1:
+        mean = channel_mean.new_tensor(normalization[0])
+        std = channel_mean.new_tensor(normalization[1])
+        channel_mean, channel_var = channel_mean * std + mean, channel_var * std ** 2
+    overall = channel_mean.mean()
+    return float(overall), float(((channel_var + (channel_mean - overall) ** 2).mean()).sqrt())
+
+# Scores between a reference and a current distribution
+def _psi(expected, actual, eps=1e-4):
+    expected = np.clip(np.asarray(expected, dtype=float), eps, None)
+    actual = np.clip(np.asarray(actual, dtype=float), eps, None)
+    expected, actual = expected / expected.sum(), actual / actual.sum()
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+def _js(p, q):
+    p, q = np.asarray(p, dtype=float), np.asarray(q, dtype=float)
+    p, q = p / max(p.sum(), 1e-12), q / max(q.sum(), 1e-12)
+    m = (p + q) / 2
+    kl = lambda a, b: float(np.sum(np.where(a > 0, a * np.log(np.where(a > 0, a, 1) / np.where(b > 0, b, 1)), 0)))
+    return (kl(p, m) + kl(q, m)) / 2 / math.log(2)
+
+def _status(psi, observations):
+    if observations < MIN_OBSERVATIONS:
+        return 'insufficient_data'
+    return 'drift' if psi >= PSI_DRIFT else 'warning' if psi >= PSI_WARNING else 'ok'
+
+def compare_sketch(reference, current):
+    n = current.count
+    if isinstance(reference, TDigest):
+        if reference.count == 0 or n == 0:
+            return {'observations': n, 'status': 'insufficient_data'}
+        qs = np.linspace(0.01, 0.99, 99)
+        points = np.concatenate([reference.quantile(qs), current.quantile(qs)])
+        ks = float(np.max(np.abs(reference.cdf(points) - current.cdf(points))))
+        # PSI over the reference deciles. Tied deciles (point masses, constant inputs) are
+        # merged and the expected mass of each bin is read from the reference itself.
+        edges = np.unique(reference.quantile(np.linspace(0.1, 0.9, 9)))
+        expected = np.diff(np.concatenate([[0.0], reference.cdf(edges), [1.0]]))
+        actual = np.diff(np.concatenate([[0.0], current.cdf(edges), [1.0]]))
+        psi = _psi(expected, actual)
+        return {'observations': n, 'psi': psi, 'ks': ks, 'status': _status(psi, n),
+                'reference_median': float(reference.quantile(0.5)), 'current_median': float(current.quantile(0.5))}
+    if isinstance(reference, Histogram):
+        if reference.count == 0 or n == 0:
+            return {'observations': n, 'status': 'insufficient_data'}
+        psi = _psi(reference.counts, current.counts)
+        return {'observations': n, 'psi': psi, 'js': _js(reference.counts, current.counts), 'status': _status(psi, n)}
+    keys = sorted(set(reference.counts) | set(current.counts))
+    if reference.count == 0 or n == 0:
+        return {'observations': n, 'status': 'insufficient_data'}
+    expected = [reference.counts.get(k, 0) for k in keys]
+    actual = [current.counts.get(k, 0) for k in keys]
+    psi = _psi(expected, actual)
+    return {'observations': n, 'psi': psi, 'js': _js(expected, actual), 'status': _status(psi, n),
+            'reference_share': {k: e / sum(expected) for k, e in zip(keys, expected)},
+            'current_share': {k: a / sum(actual) for k, a in zip(keys, actual)}}
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# State is saved every save_every observations or save_seconds, whichever comes first,
+# so /drift in one worker sees the others' recent traffic
+class DriftMonitor:
+    def __init__(self, model_type, state_dir='drift_state', window_seconds=3600, keep_windows=24,
+                 save_every=100, save_seconds=10.0):
+        self.model_type = model_type
+        self.state_dir = state_dir
+        self.window_seconds = window_seconds
+        self.windows = deque(maxlen=keep_windows)
+        self.save_every = save_every
+        self.save_seconds = save_seconds
+        self._unsaved = 0
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_path = os.path.join(state_dir, f"{model_type}.{os.getpid()}.json")
+        self.reference_path = os.path.join(state_dir, f"{model_type}.reference.json")
+
+    def _current_window(self, now):
+        start = now - now % self.window_seconds
+        if not self.windows or self.windows[-1][0] != start:
+            if self.windows:
+                self.save()
+            self.windows.append((start, new_sketches()))
+        return self.windows[-1][1]
+
+    def observe(self, image_size, intensity_mean, intensity_std, predicted_class, confidence):
+        width, height = image_size
+        with self._lock:
+            sketches = self._current_window(time.time())
+            sketches['intensity_mean'].update(intensity_mean)
+            sketches['intensity_std'].update(intensity_std)
+            sketches['aspect_ratio'].update(width / max(height, 1))
+            sketches['width'].update(width)
+            sketches['height'].update(height)
+            sketches['confidence'].update(confidence)
+            sketches['predicted_class'].update(predicted_class)
+            self._unsaved += 1
+            if self._unsaved >= self.save_every or time.monotonic() - self._last_save >= self.save_seconds:
+                self.save()
+
+    def save(self):
+        self._unsaved = 0
+        self._last_save = time.monotonic()
+        state = {'pid': os.getpid(), 'windows': [[start, sketches_to_dict(s)] for start, s in self.windows]}
+        tmp_path = self.state_path + '.partial'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    # Windows that started within the last `windows` window lengths, from this process
+    # and the saved state of the others. State of exited workers is kept until its
+    # newest window is older than keep_windows, then deleted.
+    def recent(self, windows=1):
+        with self._lock:
+            self.save()
+        now = time.time()
+        since = now - windows * self.window_seconds
+        expired = now - self.windows.maxlen * self.window_seconds
+        parts = []
+        prefix = f"{self.model_type}."
+        for name in os.listdir(self.state_dir):
+            if not (name.startswith(prefix) and name.endswith('.json')) or name.endswith('.reference.json'):
+                continue
+            path = os.path.join(self.state_dir, name)
+            try:
+                with open(path, 'r') as f:
+                    state = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            newest = max((start for start, _ in state['windows']), default=-math.inf)
+            if state.get('pid') != os.getpid() and newest + self.window_seconds <= expired \
+                    and not _pid_alive(state.get('pid', 0)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            parts.extend(sketches_from_dict(s) for start, s in state['windows'] if start + self.window_seconds > since)
+        return merge_sketches(parts)
+
+    def reference(self):
+        if not os.path.exists(self.reference_path):
+            return None
+        with open(self.reference_path, 'r') as f:
+            return json.load(f)
+
+    def report(self, windows=1):
+        reference = self.reference()
+        if reference is None:
+            return {'model_type': self.model_type, 'error': f"No reference snapshot at {self.reference_path}"}
+        ref_sketches = sketches_from_dict(reference['sketches'])
+        current = self.recent(windows)
+        features = {name: compare_sketch(ref_sketches[name], current[name]) for name in ref_sketches}
+        statuses = [f['status'] for f in features.values()]
+        overall = 'drift' if 'drift' in statuses else 'warning' if 'warning' in statuses else \
+            'ok' if 'ok' in statuses else 'insufficient_data'
+        return {'model_type': self.model_type, 'status': overall, 'window_seconds': self.window_seconds,
+                'windows': windows, 'reference': {k: v for k, v in reference.items() if k != 'sketches'},
+                'features': features}
+
+def _intensity_chunk(paths, single_channel):
+    from dataset_stats import _image_pixels
+    results = []
+    for path in paths:
+        try:
+            pixels = _image_pixels(path, single_channel)
+        except Exception as e:
+            print(f"Error reading {path}: {e}")
+            continue
+        channel_mean = pixels.mean(axis=0, dtype=np.float64)
+        overall = channel_mean.mean()
+        variance = (pixels.var(axis=0, dtype=np.float64) + (channel_mean - overall) ** 2).mean()
+        results.append((float(overall), float(np.sqrt(variance))))
+    return results
+
+# Reference snapshot of a training split: image sizes and class prior from its manifest,
+# per-image intensity from a parallel pass at model resolution, pixel mean/std from
+# dataset_stats. The confidence sketch stays empty (no model run), so it is not scored.
+def build_reference(model_type, train_dir, state_dir='drift_state', single_channel=False, num_workers=None,
+                    chunk_size=64):
+    from manifest import build_manifest
+    from dataset_stats import compute_split_stats
+    manifest = build_manifest(train_dir)
+    sketches = new_sketches()
+    ok = manifest.ok
+    for width, height in zip(manifest.widths[ok].tolist(), manifest.heights[ok].tolist()):
+        sketches['width'].update(width)
+        sketches['height'].update(height)
+        sketches['aspect_ratio'].update(width / max(height, 1))
+    # Class folder names are the served class names (ImageFolder class_to_idx)
+    sketches['predicted_class'].counts.update(manifest.class_counts())
+    paths = [path for path, _ in manifest.samples()]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_intensity_chunk, paths[i:i + chunk_size], single_channel)
+                   for i in range(0, len(paths), chunk_size)]
+        for future in futures:
+            for mean, std in future.result():
+                sketches['intensity_mean'].update(mean)
+                sketches['intensity_std'].update(std)
+    stats = compute_split_stats(train_dir, single_channel=single_channel, num_workers=num_workers)
+    reference = {'model_type': model_type, 'train_dir': train_dir, 'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+                 'images': len(paths), 'single_channel': single_channel,
+                 'pixel_mean': stats['mean'], 'pixel_std': stats['std'], 'sketches': sketches_to_dict(sketches)}
+    os.makedirs(state_dir, exist_ok=True)
+    reference_path = os.path.join(state_dir, f"{model_type}.reference.json")
+    with open(reference_path, 'w') as f:
+        json.dump(reference, f)
+    print(f"Drift reference for {model_type}: {len(paths)} images from {train_dir} -> {reference_path}")
+    return reference
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the drift reference snapshot of a model type from its training split")
+    parser.add_argument('--model-type', required=True, choices=['chest', 'brain', 'scan_type'])
+    parser.add_argument('--train-dir', required=True, help="Training split with class folders (e.g. medical_images/chest/train)")
+    parser.add_argument('--state-dir', default=os.environ.get('DRIFT_DIR', 'drift_state'))
+    parser.add_argument('--single-channel', action='store_true', help="Reference for a single-channel (image_io) model")
+    parser.add_argument('--num-workers', type=int, default=None)
+    args = parser.parse_args()
+    build_reference(args.model_type, args.train_dir, args.state_dir, args.single_channel, args.num_workers)
+
+if __name__ == "__main__":
+    main()
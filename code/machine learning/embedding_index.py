@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import array
+import argparse
+import tempfile
+import threading
+import numpy as np
+
+# Similar-case retrieval over the pooled penultimate DenseNet features (1024-d).
+# EmbeddingStore appends one L2-normalised float16 vector per analysed scan to a
+# memory-mapped file, with its prediction in a metadata JSONL. IVFIndex is an in-process
+# inverted-file index: k-means centroids over a sample of the store, one inverted list
+# per centroid, and queries that scan only the nprobe closest lists. New scans go
+# straight into their list; when the store has doubled since the centroids were
+# trained they are retrained in a background thread and swapped in. Below min_train
+# vectors every query is an exact scan.
+#
+#   python embedding_index.py --vectors 1000000 --nprobe 1 4 8 16 32
+
+DIM = 1024
+
+class EmbeddingStore:
+    def __init__(self, root, dim=DIM, initial_capacity=1024):
+        self.root = root
+        self.dim = dim
+        os.makedirs(root, exist_ok=True)
+        self.vectors_path = os.path.join(root, 'embeddings.f16')
+        self.metadata_path = os.path.join(root, 'metadata.jsonl')
+        self.metadata = []
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, 'r') as f:
+                # A torn last line (crash mid-append) is dropped with its vector
+                for line in f:
+                    try:
+                        self.metadata.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        self.count = len(self.metadata)
+        self.row_of = {m['scan_id']: i for i, m in enumerate(self.metadata)}
+        self._open(max(initial_capacity, self.count))
+        self._metadata_file = open(self.metadata_path, 'a')
+        self._lock = threading.Lock()
+
+    def _open(self, capacity):
+        size = capacity * self.dim * 2
+        with open(self.vectors_path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.capacity = os.path.getsize(self.vectors_path) // (self.dim * 2)
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r+', shape=(self.capacity, self.dim))
+
+    # Returns the row of the new vector; capacity doubles when the file is full
+    def append(self, vector, metadata):
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        with self._lock:
+            if self.count == self.capacity:
+                self.vectors.flush()
+                self._open(self.capacity * 2)
+            row = self.count
+            self.vectors[row] = vector
+            self._metadata_file.write(json.dumps(metadata) + '\n')
+            self._metadata_file.flush()
+            self.metadata.append(metadata)
+            self.row_of[metadata['scan_id']] = row
+            self.count += 1
+        return row
+
+    def get(self, rows):
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def flush(self):
+        self.vectors.flush()
+
+def _normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+def _top_k(scores, ids, k):
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[part], ids[part]
+    order = np.argsort(-scores)
+    return ids[order], scores[order]
+
+# Exact cosine search over the first n rows, in chunks so the float32 copy stays small
+def brute_force(store, query, k=10, n=None, chunk=65536):
+    n = store.count if n is None else n
+    query = _normalize(query)
+    best_ids, best_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    for start in range(0, n, chunk):
+        scores = store.get(slice(start, min(n, start + chunk))) @ query
+        ids = np.arange(start, start + len(scores))
+        best_ids, best_scores = _top_k(np.concatenate([best_scores, scores]), np.concatenate([best_ids, ids]), k)
+    return best_ids, best_scores
+
+# Spherical k-means (cosine) on the rows of `sample`
+def train_centroids(sample, nlist, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        counts = np.bincount(assign, minlength=nlist)
+        nonempty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums = np.zeros_like(centroids)
+        sums[nonempty] = np.add.reduceat(sample[np.argsort(assign, kind='stable')], starts, axis=0)
+        empty = ~nonempty
+        # Empty clusters restart from random samples
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+class IVFIndex:
+    def __init__(self, store, nprobe=8, min_train=4096, sample_per_list=32, background=True):
+        self.store = store
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.sample_per_list = sample_per_list
+        self.background = background
+        self.centroids = None
+        self.lists = []
+        self.indexed = 0
+        self.trained_on = 0
+        self._lock = threading.Lock()
+        self._training = False
+        self.centroids_path = os.path.join(store.root, 'ivf_centroids.npy')
+        if os.path.exists(self.centroids_path):
+            self._install(np.load(self.centroids_path), store.count)
+        self.sync()
+
+    @staticmethod
+    def nlist_for(n):
+        return int(np.clip(np.sqrt(n), 16, 4096))
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    # Inverted lists for rows [0, upto) under new centroids, built chunk by chunk
+    def _build_lists(self, centroids, upto, chunk=65536):
+        assign = np.empty(upto, dtype=np.int64)
+        for start in range(0, upto, chunk):
+            end = min(upto, start + chunk)
+            assign[start:end] = np.argmax(self.store.get(slice(start, end)) @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable')
+        lists = []
+        for rows in np.split(order, np.cumsum(np.bincount(assign, minlength=len(centroids)))[:-1]):
+            inverted = array.array('q')
+            inverted.frombytes(rows.astype(np.int64).tobytes())
+            lists.append(inverted)
+        return lists
+
+    def _install(self, centroids, upto):
+        lists = self._build_lists(centroids, upto)
+        with self._lock:
+            self.centroids, self.lists, self.trained_on = centroids, lists, upto
+            self.indexed = upto
+        self._add_pending()
+
+    def retrain(self):
+        n = self.store.count
+        nlist = self.nlist_for(n)
+        rng = np.random.default_rng(n)
+        sample_rows = np.sort(rng.choice(n, min(n, nlist * self.sample_per_list), replace=False))
+        centroids = train_centroids(self.store.get(sample_rows), nlist)
+        np.save(self.centroids_path, centroids)
+        self._install(centroids, n)
+
+    def _retrain_async(self):
+        def run():
+            try:
+                self.retrain()
+            finally:
+                self._training = False
+        self._training = True
+        threading.Thread(target=run, daemon=True).start()
+
+    def _add_pending(self):
+        with self._lock:
+            start, end = self.indexed, self.store.count
+            if self.centroids is None or start >= end:
+                return
+            for row, c in zip(range(start, end), self._assign(self.store.get(slice(start, end)))):
+                self.lists[c].append(row)
+            self.indexed = end
+
+    # Index rows appended to the store since the last call; (re)train once the store has
+    # grown enough for the current centroids to be unrepresentative
+    def sync(self):
+        n = self.store.count
+        if n >= self.min_train and not self._training and (self.centroids is None or n >= 2 * self.trained_on):
+            if self.background and self.centroids is not None:
+                self._retrain_async()
+            else:
+                self.retrain()
+        self._add_pending()
+
+    def search(self, query, k=10, nprobe=None):
+        query = _normalize(query)
+        with self._lock:
+            if self.centroids is None:
+                centroids = None
+            else:
+                probes = np.argsort(-(self.centroids @ query))[:nprobe or self.nprobe]
+                # Copied under the lock: an array.array can't grow while a buffer view of it exists
+                candidates = np.concatenate([np.frombuffer(self.lists[c], dtype=np.int64) for c in probes] +
+                                            [np.arange(self.indexed, self.store.count)])
+                centroids = self.centroids
+        if centroids is None:
+            return brute_force(self.store, query, k)
+        if len(candidates) == 0:
+            return candidates, np.empty(0, dtype=np.float32)
+        candidates.sort()
+        scores = self.store.get(candidates) @ query
+        return _top_k(scores, candidates, k)
+
+# Store plus index for one model type, as used by app.py. Once max_scans vectors are
+# stored, add() stores nothing more and returns None.
+class ScanIndex:
+    def __init__(self, root, dim=DIM, nprobe=8, max_scans=None):
+        self.store = EmbeddingStore(root, dim=dim)
+        self.index = IVFIndex(self.store, nprobe=nprobe)
+        self.max_scans = max_scans
+
+    def add(self, scan_id, vector, metadata):
+        if self.max_scans is not None and self.store.count >= self.max_scans:
+            return None
+        row = self.store.append(vector, {'scan_id': scan_id, **metadata})
+        self.index.sync()
+        return row
+
+    # Top-k stored scans with their metadata; a re-analysed scan_id only shows its newest entry
+    def similar(self, vector, k=10, exclude=None, nprobe=None):
+        rows, scores = self.index.search(vector, k * 2 + 1, nprobe=nprobe)
+        results, seen = [], {exclude}
+        for row, score in zip(rows.tolist(), scores.tolist()):
+            metadata = self.store.metadata[row]
+            if metadata['scan_id'] in seen or self.store.row_of.get(metadata['scan_id']) != row:
+                continue
+            seen.add(metadata['scan_id'])
+            results.append({**metadata, 'similarity': score})
+            if len(results) == k:
+                break
+        return results
+
+    def similar_to(self, scan_id, k=10, nprobe=None):
+        row = self.store.row_of.get(scan_id)
+        if row is None:
+            raise KeyError(scan_id)
+        return self.similar(self.store.get(row), k, exclude=scan_id, nprobe=nprobe)
+
+# Clustered synthetic vectors, roughly like features of a few scan types and findings.
+# The cluster centres are fixed, so queries (another seed) come from the same distribution.
+def synthetic_vectors(n, dim=DIM, clusters=64, seed=0, chunk=65536):
+    centers = _normalize(np.random.default_rng(12345).standard_normal((clusters, dim)))
+    rng = np.random.default_rng(seed)
+    for start in range(0, n, chunk):
+        size = min(chunk, n - start)
+        yield _normalize(centers[rng.integers(0, clusters, size)] + rng.standard_normal((size, dim)) / np.sqrt(dim))
+
+# Recall@k and latency of IVF search against exact search, per nprobe
+def bench(n=200000, dim=DIM, k=10, nprobes=(1, 4, 8, 16, 32), queries=100, root=None):
+    root = root or tempfile.mkdtemp(prefix='embedding_bench_')
+    store = EmbeddingStore(root, dim=dim, initial_capacity=n)
+    start = time.perf_counter()
+    for chunk in synthetic_vectors(n, dim):
+        rows = slice(store.count, store.count + len(chunk))
+        store.vectors[rows] = chunk
+        store.count += len(chunk)
+    store.flush()
+    fill_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index = IVFIndex(store, background=False)
+    build_seconds = time.perf_counter() - start
+    query_set = next(synthetic_vectors(queries, dim, seed=1))
+
+    exact, exact_ms = [], []
+    for q in query_set:
+        t0 = time.perf_counter()
+        exact.append(set(brute_force(store, q, k)[0].tolist()))
+        exact_ms.append((time.perf_counter() - t0) * 1000)
+    results = {'vectors': n, 'dim': dim, 'k': k, 'nlist': len(index.centroids), 'fill_seconds': fill_seconds,
+               'build_seconds': build_seconds, 'brute_force_p50_ms': float(np.percentile(exact_ms, 50)), 'ivf': {}}
+    for nprobe in nprobes:
+        timings, recall = [], []
+        for q, truth in zip(query_set, exact):
+            t0 = time.perf_counter()
+            ids, _ = index.search(q, k, nprobe=nprobe)
+            timings.append((time.perf_counter() - t0) * 1000)
+            recall.append(len(truth & set(ids.tolist())) / k)
+        results['ivf'][str(nprobe)] = {'recall_at_k': float(np.mean(recall)), 'p50_ms': float(np.percentile(timings, 50)),
+                                       'p99_ms': float(np.percentile(timings, 99))}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall-vs-latency benchmark of the IVF embedding index")
+    parser.add_argument('--vectors', type=int, default=200000)
+    parser.add_argument('--dim', type=int, default=DIM)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nprobe', nargs='+', type=int, default=[1, 4, 8, 16, 32])
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--root', default=None, help="Store directory (default: a temporary one)")
+    parser.add_argument('--out', default=None, help="Write the results JSON here")
+    args = parser.parse_args()
+    results = bench(args.vectors, args.dim, args.k, tuple(args.nprobe), args.queries, args.root)
+    print(f"{results['vectors']} vectors, {results['nlist']} lists (built in {results['build_seconds']:.1f}s); "
+          f"brute force p50 {results['brute_force_p50_ms']:.1f} ms")
+    for nprobe, r in results['ivf'].items():
+        print(f"  nprobe {nprobe:>3}: recall@{args.k} {r['recall_at_k']:.3f}, p50 {r['p50_ms']:.2f} ms, p99 {r['p99_ms']:.2f} ms")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
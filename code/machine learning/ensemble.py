@@ -0,0 +1,181 @@
+import os
+import copy
+import glob
+import time
+import argparse
+import torch
+from torch.func import stack_module_state, functional_call
+from model_utils import (device, get_model_architecture, enable_single_channel_input, normalization_from_info,
+                         backbone_features, load_model_info)
+
+# Ensemble inference over K checkpoints of one architecture (CV folds, sweep trials,
+# seeds). Strategies:
+#   shared_backbone  every member has the same backbone weights (head-only retrains,
+#                    linear probes): one backbone pass, then all K heads at once
+#   vmap             parameters and buffers stacked with stack_module_state and the
+#                    model run under torch.vmap through functional_call, so each layer
+#                    is one batched kernel over the K members
+#   sequential       the K members one after another
+# vmap is not reliably faster than sequential (on CPU it is often slower), so
+# build_ensemble times both on an example batch and keeps the faster one; sequential
+# is also the fallback when vmap can't trace the model.
+# predict() returns the mean probabilities and how much the members disagree.
+#
+#   python ensemble.py --model-type brain --checkpoints cv_runs/brain/fold_*/best_brain_model.pth
+
+HEAD_PREFIX = 'classifier.'
+
+# Checkpoints served as the model_type ensemble: <checkpoints_dir>/ensemble/<type>/**/best_<type>_model.pth
+def ensemble_checkpoints(model_type, checkpoints_dir):
+    pattern = os.path.join(checkpoints_dir, 'ensemble', model_type, '**', f'best_{model_type}_model.pth')
+    return sorted(glob.glob(pattern, recursive=True))
+
+def load_members(model_type, checkpoint_paths, model_info):
+    class_to_idx = model_info['class_to_idx']
+    members = []
+    for path in checkpoint_paths:
+        checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+        if checkpoint.get('class_to_idx', class_to_idx) != class_to_idx:
+            raise ValueError(f"{path} has a different class map than the served model")
+        model = get_model_architecture(model_type, model_info['num_classes'], pretrained=False,
+                                       architecture=model_info.get('architecture', 'densenet121'))
+        model.load_state_dict(checkpoint['model_state_dict'])
+        members.append(model.to(device).eval())
+    return members
+
+def _same_backbone(members):
+    first = members[0].state_dict()
+    for member in members[1:]:
+        for name, tensor in member.state_dict().items():
+            if not name.startswith(HEAD_PREFIX) and not torch.equal(tensor, first[name]):
+                return False
+    return True
+
+# Entropy along the class dimension, in nats
+def _entropy(probs):
+    return -(probs * torch.log(probs.clamp_min(1e-12))).sum(dim=-1)
+
+class Ensemble:
+    def __init__(self, members, architecture='densenet121', single_channel=False, normalization=None):
+        if not members:
+            raise ValueError("An ensemble needs at least one checkpoint")
+        if single_channel:
+            for member in members:
+                enable_single_channel_input(member, *(normalization or normalization_from_info({})))
+        self.num_members = len(members)
+        # backbone_features knows DenseNet's pooling; other students run per member (vmap or sequential)
+        if architecture == 'densenet121' and _same_backbone(members):
+            self.strategy = 'shared_backbone'
+            self.backbone = members[0]
+            heads = [m.classifier for m in members]
+        else:
+            self.strategy = 'vmap'
+            self.members = members
+            heads = members
+        self.params, self.buffers = stack_module_state(heads)
+        # Stateless copy (hooks included) that only provides the module structure to functional_call
+        self.base = copy.deepcopy(heads[0]).to('meta')
+
+    # Keeps vmap only if it beats running the members one after another on `example`;
+    # timings in ms end up in self.strategy_timings
+    def choose_strategy(self, example, iterations=3):
+        if self.strategy != 'vmap':
+            return self.strategy
+        self.strategy_timings = {}
+        for strategy in ['vmap', 'sequential']:
+            self.strategy = strategy
+            self.member_logits(example)
+            if self.strategy != strategy:
+                # vmap could not trace the model and already fell back
+                break
+            start = time.perf_counter()
+            for _ in range(iterations):
+                self.member_logits(example)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            self.strategy_timings[strategy] = (time.perf_counter() - start) / iterations * 1000
+        if len(self.strategy_timings) == 2:
+            self.strategy = min(self.strategy_timings, key=self.strategy_timings.get)
+        if self.strategy == 'sequential':
+            # The stacked copies of the weights are no longer needed
+            self.params, self.buffers, self.base = None, None, None
+        return self.strategy
+
+    def _call(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    # (B, C, H, W) -> (K, B, num_classes) member logits
+    def member_logits(self, x):
+        with torch.no_grad():
+            if self.strategy == 'shared_backbone':
+                x = backbone_features(self.backbone, x)
+            if self.strategy != 'sequential':
+                try:
+                    return torch.vmap(self._call, in_dims=(0, 0, None))(self.params, self.buffers, x)
+                except RuntimeError as e:
+                    if self.strategy == 'shared_backbone':
+                        raise
+                    print(f"vmap ensemble failed ({e}); evaluating members sequentially")
+                    self.strategy = 'sequential'
+            return torch.stack([m(x) for m in self.members])
+
+    # Mean probabilities plus disagreement statistics per image:
+    #   agreement           fraction of members whose top class is the ensemble's
+    #   probability_std     spread of the member probabilities, per class
+    #   mutual_information  entropy of the mean minus mean member entropy (epistemic part)
+    def predict(self, x, temperature=1.0):
+        member_probs = torch.softmax(self.member_logits(x) / temperature, dim=-1)
+        mean_probs = member_probs.mean(dim=0)
+        ensemble_pred = mean_probs.argmax(dim=-1)
+        member_preds = member_probs.argmax(dim=-1)
+        return {
+            'probabilities': mean_probs,
+            'member_probabilities': member_probs,
+            'member_predictions': member_preds.t(),
+            'agreement': (member_preds == ensemble_pred).float().mean(dim=0),
+            'probability_std': member_probs.std(dim=0, unbiased=False),
+            'predictive_entropy': _entropy(mean_probs),
+            'mutual_information': _entropy(mean_probs) - _entropy(member_probs).mean(dim=0),
+        }
+
+def build_ensemble(model_type, checkpoint_paths, model_info):
+    members = load_members(model_type, checkpoint_paths, model_info)
+    single_channel = model_info.get('input_channels', 3) == 1
+    ensemble = Ensemble(members, architecture=model_info.get('architecture', 'densenet121'),
+                        single_channel=single_channel, normalization=normalization_from_info(model_info))
+    ensemble.choose_strategy(torch.randn(1, 1 if single_channel else 3, 224, 224, device=device))
+    return ensemble
+
+# Ensemble latency against calling the K members one after another
+def bench(ensemble, members, batch_size=1, iterations=20):
+    x = torch.randn(batch_size, 3, 224, 224, device=device)
+    timings = {}
+    with torch.no_grad():
+        for name, run in [('ensemble', lambda: ensemble.member_logits(x)),
+                          ('sequential', lambda: [m(x) for m in members])]:
+            run()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                run()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            timings[name] = (time.perf_counter() - start) / iterations * 1000
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a vectorised checkpoint ensemble against sequential members")
+    parser.add_argument('--model-type', required=True, choices=['chest', 'brain', 'scan_type'])
+    parser.add_argument('--checkpoints-dir', default='model_checkpoints', help="Directory with <type>_model_info.json")
+    parser.add_argument('--checkpoints', nargs='*', help="Member checkpoints (default: the ensemble/ subdirectory)")
+    parser.add_argument('--batch-size', type=int, default=1)
+    args = parser.parse_args()
+    model_info = load_model_info(args.model_type, args.checkpoints_dir)
+    paths = args.checkpoints or ensemble_checkpoints(args.model_type, args.checkpoints_dir)
+    ensemble = build_ensemble(args.model_type, paths, model_info)
+    members = load_members(args.model_type, paths, model_info)
+    timings = bench(ensemble, members, batch_size=args.batch_size)
+    print(f"{len(paths)} members, strategy {ensemble.strategy}: ensemble {timings['ensemble']:.1f} ms, "
+          f"sequential {timings['sequential']:.1f} ms ({timings['sequential'] / timings['ensemble']:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import argparse
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from sklearn.metrics import confusion_matrix, classification_report
+from model_utils import (device, normalization_from_info, checkpoint_paths, load_model_info,
+                         save_model_info, load_trained_model)
+from medical_datasets import MedicalImageDataset
+
+# Batched evaluation: logits are written into preallocated tensors, test-time
+# augmentation views are evaluated as one enlarged batch, and a temperature is fitted
+# on cached validation logits and stored in <type>_model_info.json per TTA mode
+# ('temperatures'); serving runs without TTA and reads the 'none' one ('temperature').
+#
+#   python evaluation.py --model-type chest --tta flip --calibrate
+
+TTA_MODES = ['none', 'flip', 'multicrop']
+
+# normalization: (mean, std) the checkpoint was trained with, see normalization_from_info.
+# Single-channel datasets already yield 1xHxW tensors that the model's input hook normalises.
+def get_eval_transform(tta='none', crop_size=224, multicrop_resize=256, normalization=None, single_channel=False):
+    size = multicrop_resize if tta == 'multicrop' else crop_size
+    if single_channel:
+        return transforms.Resize((size, size), antialias=True)
+    mean, std = normalization or normalization_from_info({})
+    return transforms.Compose([
+        transforms.Resize((size, size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean, std)
+    ])
+
+# All TTA views of a batch, each of shape (B, C, crop, crop)
+def tta_views(inputs, tta='none', crop_size=224):
+    if tta == 'none':
+        return [inputs]
+    if tta == 'flip':
+        return [inputs, inputs.flip(-1)]
+    if tta == 'multicrop':
+        h, w = inputs.shape[-2:]
+        top, left = (h - crop_size) // 2, (w - crop_size) // 2
+        offsets = [(top, left), (0, 0), (0, w - crop_size), (h - crop_size, 0), (h - crop_size, w - crop_size)]
+        crops = [inputs[..., y:y + crop_size, x:x + crop_size] for y, x in offsets]
+        return crops + [crops[0].flip(-1)]
+    raise ValueError(f"Unknown TTA mode: {tta}")
+
+# One forward pass over every view of the batch, logits averaged over views
+def tta_forward(model, inputs, tta='none', crop_size=224):
+    views = tta_views(inputs, tta, crop_size)
+    if len(views) == 1:
+        return model(views[0])
+    logits = model(torch.cat(views, 0))
+    return logits.view(len(views), inputs.size(0), -1).mean(0)
+
+def collect_logits(model, dataloader, num_classes, tta='none', desc='Evaluating'):
+    num_samples = len(dataloader.dataset)
+    logits = torch.empty((num_samples, num_classes), dtype=torch.float32)
+    labels = torch.empty(num_samples, dtype=torch.long)
+    model.eval()
+    offset = 0
+    with torch.no_grad():
+        for inputs, targets in tqdm(dataloader, desc=desc):
+            n = inputs.size(0)
+            logits[offset:offset + n] = tta_forward(model, inputs.to(device), tta).float().cpu()
+            labels[offset:offset + n] = targets
+            offset += n
+    return logits[:offset], labels[:offset]
+
+# Single temperature T minimising the NLL of softmax(logits / T) on held-out logits
+def fit_temperature(logits, labels, max_iter=100):
+    log_t = torch.zeros(1, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_t], lr=0.1, max_iter=max_iter)
+
+    def closure():
+        optimizer.zero_grad()
+        loss = F.cross_entropy(logits / log_t.exp(), labels)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return float(log_t.exp().item())
+
+def expected_calibration_error(probs, labels, num_bins=15):
+    confidences, preds = probs.max(1)
+    correct = (preds == labels).float()
+    bins = torch.linspace(0, 1, num_bins + 1)
+    ece = torch.zeros(1)
+    for low, high in zip(bins[:-1], bins[1:]):
+        in_bin = (confidences > low) & (confidences <= high)
+        if in_bin.any():
+            ece += in_bin.float().mean() * (confidences[in_bin].mean() - correct[in_bin].mean()).abs()
+    return float(ece.item())
+
+def logit_metrics(logits, labels, temperature=1.0):
+    probs = F.softmax(logits / temperature, dim=1)
+    return {
+        'accuracy': float((logits.argmax(1) == labels).float().mean().item()),
+        'nll': float(F.cross_entropy(logits / temperature, labels).item()),
+        'ece': expected_calibration_error(probs, labels),
+    }
+
+# Checkpoint, input pipeline and sample list the logits were computed from
+def logits_cache_key(ckpt_path, dataset, normalization, single_channel):
+    st = os.stat(ckpt_path)
+    h = hashlib.sha1(f"{st.st_size}:{st.st_mtime_ns}:{normalization}:{single_channel}\n".encode())
+    for path, label in zip(dataset.paths(), dataset.labels):
+        h.update(f"{path}:{label}\n".encode())
+    return h.hexdigest()
+
+# Logits are cached per split/TTA mode and invalidated when the checkpoint, the
+# normalisation or the split's files change
+def cached_logits(model_type, split, data_dir, checkpoints_dir, tta='none', batch_size=32, num_workers=4, model_state=None):
+    _, ckpt_path = checkpoint_paths(model_type, checkpoints_dir)
+    cache_path = os.path.join(checkpoints_dir, f"{model_type}_{split}_logits_{tta}.pt")
+    model_info = load_model_info(model_type, checkpoints_dir)
+    normalization = normalization_from_info(model_info)
+    single_channel = model_info.get('input_channels', 3) == 1
+    transform = get_eval_transform(tta, normalization=normalization, single_channel=single_channel)
+    dataset = MedicalImageDataset(os.path.join(data_dir, model_type, split), transform=transform,
+                                  class_to_idx=model_info['class_to_idx'], single_channel=single_channel)
+    key = logits_cache_key(ckpt_path, dataset, normalization, single_channel)
+    if model_state is None:
+        model_state = {}
+    if os.path.exists(cache_path):
+        cached = torch.load(cache_path)
+        if cached.get('key') == key:
+            return cached['logits'], cached['labels']
+    if model_state.get('model') is None:
+        model_state['model'], _ = load_trained_model(model_type, checkpoints_dir)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    logits, labels = collect_logits(model_state['model'], loader, model_info['num_classes'], tta=tta,
+                                    desc=f'Evaluating {split}')
+    torch.save({'key': key, 'logits': logits, 'labels': labels}, cache_path)
+    return logits, labels
+
+def evaluate(model_type, data_dir='medical_images', checkpoints_dir='model_checkpoints', tta='none',
+             calibrate=False, batch_size=32, num_workers=4):
+    model_info = load_model_info(model_type, checkpoints_dir)
+    model_state = {'model': None}
+    # TTA averages logits over views, which changes their scale, so each mode has its own temperature
+    temperatures = model_info.get('temperatures', {})
+    temperature = temperatures.get(tta, model_info.get('temperature', 1.0) if tta == 'none' else 1.0)
+    if calibrate:
+        val_logits, val_labels = cached_logits(model_type, 'val', data_dir, checkpoints_dir, tta,
+                                               batch_size, num_workers, model_state)
+        temperature = fit_temperature(val_logits, val_labels)
+        model_info['temperatures'] = {**temperatures, tta: temperature}
+        if tta == 'none':
+            model_info['temperature'] = temperature
+        save_model_info(model_info, model_type, checkpoints_dir)
+        print(f"Fitted {tta} temperature {temperature:.4f} on {len(val_labels)} validation logits")
+
+    test_logits, test_labels = cached_logits(model_type, 'test', data_dir, checkpoints_dir, tta,
+                                             batch_size, num_workers, model_state)
+    preds = test_logits.argmax(1).numpy()
+    labels = test_labels.numpy()
+    class_names = list(model_info['class_to_idx'].keys())
+    report = {
+        'model_type': model_type,
+        'tta': tta,
+        'temperature': temperature,
+        'uncalibrated': logit_metrics(test_logits, test_labels),
+        'calibrated': logit_metrics(test_logits, test_labels, temperature),
+        'confusion_matrix': confusion_matrix(labels, preds).tolist(),
+        'classification_report': classification_report(labels, preds, target_names=class_names, output_dict=True),
+    }
+    print(f"Test Acc: {report['uncalibrated']['accuracy']:.4f}")
+    print(f"NLL {report['uncalibrated']['nll']:.4f} -> {report['calibrated']['nll']:.4f}, "
+          f"ECE {report['uncalibrated']['ece']:.4f} -> {report['calibrated']['ece']:.4f}")
+    with open(os.path.join(checkpoints_dir, f"{model_type}_evaluation.json"), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched evaluation with TTA and temperature calibration")
+    parser.add_argument('--model-type', required=True, choices=['chest', 'brain', 'scan_type'])
+    parser.add_argument('--data-dir', default='medical_images')
+    parser.add_argument('--checkpoints-dir', default='model_checkpoints')
+    parser.add_argument('--tta', default='none', choices=TTA_MODES)
+    parser.add_argument('--calibrate', action='store_true', help="Fit and save a temperature on the val split")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-workers', type=int, default=4)
+    args = parser.parse_args()
+    evaluate(args.model_type, data_dir=args.data_dir, checkpoints_dir=args.checkpoints_dir, tta=args.tta,
+             calibrate=args.calibrate, batch_size=args.batch_size, num_workers=args.num_workers)
+
+if __name__ == "__main__":
+    main()
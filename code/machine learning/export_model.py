@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import torch
+from model_utils import (MODEL_TYPES, get_model_architecture, enable_single_channel_input, normalization_from_info,
+                         checkpoint_paths, load_model_info, device)
+
+# Serving export. best_<type>_model.pth also carries the Adam state (about twice the
+# weights) and is read with a full unpickle into a model that first gets randomly
+# initialised. The export keeps only the weights, optionally in fp16, as
+# <type>_serving.pt plus a <type>_serving.json spec (classes, architecture, transform).
+# load_serving_model builds the architecture on the meta device (no init, no ImageNet
+# weights) and assigns memory-mapped tensors from the file, so start-up barely reads
+# the weights and worker processes share the same page-cache pages. app.py only serves
+# an artifact while it still matches the checkpoint and model_info it was exported from.
+#
+#   python export_model.py --model-type chest brain scan_type
+#   python export_model.py --model-type chest --fp16 --out-dir serving_artifacts
+
+# model_info fields baked into the exported weights and transform; the rest (temperature,
+# metrics) may change after export and is read from the current model_info
+STRUCTURAL_KEYS = ('num_classes', 'class_to_idx', 'architecture', 'input_channels', 'normalization')
+
+def artifact_paths(model_type, artifact_dir):
+    prefix = os.path.join(artifact_dir, f"{model_type}_serving")
+    return prefix + ".pt", prefix + ".json"
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Transform app.py rebuilds at load time (see app.get_inference_transform)
+def transform_spec(model_info):
+    mean, std = normalization_from_info(model_info)
+    return {'resize': [224, 224], 'single_channel': model_info.get('input_channels', 3) == 1,
+            'mean': list(mean), 'std': list(std)}
+
+def export_model(model_type, checkpoints_dir="model_checkpoints", out_dir=None, fp16=False):
+    out_dir = out_dir or checkpoints_dir
+    os.makedirs(out_dir, exist_ok=True)
+    _, ckpt_path = checkpoint_paths(model_type, checkpoints_dir)
+    model_info = load_model_info(model_type, checkpoints_dir)
+    checkpoint = torch.load(ckpt_path, map_location='cpu', weights_only=True)
+    # Only floating tensors go to fp16; BatchNorm's num_batches_tracked stays int64
+    state_dict = {k: (v.half() if fp16 and v.is_floating_point() else v).contiguous()
+                  for k, v in checkpoint['model_state_dict'].items()}
+    weights_path, spec_path = artifact_paths(model_type, out_dir)
+    torch.save(state_dict, weights_path)
+
+    spec = {
+        'format': 1,
+        'model_type': model_type,
+        'architecture': model_info.get('architecture', 'densenet121'),
+        'dtype': 'float16' if fp16 else 'float32',
+        'weights': os.path.basename(weights_path),
+        'sha256': _sha256(weights_path),
+        'source_checkpoint': os.path.abspath(ckpt_path),
+        'source_stat': {'size': os.stat(ckpt_path).st_size, 'mtime_ns': os.stat(ckpt_path).st_mtime_ns},
+        'exported': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'transform': transform_spec(model_info),
+        'model_info': model_info,
+    }
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f, indent=2)
+    print(f"{model_type}: {os.path.getsize(ckpt_path) / 2**20:.1f} MiB checkpoint -> "
+          f"{os.path.getsize(weights_path) / 2**20:.1f} MiB {spec['dtype']} weights at {weights_path}")
+    return weights_path, spec_path
+
+def load_spec(model_type, artifact_dir):
+    _, spec_path = artifact_paths(model_type, artifact_dir)
+    with open(spec_path, 'r') as f:
+        return json.load(f)
+
+# Why the artifact no longer matches best_<type>_model.pth / <type>_model_info.json in
+# checkpoints_dir (retrained, linear-probe overwrite, ...), or None while it is current.
+# An artifact deployed without its checkpoint or model_info is taken as current.
+def artifact_staleness(model_type, artifact_dir, checkpoints_dir=None):
+    checkpoints_dir = checkpoints_dir or artifact_dir
+    spec = load_spec(model_type, artifact_dir)
+    info_path, ckpt_path = checkpoint_paths(model_type, checkpoints_dir)
+    if os.path.exists(ckpt_path):
+        st = os.stat(ckpt_path)
+        source = spec.get('source_stat')
+        if source is None:
+            # Specs from before source_stat: compare against the export time of the weights
+            if st.st_mtime > os.path.getmtime(os.path.join(artifact_dir, spec['weights'])):
+                return f"{ckpt_path} is newer than the export"
+        elif (st.st_size, st.st_mtime_ns) != (source['size'], source['mtime_ns']):
+            return f"{ckpt_path} changed since the export"
+    if os.path.exists(info_path):
+        model_info = load_model_info(model_type, checkpoints_dir)
+        for key in STRUCTURAL_KEYS:
+            if model_info.get(key) != spec['model_info'].get(key):
+                return f"model_info '{key}' changed since the export"
+    return None
+
+# Returns (model, model_info). fp32 weights on CPU stay memory-mapped (assign=True keeps
+# the mmap'd tensors as the parameters); fp16 weights and GPU models are copied once.
+def load_serving_model(model_type, artifact_dir, map_device=None):
+    map_device = map_device or device
+    spec = load_spec(model_type, artifact_dir)
+    model_info = spec['model_info']
+    weights_path = os.path.join(artifact_dir, spec['weights'])
+    state_dict = torch.load(weights_path, map_location='cpu', mmap=True, weights_only=True)
+    with torch.device('meta'):
+        model = get_model_architecture(model_type, model_info['num_classes'], pretrained=False,
+                                       architecture=spec['architecture'])
+    model.load_state_dict(state_dict, assign=True)
+    if spec['dtype'] != 'float32':
+        model.float()
+    if spec['transform']['single_channel']:
+        enable_single_channel_input(model, spec['transform']['mean'], spec['transform']['std'])
+    model.to(map_device)
+    model.eval()
+    return model, model_info
+
+def main():
+    parser = argparse.ArgumentParser(description="Export weights-only serving artifacts from training checkpoints")
+    parser.add_argument('--model-type', nargs='+', default=MODEL_TYPES, choices=MODEL_TYPES)
+    parser.add_argument('--checkpoints-dir', default='model_checkpoints')
+    parser.add_argument('--out-dir', default=None, help="Defaults to the checkpoints directory")
+    parser.add_argument('--fp16', action='store_true', help="Store weights as fp16 (half the size; upcast on load)")
+    args = parser.parse_args()
+    for model_type in args.model_type:
+        export_model(model_type, args.checkpoints_dir, args.out_dir, fp16=args.fp16)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import os
+import json
+
+# gunicorn -c gunicorn.conf.py app:app
+# Worker count comes from autotune.py's serving_config.json; each worker applies the
+# torch thread settings itself when it loads its first model. gthread workers let
+# concurrent requests reach app.py's micro-batcher. Models load on first request unless
+# WARMUP_MODELS=1, which loads them (and runs one forward) as each worker starts.
+
+config_path = os.environ.get("SERVING_CONFIG", "serving_config.json")
+serving_config = {}
+if os.path.exists(config_path):
+    with open(config_path, "r") as f:
+        serving_config = json.load(f)
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(serving_config.get("workers", 1))
+worker_class = "gthread"
+threads = max([m.get("max_batch_size", 1) for m in serving_config.get("models", {}).values()] + [1]) * 2
+timeout = 120
+
+def post_worker_init(worker):
+    if os.environ.get("WARMUP_MODELS") == "1":
+        import app
+        print(f"Worker {worker.pid} warmed up: {app.warmup()}")
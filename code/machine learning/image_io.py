@@ -0,0 +1,103 @@
+import os
+import numpy as np
+from PIL import Image
+
+# Decoding for medical images at their native bit depth. DICOM (via pydicom, optional)
+# and 16-bit PNG pixel data are read as a single channel, windowed to [0, 1] in one
+# vectorised op and handed on as a 1xHxW float32 tensor. Broadcasting to the three
+# channels the ImageNet backbones expect happens inside the model (see
+# model_utils.enable_single_channel_input), not in the data pipeline.
+
+def _peek(source, size):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read(size)
+    pos = source.tell()
+    data = source.read(size)
+    source.seek(pos)
+    return data
+
+def is_dicom(source):
+    if isinstance(source, (str, os.PathLike)) and str(source).lower().endswith('.dcm'):
+        return True
+    try:
+        return _peek(source, 132)[128:132] == b'DICM'
+    except OSError:
+        return False
+
+# pydicom is only needed for DICOM files, so it is imported on first use
+def import_pydicom():
+    try:
+        import pydicom
+    except ImportError as e:
+        raise ImportError("install pydicom for DICOM support (pip install pydicom)") from e
+    return pydicom
+
+# DICOM pixels in modality units plus the file's default window (center, width).
+# defer_size keeps large elements unread until accessed; pixel data is decoded once here.
+def read_dicom(source):
+    pydicom = import_pydicom()
+    ds = pydicom.dcmread(source, defer_size='1 KB')
+    pixels = ds.pixel_array.astype(np.float32, copy=False)
+    slope = float(getattr(ds, 'RescaleSlope', 1.0))
+    intercept = float(getattr(ds, 'RescaleIntercept', 0.0))
+    if slope != 1.0 or intercept != 0.0:
+        pixels = pixels * slope + intercept
+    if pixels.ndim == 3 and pixels.shape[-1] == 3:
+        pixels = pixels.mean(axis=-1)
+    elif pixels.ndim == 3:
+        pixels = pixels[pixels.shape[0] // 2]
+    window = None
+    if 'WindowCenter' in ds and 'WindowWidth' in ds:
+        center, width = ds.WindowCenter, ds.WindowWidth
+        center = center[0] if isinstance(center, pydicom.multival.MultiValue) else center
+        width = width[0] if isinstance(width, pydicom.multival.MultiValue) else width
+        window = (float(center), float(width))
+    invert = getattr(ds, 'PhotometricInterpretation', '') == 'MONOCHROME1'
+    return pixels, window, invert
+
+# PNG/JPEG pixels as a single channel, keeping 16-bit data at 16 bits. 16-bit images
+# get the fixed full 0-65535 window so intensities mean the same thing in every image.
+def read_raster(source):
+    with Image.open(source) as img:
+        if img.mode in ('I;16', 'I;16B', 'I;16L', 'I'):
+            pixels = np.asarray(img, dtype=np.int32 if img.mode == 'I' else np.uint16)
+            return pixels, (32767.5, 65535.0), False
+        if img.mode != 'L':
+            img = img.convert('L')
+        return np.asarray(img, dtype=np.uint8), (127.5, 255.0), False
+
+# Window/level to [0, 1]; without a window (DICOM lacking one) the image's own min/max range is used
+def apply_window(pixels, window=None, invert=False):
+    if window is None:
+        low, high = float(pixels.min()), float(pixels.max())
+    else:
+        center, width = window
+        low, high = center - width / 2.0, center + width / 2.0
+    scale = 1.0 / max(high - low, 1e-6)
+    out = np.subtract(pixels, low, dtype=np.float32)
+    out *= scale
+    np.clip(out, 0.0, 1.0, out=out)
+    if invert:
+        np.subtract(1.0, out, out=out)
+    return out
+
+def load_grayscale(source, window=None):
+    if is_dicom(source):
+        pixels, default_window, invert = read_dicom(source)
+    else:
+        pixels, default_window, invert = read_raster(source)
+    return apply_window(pixels, window or default_window, invert)
+
+# 1xHxW float32 tensor for the single-channel pipeline
+def load_grayscale_tensor(source, window=None):
+    import torch
+    return torch.from_numpy(load_grayscale(source, window)).unsqueeze(0)
+
+# 8-bit RGB PIL image for the existing 3-channel pipeline; DICOM goes through the
+# windowing path instead of failing in PIL
+def load_rgb(source):
+    if is_dicom(source):
+        gray = load_grayscale(source)
+        return Image.fromarray(np.round(gray * 255.0).astype(np.uint8), mode='L').convert('RGB')
+    return Image.open(source).convert('RGB')
@@ -0,0 +1,234 @@
+import os
+import json
+import copy
+import hashlib
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from model_utils import (device, get_transforms, get_model_architecture, enable_single_channel_input,
+                         backbone_features, normalization_from_info, checkpoint_paths, load_model_info,
+                         save_model_info)
+from medical_datasets import MedicalImageDataset
+
+# Linear-probe training: run the frozen DenseNet backbone once per split, cache the
+# pooled 1024-d features on disk and train only the Dropout+Linear head on them. The
+# probed model is written to its own directory (model_checkpoints_probe); replacing the
+# fine-tuned model in the checkpoints directory needs --overwrite.
+#
+#   python linear_probe.py --model-type brain --epochs 200
+#   CHECKPOINTS_DIR=model_checkpoints_probe python app.py   # serve the probe
+
+SPLITS = ['train', 'val', 'test']
+
+# Backbone taken from an existing fine-tuned checkpoint, or ImageNet weights if none is given
+def load_backbone(model_type, backbone_checkpoint=None):
+    model = get_model_architecture(model_type, num_classes=1, pretrained=backbone_checkpoint is None)
+    if backbone_checkpoint is not None:
+        checkpoint = torch.load(backbone_checkpoint, map_location='cpu')
+        state_dict = {k: v for k, v in checkpoint['model_state_dict'].items() if not k.startswith('classifier.')}
+        model.load_state_dict(state_dict, strict=False)
+    model.to(device)
+    model.eval()
+    return model
+
+# Fingerprint of the backbone weights and the sample list, so stale caches are rebuilt.
+# Hashing the weights (not the file mtime) keeps the cache valid after a head-only retrain.
+def backbone_fingerprint(backbone):
+    h = hashlib.sha1()
+    for name, tensor in backbone.state_dict().items():
+        if not name.startswith('classifier.'):
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+def cache_key(dataset, fingerprint):
+    h = hashlib.sha1(fingerprint.encode())
+    for path, label in zip(dataset.paths(), dataset.labels):
+        h.update(f"{path}:{label}\n".encode())
+    return h.hexdigest()
+
+def feature_cache_paths(cache_dir, model_type, split):
+    prefix = os.path.join(cache_dir, f"{model_type}_{split}")
+    return prefix + "_features.npy", prefix + "_labels.npy", prefix + "_features.json"
+
+# Run the backbone once over a dataset, writing float16 features into a preallocated .npy
+def extract_features(backbone, dataset, features_path, batch_size=64, num_workers=4):
+    num_features = backbone.classifier[1].in_features
+    partial_path = features_path + ".partial"
+    features = np.lib.format.open_memmap(partial_path, mode='w+', dtype=np.float16,
+                                         shape=(len(dataset), num_features))
+    labels = np.empty(len(dataset), dtype=np.int64)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    offset = 0
+    with torch.no_grad():
+        for inputs, targets in tqdm(loader, desc='Extracting features'):
+            inputs = inputs.to(device)
+            batch_features = backbone_features(backbone, inputs)
+            n = inputs.size(0)
+            features[offset:offset + n] = batch_features.cpu().numpy().astype(np.float16)
+            labels[offset:offset + n] = targets.numpy()
+            offset += n
+    features.flush()
+    del features
+    os.replace(partial_path, features_path)
+    return labels
+
+def load_or_extract(backbone, dataset, cache_dir, model_type, split, fingerprint, batch_size=64, num_workers=4):
+    features_path, labels_path, meta_path = feature_cache_paths(cache_dir, model_type, split)
+    key = cache_key(dataset, fingerprint)
+    if os.path.exists(meta_path) and os.path.exists(features_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get('key') == key:
+            print(f"Using cached {split} features from {features_path}")
+            return np.load(features_path, mmap_mode='r'), np.load(labels_path)
+    print(f"Extracting {split} features ({len(dataset)} images)")
+    labels = extract_features(backbone, dataset, features_path, batch_size=batch_size, num_workers=num_workers)
+    np.save(labels_path, labels)
+    with open(meta_path, 'w') as f:
+        json.dump({'key': key, 'num_samples': len(dataset), 'class_to_idx': dataset.class_to_idx}, f)
+    return np.load(features_path, mmap_mode='r'), labels
+
+def head_accuracy(head, features, labels):
+    head.eval()
+    with torch.no_grad():
+        preds = head(features).argmax(1)
+    return (preds == labels).double().mean().item()
+
+# Train the Dropout+Linear head on cached features, keeping the best val epoch
+def train_head(train_data, val_data, num_classes, epochs=100, batch_size=256, learning_rate=0.001, weight_decay=1e-5):
+    train_x, train_y = train_data
+    val_x, val_y = val_data
+    head = nn.Sequential(nn.Dropout(0.3), nn.Linear(train_x.size(1), num_classes)).to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(head.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    best_acc, best_epoch, best_state = -1.0, 0, None
+    for epoch in range(epochs):
+        head.train()
+        perm = torch.randperm(train_x.size(0), device=device)
+        for start in range(0, train_x.size(0), batch_size):
+            idx = perm[start:start + batch_size]
+            optimizer.zero_grad()
+            loss = criterion(head(train_x[idx]), train_y[idx])
+            loss.backward()
+            optimizer.step()
+        val_acc = head_accuracy(head, val_x, val_y)
+        if val_acc > best_acc:
+            best_acc, best_epoch, best_state = val_acc, epoch, copy.deepcopy(head.state_dict())
+    head.load_state_dict(best_state)
+    print(f"Best val Acc: {best_acc:.4f} (Epoch {best_epoch+1})")
+    return head, best_acc, best_epoch
+
+def to_tensors(features, labels):
+    return (torch.from_numpy(np.asarray(features, dtype=np.float32)).to(device),
+            torch.from_numpy(np.asarray(labels, dtype=np.int64)).to(device))
+
+# checkpoints_dir holds the backbone's <type>_model_info.json; the probe is saved to
+# out_dir, which may only be checkpoints_dir itself with overwrite=True
+def linear_probe(data_dir, model_type, checkpoints_dir='model_checkpoints', backbone_checkpoint=None,
+                 out_dir='model_checkpoints_probe', overwrite=False, cache_dir='feature_cache', epochs=100,
+                 batch_size=256, learning_rate=0.001, num_workers=4):
+    if os.path.abspath(out_dir) == os.path.abspath(checkpoints_dir) and not overwrite:
+        raise ValueError(f"Refusing to replace the model in {checkpoints_dir} without overwrite=True")
+    os.makedirs(cache_dir, exist_ok=True)
+    os.makedirs(out_dir, exist_ok=True)
+    # Keep the backbone model's info (normalisation, input channels, temperature, ...) and
+    # only replace what the new head changes. A fine-tuned backbone expects the
+    # normalisation and channels it was trained with, ImageNet weights the RGB defaults.
+    info_path, _ = checkpoint_paths(model_type, checkpoints_dir)
+    if backbone_checkpoint is None:
+        print("No backbone checkpoint given: probing ImageNet weights (downloaded if not cached)")
+        backbone_info = {}
+    else:
+        backbone_info = load_model_info(model_type, checkpoints_dir) if os.path.exists(info_path) else {}
+    normalization = normalization_from_info(backbone_info)
+    single_channel = backbone_info.get('input_channels', 3) == 1
+    val_transform = get_transforms(model_type, single_channel=single_channel, normalization=normalization)['val']
+    train_dataset = MedicalImageDataset(os.path.join(data_dir, model_type, 'train'), transform=val_transform,
+                                        single_channel=single_channel)
+    datasets = {'train': train_dataset}
+    for split in ['val', 'test']:
+        datasets[split] = MedicalImageDataset(os.path.join(data_dir, model_type, split), transform=val_transform,
+                                              class_to_idx=train_dataset.class_to_idx, single_channel=single_channel)
+    num_classes = len(train_dataset.classes)
+    print(f"Classes: {train_dataset.classes}")
+
+    backbone = load_backbone(model_type, backbone_checkpoint)
+    if single_channel:
+        enable_single_channel_input(backbone, *normalization)
+    fingerprint = f"{backbone_fingerprint(backbone)}:{normalization}:{single_channel}"
+    cached = {}
+    for split in SPLITS:
+        features, labels = load_or_extract(backbone, datasets[split], cache_dir, model_type, split,
+                                           fingerprint, num_workers=num_workers)
+        cached[split] = to_tensors(features, labels)
+
+    head, best_acc, best_epoch = train_head(cached['train'], cached['val'], num_classes, epochs=epochs,
+                                            batch_size=batch_size, learning_rate=learning_rate)
+    test_acc = head_accuracy(head, *cached['test'])
+    print(f"Test Acc: {test_acc:.4f}")
+
+    # Full checkpoint in the same format train_model writes, so app.load_model serves it as-is
+    backbone.classifier = head
+    _, ckpt_path = checkpoint_paths(model_type, out_dir)
+    torch.save({
+        'model_state_dict': backbone.state_dict(),
+        'acc': best_acc,
+        'epoch': best_epoch,
+        'class_to_idx': train_dataset.class_to_idx,
+        'training_mode': 'linear_probe'
+    }, ckpt_path)
+    model_info = dict(backbone_info)
+    model_info.update({
+        'model_type': model_type,
+        'num_classes': num_classes,
+        'classes': train_dataset.classes,
+        'class_to_idx': train_dataset.class_to_idx,
+        'best_acc': best_acc,
+        'best_epoch': best_epoch,
+        'test_acc': test_acc,
+        'training_mode': 'linear_probe',
+        'architecture': 'densenet121',
+        'normalization': {'mean': list(normalization[0]), 'std': list(normalization[1])},
+        'input_channels': 1 if single_channel else 3,
+    })
+    save_model_info(model_info, model_type, out_dir)
+    print(f"Saved linear-probe model to {ckpt_path}")
+    return model_info
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the classifier head on cached frozen-backbone features")
+    parser.add_argument('--model-type', required=True, choices=['chest', 'brain', 'scan_type'])
+    parser.add_argument('--data-dir', default='medical_images')
+    parser.add_argument('--checkpoints-dir', default='model_checkpoints', help="Directory of the fine-tuned backbone")
+    parser.add_argument('--backbone-checkpoint', default=None,
+                        help="Checkpoint to take the backbone from (default: best_<type>_model.pth in --checkpoints-dir)")
+    parser.add_argument('--imagenet-backbone', action='store_true',
+                        help="Probe ImageNet weights when there is no backbone checkpoint")
+    parser.add_argument('--out-dir', default='model_checkpoints_probe')
+    parser.add_argument('--overwrite', action='store_true',
+                        help="Allow --out-dir to be --checkpoints-dir, replacing the fine-tuned model")
+    parser.add_argument('--cache-dir', default='feature_cache')
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--num-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    backbone_checkpoint = args.backbone_checkpoint
+    if backbone_checkpoint is None:
+        _, default_ckpt = checkpoint_paths(args.model_type, args.checkpoints_dir)
+        backbone_checkpoint = default_ckpt if os.path.exists(default_ckpt) else None
+        if backbone_checkpoint is None and not args.imagenet_backbone:
+            parser.error(f"No {default_ckpt}; pass --backbone-checkpoint, or --imagenet-backbone to probe ImageNet weights")
+    linear_probe(args.data_dir, args.model_type, checkpoints_dir=args.checkpoints_dir,
+                 backbone_checkpoint=backbone_checkpoint, out_dir=args.out_dir, overwrite=args.overwrite,
+                 cache_dir=args.cache_dir, epochs=args.epochs, batch_size=args.batch_size,
+                 learning_rate=args.lr, num_workers=args.num_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import os
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from image_io import import_pydicom
+
+# Dataset manifest: one compact .npz per class-folder dataset recording every image's
+# class, byte size, mtime, dimensions and mode, plus whether its header could be read.
+# Rebuilding only re-probes files whose size or mtime changed.
+#
+#   python manifest.py medical_images/brain/train
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.dcm')
+FIELDS = ['paths', 'labels', 'sizes', 'mtimes', 'widths', 'heights', 'modes', 'ok', 'errors']
+
+# Written next to the dataset folder (medical_images/brain/train -> train.manifest.npz)
+def default_manifest_path(root_dir):
+    return os.path.normpath(root_dir) + '.manifest.npz'
+
+# Reads only the header: PIL's open() is lazy and pydicom can stop before the pixel data
+def probe_header(path):
+    try:
+        if path.lower().endswith('.dcm'):
+            ds = import_pydicom().dcmread(path, stop_before_pixels=True)
+            return int(ds.Columns), int(ds.Rows), str(getattr(ds, 'PhotometricInterpretation', '')), True, ''
+        with Image.open(path) as img:
+            return img.width, img.height, img.mode, True, ''
+    except Exception as e:
+        return 0, 0, '', False, str(e)
+
+def _verify_decode(path):
+    try:
+        if path.lower().endswith('.dcm'):
+            from image_io import load_grayscale
+            load_grayscale(path)
+            return True, ''
+        with Image.open(path) as img:
+            img.load()
+        return True, ''
+    except Exception as e:
+        return False, str(e)
+
+def _scan_class_dir(root_dir, class_name):
+    entries = []
+    class_dir = os.path.join(root_dir, class_name)
+    with os.scandir(class_dir) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                st = entry.stat()
+                entries.append((os.path.join(class_name, entry.name), st.st_size, st.st_mtime_ns))
+    entries.sort()
+    return entries
+
+class Manifest:
+    def __init__(self, root_dir, classes, **columns):
+        self.root_dir = root_dir
+        self.classes = list(classes)
+        for field in FIELDS:
+            setattr(self, field, columns[field])
+
+    @property
+    def class_to_idx(self):
+        return {cls_name: i for i, cls_name in enumerate(self.classes)}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def full_path(self, i):
+        return os.path.join(self.root_dir, str(self.paths[i]))
+
+    # Written to a temp file unique to this writer, then renamed over manifest_path, so
+    # concurrent builders of the same dataset never write into each other's file
+    def save(self, manifest_path):
+        f = tempfile.NamedTemporaryFile(dir=os.path.dirname(manifest_path) or '.', prefix=os.path.basename(manifest_path) + '.',
+                                        suffix='.partial.npz', delete=False)
+        try:
+            with f:
+                np.savez_compressed(f, root_dir=np.array(self.root_dir), classes=np.array(self.classes),
+                                    **{field: getattr(self, field) for field in FIELDS})
+            os.replace(f.name, manifest_path)
+        except BaseException:
+            if os.path.exists(f.name):
+                os.remove(f.name)
+            raise
+
+    @classmethod
+    def load(cls, manifest_path):
+        with np.load(manifest_path, allow_pickle=False) as data:
+            columns = {field: data[field] for field in FIELDS}
+            return cls(str(data['root_dir']), [str(c) for c in data['classes']], **columns)
+
+    def bad_files(self):
+        return [(self.full_path(i), str(self.errors[i])) for i in np.flatnonzero(~self.ok)]
+
+    # (path, label) pairs of readable images, relabelled with class_to_idx when given
+    def samples(self, class_to_idx=None):
+        remap = None
+        if class_to_idx is not None:
+            remap = np.array([class_to_idx.get(c, -1) for c in self.classes], dtype=np.int64)
+        samples = []
+        for i in np.flatnonzero(self.ok):
+            label = int(self.labels[i]) if remap is None else int(remap[self.labels[i]])
+            if label >= 0:
+                samples.append((self.full_path(i), label))
+        return samples
+
+    def class_counts(self, only_ok=True):
+        labels = self.labels[self.ok] if only_ok else self.labels
+        counts = np.bincount(labels, minlength=len(self.classes))
+        return {cls_name: int(n) for cls_name, n in zip(self.classes, counts)}
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame({
+            'path': [self.full_path(i) for i in range(len(self))],
+            'class': [self.classes[label] for label in self.labels],
+            'class_id': self.labels.astype(np.int64),
+            'width': self.widths,
+            'height': self.heights,
+            'mode': self.modes,
+            'bytes': self.sizes,
+            'ok': self.ok,
+        })
+
+# Builds or incrementally updates the manifest; unchanged files cost one stat each
+def build_manifest(root_dir, classes=None, manifest_path=None, num_workers=16, verify=False):
+    manifest_path = manifest_path or default_manifest_path(root_dir)
+    if classes is None:
+        with os.scandir(root_dir) as it:
+            classes = sorted(entry.name for entry in it if entry.is_dir() and not entry.name.startswith('.'))
+    classes = [c for c in classes if os.path.isdir(os.path.join(root_dir, c))] if classes else []
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        scanned = list(executor.map(lambda c: _scan_class_dir(root_dir, c), classes))
+
+    previous = {}
+    old = None
+    if os.path.exists(manifest_path):
+        try:
+            old = Manifest.load(manifest_path)
+            if os.path.abspath(old.root_dir) == os.path.abspath(root_dir):
+                previous = {str(p): i for i, p in enumerate(old.paths)}
+        except Exception as e:
+            print(f"Ignoring unreadable manifest {manifest_path}: {e}")
+
+    rows = []
+    to_probe = []
+    for label, entries in enumerate(scanned):
+        for rel_path, size, mtime in entries:
+            j = previous.get(rel_path)
+            if j is not None and old.sizes[j] == size and old.mtimes[j] == mtime:
+                rows.append([rel_path, label, size, mtime, int(old.widths[j]), int(old.heights[j]),
+                             str(old.modes[j]), bool(old.ok[j]), str(old.errors[j])])
+            else:
+                to_probe.append(len(rows))
+                rows.append([rel_path, label, size, mtime, 0, 0, '', False, ''])
+
+    def probe(row_idx):
+        path = os.path.join(root_dir, rows[row_idx][0])
+        result = list(probe_header(path))
+        if verify and result[3]:
+            result[3], result[4] = _verify_decode(path)
+        return row_idx, result
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for row_idx, (width, height, mode, ok, error) in executor.map(probe, to_probe):
+            rows[row_idx][4:] = [width, height, mode, ok, error]
+
+    columns = list(zip(*rows)) if rows else [[] for _ in FIELDS]
+    manifest = Manifest(
+        root_dir, classes,
+        paths=np.array(columns[0], dtype=str),
+        labels=np.array(columns[1], dtype=np.int32),
+        sizes=np.array(columns[2], dtype=np.int64),
+        mtimes=np.array(columns[3], dtype=np.int64),
+        widths=np.array(columns[4], dtype=np.int32),
+        heights=np.array(columns[5], dtype=np.int32),
+        modes=np.array(columns[6], dtype=str),
+        ok=np.array(columns[7], dtype=bool),
+        errors=np.array(columns[8], dtype=str),
+    )
+    unchanged = (old is not None and not to_probe and len(rows) == len(previous)
+                 and list(old.classes) == list(classes))
+    if unchanged:
+        return manifest
+    try:
+        manifest.save(manifest_path)
+    except OSError as e:
+        print(f"Could not write manifest {manifest_path}: {e}. Using it in memory only.")
+    bad = manifest.bad_files()
+    print(f"Manifest {manifest_path}: {len(manifest)} images, {len(to_probe)} probed, {len(bad)} unreadable")
+    for path, error in bad[:20]:
+        print(f"  Unreadable image {path}: {error}")
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the manifest of a class-folder image dataset")
+    parser.add_argument('root_dirs', nargs='+')
+    parser.add_argument('--num-workers', type=int, default=16)
+    parser.add_argument('--verify', action='store_true', help="Fully decode new files instead of only reading headers")
+    args = parser.parse_args()
+    for root_dir in args.root_dirs:
+        build_manifest(root_dir, num_workers=args.num_workers, verify=args.verify)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import time
+import numpy as np
+import torch
+from torch.utils.data import Dataset, get_worker_info
+from PIL import Image
+from manifest import build_manifest
+from image_io import load_rgb, load_grayscale_tensor
+
+# Compact sample index: all paths in one contiguous UTF-8 byte buffer with an int64
+# offsets array, labels in an int64 array. The three arrays live in shared memory, so
+# forked DataLoader workers never touch per-sample Python objects (no refcount writes,
+# no copy-on-write page duplication) and spawned workers attach instead of copying.
+class SampleIndex:
+    def __init__(self, paths, labels):
+        encoded = [p.encode('utf-8') for p in paths]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8).copy()
+        self._buffer = torch.from_numpy(buffer).share_memory_()
+        self._offsets = torch.from_numpy(offsets).share_memory_()
+        self._labels = torch.from_numpy(np.asarray(labels, dtype=np.int64).copy()).share_memory_()
+        self._make_views()
+
+    def _make_views(self):
+        self.buffer = self._buffer.numpy()
+        self.offsets = self._offsets.numpy()
+        self.labels = self._labels.numpy()
+
+    # Only the shared tensors are pickled; torch's reducers send them as shared-memory handles
+    def __getstate__(self):
+        return {'_buffer': self._buffer, '_offsets': self._offsets, '_labels': self._labels}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def path(self, idx):
+        return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def label(self, idx):
+        return int(self.labels[idx])
+
+# Common base of the brain, chest and scan_type datasets: samples are looked up in a
+# SampleIndex and decoded through image_io. With single_channel=True images come out as
+# 1xHxW float32 tensors in [0, 1] at full bit depth instead of 8-bit RGB PIL images.
+class IndexedImageDataset(Dataset):
+    def __init__(self, paths, labels, transform=None, single_channel=False):
+        self.index = SampleIndex(paths, labels)
+        self.transform = transform
+        self.single_channel = single_channel
+        self.timing = None
+
+    # Per-worker [decode_seconds, transform_seconds, samples] rows in shared memory, read
+    # by throughput.ThroughputMonitor; row 0 is the main process. num_workers is that of
+    # the DataLoader reading this dataset, and must be set before its workers start.
+    def enable_timing(self, num_workers):
+        self.timing = torch.zeros(num_workers + 1, 3, dtype=torch.float64).share_memory_()
+
+    # Sample paths decoded one at a time from the index, without building a list
+    def paths(self):
+        return (self.index.path(i) for i in range(len(self.index)))
+
+    # int64 label array shared with the index; read-only view
+    @property
+    def labels(self):
+        labels = self.index.labels.view()
+        labels.flags.writeable = False
+        return labels
+
+    def load_image(self, image_path):
+        try:
+            if self.single_channel:
+                return load_grayscale_tensor(image_path)
+            return load_rgb(image_path)
+        except Exception as e:
+            print(f"Error loading image {image_path}: {e}. Using placeholder image.")
+            if self.single_channel:
+                return torch.full((1, 224, 224), 0.5)
+            return Image.new('RGB', (224, 224), color='gray')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if self.timing is None:
+            image = self.load_image(self.index.path(idx))
+            if self.transform:
+                image = self.transform(image)
+            return image, self.index.label(idx)
+        start = time.perf_counter()
+        image = self.load_image(self.index.path(idx))
+        decoded = time.perf_counter()
+        if self.transform:
+            image = self.transform(image)
+        worker = get_worker_info()
+        row = self.timing[worker.id + 1 if worker is not None else 0]
+        row += torch.tensor([decoded - start, time.perf_counter() - decoded, 1.0], dtype=torch.float64)
+        return image, self.index.label(idx)
+
+# Class-folder dataset shared by the brain, chest and scan_type pipelines. The sample
+# list comes from the folder's manifest, so unreadable files are reported and skipped
+# up front instead of turning into placeholders mid-epoch.
+class MedicalImageDataset(IndexedImageDataset):
+    def __init__(self, root_dir, transform=None, class_to_idx=None, manifest=None, single_channel=False):
+        self.root_dir = root_dir
+        manifest = manifest if manifest is not None else build_manifest(root_dir)
+        if class_to_idx is None:
+            self.classes = list(manifest.classes)
+            self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+        else:
+            self.class_to_idx = class_to_idx
+            self.classes = list(class_to_idx.keys())
+        samples = manifest.samples(self.class_to_idx)
+        super().__init__([p for p, _ in samples], [label for _, label in samples], transform=transform,
+                         single_channel=single_channel)
+
+# Per-class shuffled split into {'train', 'val', 'test'} index arrays, computed in memory
+def stratified_split(labels, val_size=0.1, test_size=0.2, seed=42):
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    splits = {'train': [], 'val': [], 'test': []}
+    for label in np.unique(labels):
+        idx = rng.permutation(np.flatnonzero(labels == label))
+        n_test = int(round(len(idx) * test_size))
+        n_val = int(round(len(idx) * val_size))
+        splits['test'].append(idx[:n_test])
+        splits['val'].append(idx[n_test:n_test + n_val])
+        splits['train'].append(idx[n_test + n_val:])
+    return {name: np.sort(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+            for name, parts in splits.items()}
+
+# chest vs brain sources for the scan_type task: every split folder of each dataset
+def scan_type_sources(data_dir, sources=('brain', 'chest'), splits=('train', 'val', 'test')):
+    return {source: [os.path.join(data_dir, source, split) for split in splits
+                     if os.path.isdir(os.path.join(data_dir, source, split))]
+            for source in sources}
+
+# Dataset whose classes are whole source datasets (e.g. scan_type = chest vs brain),
+# built by reference from the sources' manifests instead of a copied class-folder tree.
+# ratios subsamples each source (e.g. {'chest': 0.25} to balance against brain), and the
+# stratified split is recomputed deterministically from the seed, so train/val/test
+# instances built with the same arguments never overlap.
+class CompositeImageDataset(IndexedImageDataset):
+    def __init__(self, sources, split='train', transform=None, ratios=None, val_size=0.1, test_size=0.2,
+                 seed=42, single_channel=False):
+        self.classes = sorted(sources.keys())
+        self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+        rng = np.random.RandomState(seed)
+        paths, labels = [], []
+        for cls_name in self.classes:
+            source_paths = [path for root_dir in sources[cls_name] for path, _ in build_manifest(root_dir).samples()]
+            ratio = (ratios or {}).get(cls_name, 1.0)
+            if ratio < 1.0:
+                keep = np.sort(rng.choice(len(source_paths), int(round(len(source_paths) * ratio)), replace=False))
+                source_paths = [source_paths[i] for i in keep]
+            paths += source_paths
+            labels += [self.class_to_idx[cls_name]] * len(source_paths)
+        indices = stratified_split(labels, val_size=val_size, test_size=test_size, seed=seed)[split]
+        super().__init__([paths[i] for i in indices], [labels[i] for i in indices], transform=transform,
+                         single_channel=single_channel)
@@ -0,0 +1,143 @@
+import os
+import json
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.models as models
+import torchvision.transforms as transforms
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+MODEL_TYPES = ["chest", "brain", "scan_type"]
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# Train/val transforms for every model type (same as the per-type training scripts).
+# single_channel=True expects the 1xHxW float tensors from image_io and leaves
+# normalisation to the model (see enable_single_channel_input). normalization is a
+# (mean, std) pair, e.g. from dataset_stats.load_normalization; ImageNet by default.
+def get_transforms(model_type, single_channel=False, normalization=None):
+    if model_type == "chest":
+        train_augment = [transforms.RandomHorizontalFlip(),
+                         transforms.RandomAffine(degrees=5, translate=(0.05, 0.05), scale=(0.95, 1.05))]
+    elif model_type == "brain":
+        train_augment = [transforms.RandomHorizontalFlip(),
+                         transforms.RandomRotation(15)]
+    elif model_type == "scan_type":
+        train_augment = [transforms.RandomHorizontalFlip(),
+                         transforms.RandomRotation(10),
+                         transforms.ColorJitter(brightness=0.2, contrast=0.2)]
+    else:
+        raise ValueError(f"Unexpected model type: {model_type}")
+    mean, std = normalization or (IMAGENET_MEAN, IMAGENET_STD)
+    if single_channel:
+        return {
+            'train': transforms.Compose([transforms.Resize((224, 224), antialias=True)] + train_augment),
+            'val': transforms.Resize((224, 224), antialias=True)
+        }
+    return {
+        'train': transforms.Compose([transforms.Resize((224, 224))] + train_augment + [
+            transforms.ToTensor(),
+            transforms.Normalize(mean, std)
+        ]),
+        'val': transforms.Compose([
+            transforms.Resize((224, 224)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean, std)
+        ])
+    }
+
+ARCHITECTURES = ["densenet121", "resnet18", "mobilenet_v3_small", "mobilenet_v3_large"]
+
+# DenseNet121 with the Dropout+Linear head used by every model type. The smaller
+# architectures are distillation students and get the same Dropout+Linear head.
+# pretrained=False skips the ImageNet download when the weights are overwritten anyway.
+def get_model_architecture(model_type, num_classes, pretrained=True, architecture="densenet121"):
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f"Unknown model type: {model_type}")
+    if architecture == "densenet121":
+        model = models.densenet121(weights=models.DenseNet121_Weights.DEFAULT if pretrained else None)
+        num_features = model.classifier.in_features
+        model.classifier = nn.Sequential(nn.Dropout(0.3), nn.Linear(num_features, num_classes))
+    elif architecture == "resnet18":
+        model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT if pretrained else None)
+        num_features = model.fc.in_features
+        model.fc = nn.Sequential(nn.Dropout(0.3), nn.Linear(num_features, num_classes))
+    elif architecture == "mobilenet_v3_small":
+        model = models.mobilenet_v3_small(weights=models.MobileNet_V3_Small_Weights.DEFAULT if pretrained else None)
+        model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
+    elif architecture == "mobilenet_v3_large":
+        model = models.mobilenet_v3_large(weights=models.MobileNet_V3_Large_Weights.DEFAULT if pretrained else None)
+        model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
+    else:
+        raise ValueError(f"Unknown architecture: {architecture}")
+    return model
+
+def first_conv(model):
+    if hasattr(model, 'features') and hasattr(model.features, 'conv0'):
+        return model.features.conv0
+    if hasattr(model, 'conv1'):
+        return model.conv1
+    return model.features[0][0]
+
+# Lets a 3-channel ImageNet model take 1xHxW inputs in [0, 1]: a forward pre-hook on
+# the first conv broadcasts the channel to 3 and normalises it (ImageNet constants, or
+# 1- or 3-value dataset statistics). Weights and state_dict keys stay exactly those of
+# the RGB model.
+def enable_single_channel_input(model, mean=IMAGENET_MEAN, std=IMAGENET_STD):
+    mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+    std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+    def broadcast_input(module, args):
+        x = args[0]
+        if x.dim() == 4 and x.size(1) == 1:
+            return ((x.expand(-1, 3, -1, -1) - mean.to(x)) / std.to(x),)
+
+    first_conv(model).register_forward_pre_hook(broadcast_input)
+    return model
+
+# Pooled penultimate features, i.e. what DenseNet feeds into model.classifier
+def backbone_features(model, inputs):
+    features = model.features(inputs)
+    features = F.relu(features, inplace=True)
+    features = F.adaptive_avg_pool2d(features, (1, 1))
+    return torch.flatten(features, 1)
+
+# Normalisation constants a model was trained with (dataset statistics or ImageNet)
+def normalization_from_info(model_info):
+    normalization = model_info.get('normalization')
+    if normalization:
+        return normalization['mean'], normalization['std']
+    return IMAGENET_MEAN, IMAGENET_STD
+
+def checkpoint_paths(model_type, checkpoints_dir):
+    info_path = os.path.join(checkpoints_dir, f"{model_type}_model_info.json")
+    ckpt_path = os.path.join(checkpoints_dir, f"best_{model_type}_model.pth")
+    return info_path, ckpt_path
+
+def load_model_info(model_type, checkpoints_dir):
+    info_path, _ = checkpoint_paths(model_type, checkpoints_dir)
+    with open(info_path, "r") as f:
+        return json.load(f)
+
+def save_model_info(model_info, model_type, checkpoints_dir):
+    info_path, _ = checkpoint_paths(model_type, checkpoints_dir)
+    with open(info_path, "w") as f:
+        json.dump(model_info, f)
+    return info_path
+
+# Rebuild a trained model from best_<type>_model.pth and <type>_model_info.json
+def load_trained_model(model_type, checkpoints_dir):
+    info_path, ckpt_path = checkpoint_paths(model_type, checkpoints_dir)
+    if not os.path.exists(info_path) or not os.path.exists(ckpt_path):
+        raise FileNotFoundError(f"Model info or checkpoint for {model_type} not found")
+    model_info = load_model_info(model_type, checkpoints_dir)
+    model = get_model_architecture(model_type, model_info['num_classes'], pretrained=False,
+                                   architecture=model_info.get('architecture', 'densenet121'))
+    if model_info.get('input_channels', 3) == 1:
+        enable_single_channel_input(model, *normalization_from_info(model_info))
+    checkpoint = torch.load(ckpt_path, map_location=device)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    model.to(device)
+    model.eval()
+    return model, model_info
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import uuid
+import resource
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Opt-in per-request profiling for the Flask apps. A request is profiled when it carries
+# the profiling header with the configured token (PROFILE_TOKEN), or when it is the
+# N-th request with 1-in-N sampling (PROFILE_SAMPLE_EVERY). A profiled request records
+# wall-clock spans (fetch, decode, transform, forward, postprocess), a torch.profiler
+# trace when torch is installed, and its peak RSS. Each one is written as a Chrome trace
+# (chrome://tracing, Perfetto) plus a summary JSON; only the newest max_traces are kept.
+
+PROFILE_HEADER = 'X-Profile-Request'
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+def current_rss():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # No /proc (macOS): fall back to the process-lifetime peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Profiling disabled for this request: spans cost a nullcontext
+class NullProfile:
+    enabled = False
+
+    def span(self, name):
+        return nullcontext()
+
+class RequestProfile:
+    enabled = True
+
+    def __init__(self, name, out_dir, use_torch=True, rss_interval=0.005):
+        self.name = name
+        self.out_dir = out_dir
+        self.request_id = uuid.uuid4().hex[:12]
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._wall_start = time.time()
+        self._rss_start = current_rss()
+        self._rss_peak = self._rss_start
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_rss, args=(rss_interval,), daemon=True)
+        self._sampler.start()
+        self._torch_profiler = None
+        if use_torch:
+            try:
+                import torch
+                from torch.profiler import profile, ProfilerActivity
+                activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+                self._torch_profiler = profile(activities=activities, profile_memory=True)
+                self._torch_profiler.__enter__()
+            except ImportError:
+                self._torch_profiler = None
+
+    def _sample_rss(self, interval):
+        while not self._stop.wait(interval):
+            self._rss_peak = max(self._rss_peak, current_rss())
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start - self._origin, time.perf_counter() - start))
+
+    def finish(self, status=None):
+        self._stop.set()
+        self._sampler.join()
+        self._rss_peak = max(self._rss_peak, current_rss())
+        total = time.perf_counter() - self._origin
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self._wall_start))
+        base = os.path.join(self.out_dir, f"{stamp}_{self.name}_{self.request_id}")
+
+        events = []
+        if self._torch_profiler is not None:
+            self._torch_profiler.__exit__(None, None, None)
+            torch_trace = base + '.torch.json'
+            self._torch_profiler.export_chrome_trace(torch_trace)
+            with open(torch_trace, 'r') as f:
+                events = json.load(f).get('traceEvents', [])
+            os.remove(torch_trace)
+        # Spans go on their own track in Unix-epoch microseconds, the clock recent torch
+        # profiler traces use, so both line up in the viewer
+        pid, tid, origin_us = os.getpid(), 0, self._wall_start * 1e6
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': 'request spans'}})
+        events.append({'name': self.name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': origin_us, 'dur': total * 1e6})
+        for name, start, duration in self.spans:
+            events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': origin_us + start * 1e6,
+                           'dur': duration * 1e6})
+        with open(base + '.trace.json', 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+        summary = {
+            'request_id': self.request_id,
+            'name': self.name,
+            'started': self._wall_start,
+            'status': status,
+            'total_ms': total * 1000,
+            'spans_ms': {name: duration * 1000 for name, _, duration in self.spans},
+            'rss_start_bytes': self._rss_start,
+            'rss_peak_bytes': self._rss_peak,
+            'rss_high_water_delta_bytes': self._rss_peak - self._rss_start,
+        }
+        with open(base + '.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+class RequestProfiler:
+    def __init__(self, out_dir=None, sample_every=None, token=None, max_traces=None, use_torch=True):
+        self.out_dir = out_dir or os.environ.get('PROFILE_DIR', 'request_profiles')
+        self.sample_every = sample_every if sample_every is not None else int(os.environ.get('PROFILE_SAMPLE_EVERY', 0))
+        self.token = token if token is not None else os.environ.get('PROFILE_TOKEN')
+        self.max_traces = max_traces if max_traces is not None else int(os.environ.get('PROFILE_MAX_TRACES', 50))
+        self.use_torch = use_torch
+        self._count = 0
+        self._lock = threading.Lock()
+        # torch.profiler is process-wide, so only one request at a time gets a torch trace
+        self._torch_busy = threading.Lock()
+
+    # Header trigger only counts with a configured token, so anonymous callers can't
+    # switch on the (expensive) profiler
+    def should_profile(self, headers):
+        requested = headers.get(PROFILE_HEADER) if headers is not None else None
+        if requested and self.token and requested == self.token:
+            return True
+        if self.sample_every and self.sample_every > 0:
+            with self._lock:
+                self._count += 1
+                return self._count % self.sample_every == 0
+        return False
+
+    @contextmanager
+    def request(self, name, headers=None):
+        if not self.should_profile(headers):
+            yield NullProfile()
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        use_torch = self.use_torch and self._torch_busy.acquire(blocking=False)
+        profile = RequestProfile(name, self.out_dir, use_torch=use_torch)
+        status = 'ok'
+        try:
+            yield profile
+        except Exception as e:
+            status = f'error: {e}'
+            raise
+        finally:
+            summary = profile.finish(status)
+            if use_torch:
+                self._torch_busy.release()
+            self._enforce_retention()
+            print(f"Profiled {name} {summary['request_id']}: {summary['total_ms']:.1f} ms, "
+                  f"peak RSS {summary['rss_peak_bytes'] / 2**20:.0f} MiB -> {self.out_dir}")
+
+    # Newest max_traces requests are kept (file names start with a timestamp)
+    def _enforce_retention(self):
+        with self._lock:
+            summaries = sorted(f for f in os.listdir(self.out_dir)
+                               if f.endswith('.json') and not f.endswith(('.trace.json', '.torch.json')))
+            for old in summaries[:max(0, len(summaries) - self.max_traces)]:
+                base = os.path.join(self.out_dir, old[:-len('.json')])
+                for path in (base + '.json', base + '.trace.json'):
+                    if os.path.exists(path):
+                        os.remove(path)
@@ -4,14 +4,19 @@ import torch.nn as nn
 import torch.optim as optim
 import torchvision.transforms as transforms
 import torchvision.models as models
-from torch.utils.data import Dataset, DataLoader
-from PIL import Image
+from torch.utils.data import DataLoader
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.metrics import confusion_matrix, classification_report
 import json
 from tqdm import tqdm
 import random
+from training_controller import TrainingController
+from throughput import ThroughputMonitor
+from evaluation import collect_logits
+from medical_datasets import MedicalImageDataset, CompositeImageDataset, scan_type_sources
+from model_utils import get_transforms as get_single_channel_transforms, enable_single_channel_input
+from dataset_stats import load_normalization, compute_paths_stats
 
 # Set random seeds for reproducibility
 torch.manual_seed(42)
@@ -26,7 +31,8 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device: {device}")
 
 # Define data transformations for chest vs brain (scan type)
-def get_transforms(model_type):
+def get_transforms(model_type, normalization=None):
+    mean, std = normalization or ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
     if model_type == "scan_type":
         return {
             'train': transforms.Compose([
@@ -35,56 +41,17 @@ def get_transforms(model_type):
                 transforms.RandomRotation(10),
                 transforms.ColorJitter(brightness=0.2, contrast=0.2),
                 transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                transforms.Normalize(mean, std)
             ]),
             'val': transforms.Compose([
                 transforms.Resize((224, 224)),
                 transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                transforms.Normalize(mean, std)
             ])
         }
     else:
         raise ValueError(f"Unexpected model type: {model_type}")
 
-# Custom Dataset class
-class MedicalImageDataset(Dataset):
-    def __init__(self, root_dir, transform=None, class_to_idx=None):
-        self.root_dir = root_dir
-        self.transform = transform
-        if class_to_idx is None:
-            self.classes = sorted(os.listdir(root_dir))
-            self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
-        else:
-            self.class_to_idx = class_to_idx
-            self.classes = list(class_to_idx.keys())
-        self.samples = self._make_dataset()
-    
-    def _make_dataset(self):
-        samples = []
-        for class_name in self.classes:
-            class_dir = os.path.join(self.root_dir, class_name)
-            if not os.path.isdir(class_dir):
-                continue
-            for image_name in os.listdir(class_dir):
-                if image_name.lower().endswith(('.jpg', '.jpeg', '.png', '.dcm')):
-                    image_path = os.path.join(class_dir, image_name)
-                    samples.append((image_path, self.class_to_idx[class_name]))
-        return samples
-    
-    def __len__(self):
-        return len(self.samples)
-    
-    def __getitem__(self, idx):
-        image_path, label = self.samples[idx]
-        try:
-            image = Image.open(image_path).convert('RGB')
-        except Exception as e:
-            print(f"Error loading image {image_path}: {e}. Using placeholder image.")
-            image = Image.new('RGB', (224, 224), color='gray')
-        if self.transform:
-            image = self.transform(image)
-        return image, label
-
 # Define model (using pre-trained DenseNet121)
 def get_model(model_type, num_classes=2):
     if model_type == "scan_type":
@@ -99,15 +66,20 @@ def get_model(model_type, num_classes=2):
         raise ValueError(f"Unknown model type: {model_type}")
 
 # Training function
-def train_model(model, dataloaders, criterion, optimizer, scheduler, num_epochs=15, model_type="scan_type", checkpoints_dir='checkpoints'):
+def train_model(model, dataloaders, criterion, optimizer, scheduler, num_epochs=15, model_type="scan_type", checkpoints_dir='checkpoints', controller=None, monitor=None):
     os.makedirs(checkpoints_dir, exist_ok=True)
     best_model_path = os.path.join(checkpoints_dir, f'best_{model_type}_model.pth')
     best_acc = 0.0
     history = {'train_loss': [], 'val_loss': [], 'train_acc': [], 'val_acc': []}
+    if controller is None:
+        controller = TrainingController(scheduler, num_epochs)
+    if monitor is None:
+        monitor = ThroughputMonitor(os.path.join(checkpoints_dir, f'{model_type}_throughput.jsonl'))
     
     for epoch in range(num_epochs):
         print(f'Epoch {epoch+1}/{num_epochs}')
         print('-' * 10)
+        controller.start_epoch()
         
         for phase in ['train', 'val']:
             if phase == 'train':
@@ -117,31 +89,40 @@ def train_model(model, dataloaders, criterion, optimizer, scheduler, num_epochs=
             
             running_loss = 0.0
             running_corrects = 0
+            running_total = 0
             
-            pbar = tqdm(dataloaders[phase], desc=f'{phase.capitalize()} Epoch {epoch+1}/{num_epochs}')
+            pbar = tqdm(monitor.iterate(dataloaders[phase], epoch, phase), total=len(dataloaders[phase]),
+                        desc=f'{phase.capitalize()} Epoch {epoch+1}/{num_epochs}')
             for inputs, labels in pbar:
                 inputs = inputs.to(device)
                 labels = labels.to(device)
+                monitor.mark('h2d')
                 optimizer.zero_grad()
+                monitor.mark('optimizer')
                 
                 with torch.set_grad_enabled(phase == 'train'):
                     outputs = model(inputs)
                     _, preds = torch.max(outputs, 1)
                     loss = criterion(outputs, labels)
+                    monitor.mark('forward')
                     
                     if phase == 'train':
                         loss.backward()
+                        monitor.mark('backward')
                         optimizer.step()
+                        monitor.mark('optimizer')
                 
                 running_loss += loss.item() * inputs.size(0)
                 running_corrects += torch.sum(preds == labels.data)
+                running_total += inputs.size(0)
                 pbar.set_postfix({'loss': loss.item(), 'acc': torch.sum(preds == labels.data).item()/inputs.size(0)})
+                
+                if phase == 'train' and controller.after_train_step(model, criterion):
+                    print('Early stopping triggered mid-epoch')
+                    break
             
-            if phase == 'train' and scheduler is not None:
-                scheduler.step()
-            
-            epoch_loss = running_loss / len(dataloaders[phase].dataset)
-            epoch_acc = running_corrects.double() / len(dataloaders[phase].dataset)
+            epoch_loss = running_loss / running_total
+            epoch_acc = running_corrects.double() / running_total
             
             history[f'{phase}_loss'].append(epoch_loss)
             history[f'{phase}_acc'].append(epoch_acc.item())
@@ -158,8 +139,18 @@ def train_model(model, dataloaders, criterion, optimizer, scheduler, num_epochs=
                     'class_to_idx': dataloaders['train'].dataset.class_to_idx
                 }, best_model_path)
                 print(f'Saved model with acc {best_acc:.4f} to {best_model_path}')
+            
+            if phase == 'val':
+                controller.end_epoch(epoch_loss)
+        
+        if controller.should_stop:
+            print(f'Early stopping after epoch {epoch+1}: no val loss improvement for {controller.patience} checks')
+            break
     
     print(f'Best val Acc: {best_acc:.4f}')
+    controller.report(os.path.join(checkpoints_dir, f'{model_type}_training_summary.json'))
+    monitor.summary(os.path.join(checkpoints_dir, f'{model_type}_throughput_summary.json'))
+    monitor.close()
     
     # Plot and save training history
     plt.figure(figsize=(12, 4))
@@ -185,27 +176,12 @@ def train_model(model, dataloaders, criterion, optimizer, scheduler, num_epochs=
 
 # Evaluation function
 def evaluate_model(model, dataloader, criterion):
-    model.eval()
-    running_loss = 0.0
-    running_corrects = 0
-    all_preds = []
-    all_labels = []
-    
-    with torch.no_grad():
-        for inputs, labels in tqdm(dataloader, desc='Evaluating'):
-            inputs = inputs.to(device)
-            labels = labels.to(device)
-            outputs = model(inputs)
-            _, preds = torch.max(outputs, 1)
-            loss = criterion(outputs, labels)
-            
-            running_loss += loss.item() * inputs.size(0)
-            running_corrects += torch.sum(preds == labels.data)
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-    
-    test_loss = running_loss / len(dataloader.dataset)
-    test_acc = running_corrects.double() / len(dataloader.dataset)
+    num_classes = len(dataloader.dataset.class_to_idx)
+    logits, labels = collect_logits(model, dataloader, num_classes)
+    test_loss = criterion(logits, labels).item()
+    test_acc = (logits.argmax(1) == labels).double().mean()
+    all_preds = logits.argmax(1).numpy()
+    all_labels = labels.numpy()
     
     print(f'Test Loss: {test_loss:.4f} Acc: {test_acc:.4f}')
     cm = confusion_matrix(all_labels, all_preds)
@@ -218,17 +194,45 @@ def evaluate_model(model, dataloader, criterion):
     return test_acc, cm, all_preds, all_labels
 
 # End-to-end train and evaluate pipeline
-def train_and_evaluate(data_dir, model_type, num_epochs=15, batch_size=32, learning_rate=0.0005, checkpoints_dir='checkpoints'):
+def train_and_evaluate(data_dir, model_type, num_epochs=15, batch_size=32, learning_rate=0.0005, checkpoints_dir='checkpoints',
+                       patience=5, val_every_steps=None, val_subsample=None, single_channel=False,
+                       dataset_normalization=False, composite=False, source_ratios=None):
     print(f"\n{'='*50}\nTraining {model_type.upper()} model (Chest vs. Brain)\n{'='*50}")
     
-    transforms_dict = get_transforms(model_type)
     train_data_dir = os.path.join(data_dir, model_type, 'train')
     val_data_dir   = os.path.join(data_dir, model_type, 'val')
     test_data_dir  = os.path.join(data_dir, model_type, 'test')
     
-    train_dataset = MedicalImageDataset(train_data_dir, transform=transforms_dict['train'])
-    val_dataset   = MedicalImageDataset(val_data_dir, transform=transforms_dict['val'], class_to_idx=train_dataset.class_to_idx)
-    test_dataset  = MedicalImageDataset(test_data_dir, transform=transforms_dict['val'], class_to_idx=train_dataset.class_to_idx)
+    # Datasets first (transforms are set below), so dataset_normalization can use the real training images
+    if composite:
+        # Chest vs brain built from the chest and brain manifests, no scan_type copy on disk
+        sources = scan_type_sources(data_dir)
+        train_dataset = CompositeImageDataset(sources, 'train', ratios=source_ratios, single_channel=single_channel)
+        val_dataset   = CompositeImageDataset(sources, 'val', ratios=source_ratios, single_channel=single_channel)
+        test_dataset  = CompositeImageDataset(sources, 'test', ratios=source_ratios, single_channel=single_channel)
+    else:
+        train_dataset = MedicalImageDataset(train_data_dir, single_channel=single_channel)
+        val_dataset   = MedicalImageDataset(val_data_dir, class_to_idx=train_dataset.class_to_idx, single_channel=single_channel)
+        test_dataset  = MedicalImageDataset(test_data_dir, class_to_idx=train_dataset.class_to_idx, single_channel=single_channel)
+    
+    # dataset_normalization swaps the ImageNet mean/std for the training split's statistics
+    normalization = None
+    if dataset_normalization and composite:
+        # There is no scan_type/train folder: statistics of the composite training images, cached with the checkpoints
+        os.makedirs(checkpoints_dir, exist_ok=True)
+        stats_path = os.path.join(checkpoints_dir, f"{model_type}_composite{'.gray' if single_channel else ''}.stats.json")
+        stats = compute_paths_stats(list(train_dataset.paths()), stats_path, single_channel=single_channel)
+        normalization = stats['mean'], stats['std']
+    elif dataset_normalization:
+        normalization = load_normalization(train_data_dir, single_channel=single_channel)
+    # single_channel keeps grayscale/16-bit scans as one float channel until the model's first conv
+    if single_channel:
+        transforms_dict = get_single_channel_transforms(model_type, single_channel=True, normalization=normalization)
+    else:
+        transforms_dict = get_transforms(model_type, normalization=normalization)
+    train_dataset.transform = transforms_dict['train']
+    val_dataset.transform = transforms_dict['val']
+    test_dataset.transform = transforms_dict['val']
     
     print(f"Classes: {train_dataset.classes}")
     print(f"Training samples: {len(train_dataset)}")
@@ -239,17 +243,25 @@ def train_and_evaluate(data_dir, model_type, num_epochs=15, batch_size=32, learn
         'train': DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4, pin_memory=True),
         'val': DataLoader(val_dataset, batch_size=batch_size, shuffle=False, num_workers=4, pin_memory=True)
     }
+    # Decode/transform time per sample for the throughput summary
+    train_dataset.enable_timing(dataloaders['train'].num_workers)
     test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=4, pin_memory=True)
     
     num_classes = len(train_dataset.classes)
     model = get_model(model_type, num_classes=num_classes).to(device)
+    if single_channel:
+        enable_single_channel_input(model, *(normalization or ()))
     
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-5)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=3, factor=0.1, verbose=True)
+    controller = TrainingController(scheduler, num_epochs, patience=patience, val_loader=dataloaders['val'],
+                                    val_every_steps=val_every_steps, val_subsample=val_subsample,
+                                    cpu_cores=torch.get_num_threads() + dataloaders['train'].num_workers)
     
     history, best_model_path = train_model(model, dataloaders, criterion, optimizer, scheduler,
-                                             num_epochs=num_epochs, model_type=model_type, checkpoints_dir=checkpoints_dir)
+                                             num_epochs=num_epochs, model_type=model_type, checkpoints_dir=checkpoints_dir,
+                                             controller=controller)
     
     # Load the best model
     checkpoint = torch.load(best_model_path)
@@ -266,6 +278,10 @@ def train_and_evaluate(data_dir, model_type, num_epochs=15, batch_size=32, learn
         'best_acc': checkpoint['acc'],
         'best_epoch': checkpoint['epoch'],
     }
+    if single_channel:
+        model_info['input_channels'] = 1
+    if normalization:
+        model_info['normalization'] = {'mean': list(normalization[0]), 'std': list(normalization[1])}
     
     with open(os.path.join(checkpoints_dir, f"{model_type}_model_info.json"), 'w') as f:
         json.dump(model_info, f)
@@ -297,14 +313,20 @@ def main():
     checkpoints_dir = "model_checkpoints"
     os.makedirs(checkpoints_dir, exist_ok=True)
     model_type = "scan_type"
-    config = {'epochs': 15, 'batch_size': 32, 'lr': 0.0005}
+    config = {'epochs': 15, 'batch_size': 32, 'lr': 0.0005, 'patience': 5, 'single_channel': False, 'dataset_normalization': False,
+              'composite': False, 'source_ratios': None}
     
     model_info = train_and_evaluate(data_dir=data_dir,
                                     model_type=model_type,
                                     num_epochs=config['epochs'],
                                     batch_size=config['batch_size'],
                                     learning_rate=config['lr'],
-                                    checkpoints_dir=checkpoints_dir)
+                                    checkpoints_dir=checkpoints_dir,
+                                    patience=config['patience'],
+                                    single_channel=config['single_channel'],
+                                    dataset_normalization=config['dataset_normalization'],
+                                    composite=config['composite'],
+                                    source_ratios=config['source_ratios'])
     print("\nChest vs. Brain training complete!")
     print("Model summary:")
     print(f"  Classes: {model_info['classes']}")
@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+# Serving-process settings written by autotune.py (serving_config.json): torch intra-
+# and inter-op thread counts, gunicorn worker count, and per-model micro-batching.
+
+DEFAULT_CONFIG_PATH = "serving_config.json"
+
+def load_serving_config(path=None):
+    path = path or os.environ.get("SERVING_CONFIG", DEFAULT_CONFIG_PATH)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+# Must run before the first forward pass: inter-op threads can only be set once per process
+def apply_thread_settings(config):
+    import torch
+    if config.get("torch_threads"):
+        torch.set_num_threads(int(config["torch_threads"]))
+    if config.get("interop_threads"):
+        try:
+            torch.set_num_interop_threads(int(config["interop_threads"]))
+        except RuntimeError as e:
+            print(f"Could not set inter-op threads: {e}")
+
+# Groups concurrent single-image requests into one forward pass. Requests wait at most
+# max_wait_ms for others to arrive; a batch runs as soon as max_batch_size is reached.
+# Requests that also want the pooled backbone features (DenseNet, for the embedding
+# index) get them from the same batched pass.
+class MicroBatcher:
+    def __init__(self, model, max_batch_size=8, max_wait_ms=5.0):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # inputs: (1, C, H, W) on the model's device -> (1, num_classes) logits, or
+    # (logits, (1, F) features) with return_features=True
+    def infer(self, inputs, return_features=False):
+        future = Future()
+        self._queue.put((inputs, return_features, future))
+        return future.result()
+
+    def _run(self):
+        import torch
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while len(batch) < self.max_batch_size:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+            # Different input shapes (e.g. 1- and 3-channel) can't share a batch
+            groups = {}
+            for inputs, return_features, future in batch:
+                groups.setdefault(tuple(inputs.shape[1:]), []).append((inputs, return_features, future))
+            for items in groups.values():
+                try:
+                    with torch.no_grad():
+                        inputs = torch.cat([inputs for inputs, _, _ in items])
+                        if any(return_features for _, return_features, _ in items):
+                            # Same computation as self.model(inputs), keeping the pooled features
+                            from model_utils import backbone_features
+                            features = backbone_features(self.model, inputs)
+                            outputs = self.model.classifier(features)
+                        else:
+                            outputs = self.model(inputs)
+                    for i, (_, return_features, future) in enumerate(items):
+                        future.set_result((outputs[i:i + 1], features[i:i + 1]) if return_features
+                                          else outputs[i:i + 1])
+                except Exception as e:
+                    for _, _, future in items:
+                        future.set_exception(e)
@@ -0,0 +1,181 @@
+import os
+import io
+import json
+import random
+import tarfile
+import argparse
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from manifest import build_manifest
+from image_io import load_rgb
+
+# Sequential tar-shard dataset format. The packer writes any class-folder dataset
+# (brain, chest or scan_type layout) or a chest split CSV into fixed-size tar shards of
+# "<key>.<ext>" image + "<key>.cls" label pairs plus an index.json. ShardedImageDataset
+# then reads whole shards sequentially, which avoids per-file open/seek latency on
+# network storage.
+#
+#   python shards.py medical_images/brain/train shards/brain/train
+#   python shards.py chest/train_set.csv shards/chest/train
+
+INDEX_NAME = 'index.json'
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0
+    tar.addfile(info, io.BytesIO(data))
+
+# Samples are shuffled once at pack time so every shard mixes classes
+def pack_shards(samples, class_to_idx, out_dir, max_shard_bytes=256 * 1024 * 1024, max_shard_samples=10000, seed=42):
+    os.makedirs(out_dir, exist_ok=True)
+    samples = list(samples)
+    random.Random(seed).shuffle(samples)
+    shards = []
+    tar, shard_bytes, shard_samples = None, 0, 0
+
+    def close_shard():
+        if tar is not None:
+            tar.close()
+            shards.append({'name': os.path.basename(tar.name), 'num_samples': shard_samples, 'bytes': shard_bytes})
+
+    for key, (path, label) in enumerate(samples):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if tar is None or shard_bytes + len(data) > max_shard_bytes or shard_samples >= max_shard_samples:
+            close_shard()
+            tar = tarfile.open(os.path.join(out_dir, f"shard-{len(shards):06d}.tar"), 'w')
+            shard_bytes, shard_samples = 0, 0
+        ext = os.path.splitext(path)[1].lower() or '.img'
+        _add_bytes(tar, f"{key:09d}{ext}", data)
+        _add_bytes(tar, f"{key:09d}.cls", str(label).encode())
+        shard_bytes += len(data)
+        shard_samples += 1
+    close_shard()
+
+    index = {'class_to_idx': class_to_idx, 'num_samples': len(samples), 'shards': shards}
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f, indent=2)
+    print(f"Packed {len(samples)} images into {len(shards)} shards in {out_dir}")
+    return index
+
+def pack_source(source, out_dir, **kwargs):
+    if source.lower().endswith('.csv'):
+        import pandas as pd
+        df = pd.read_csv(source)
+        if 'class' in df.columns:
+            class_to_idx = dict(sorted(set(zip(df['class'], df['class_id'].astype(int))), key=lambda kv: kv[1]))
+        else:
+            class_to_idx = {str(i): i for i in sorted(df['class_id'].astype(int).unique())}
+        samples = list(zip(df['path'], df['class_id'].astype(int)))
+    else:
+        manifest = build_manifest(source)
+        class_to_idx = manifest.class_to_idx
+        samples = manifest.samples()
+    return pack_shards(samples, class_to_idx, out_dir, **kwargs)
+
+# Streams shards sequentially. Shuffling is a per-epoch shuffle of the shard order plus
+# an in-memory shuffle buffer of still-encoded samples. Shards are split across
+# distributed ranks and DataLoader workers, so every sample is read once per epoch as
+# long as there are at least world_size * num_workers shards.
+class ShardedImageDataset(IterableDataset):
+    def __init__(self, shard_dir, transform=None, shuffle=True, buffer_size=1000, seed=42, rank=None, world_size=None):
+        with open(os.path.join(shard_dir, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+        self.shard_dir = shard_dir
+        self.shards = [s['name'] for s in index['shards']]
+        self.class_to_idx = index['class_to_idx']
+        self.classes = list(self.class_to_idx.keys())
+        self.num_samples = index['num_samples']
+        self.transform = transform
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _rank_and_world(self):
+        if self.rank is not None and self.world_size is not None:
+            return self.rank, self.world_size
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def __len__(self):
+        _, world_size = self._rank_and_world()
+        return self.num_samples // world_size
+
+    def _assigned_shards(self):
+        rank, world_size = self._rank_and_world()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        shards = list(self.shards)
+        if self.shuffle:
+            # Same seed on every rank and worker, so they agree on the order before slicing
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        slot = rank * num_workers + worker_id
+        return shards[slot::world_size * num_workers], slot
+
+    def _stream_shard(self, name):
+        pending_key, pending = None, {}
+        with tarfile.open(os.path.join(self.shard_dir, name), mode='r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, ext = os.path.splitext(member.name)
+                if key != pending_key and pending:
+                    yield pending
+                    pending = {}
+                pending_key = key
+                pending[ext] = tar.extractfile(member).read()
+        if pending:
+            yield pending
+
+    def _decode(self, sample):
+        label = int(sample.pop('.cls'))
+        data = next(iter(sample.values()))
+        image = load_rgb(io.BytesIO(data))
+        if self.transform:
+            image = self.transform(image)
+        return image, label
+
+    def __iter__(self):
+        shards, slot = self._assigned_shards()
+        rng = random.Random(self.seed + 1000003 * self.epoch + slot)
+        buffer = []
+        for name in shards:
+            for sample in self._stream_shard(name):
+                if not self.shuffle:
+                    yield self._decode(sample)
+                    continue
+                if len(buffer) < self.buffer_size:
+                    buffer.append(sample)
+                    continue
+                i = rng.randrange(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                yield self._decode(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._decode(sample)
+
+def shard_dataloader(shard_dir, transform=None, batch_size=32, num_workers=4, shuffle=True, buffer_size=1000):
+    dataset = ShardedImageDataset(shard_dir, transform=transform, shuffle=shuffle, buffer_size=buffer_size)
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=torch.cuda.is_available())
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a class-folder dataset or split CSV into tar shards")
+    parser.add_argument('source', help="Class-folder directory (e.g. medical_images/brain/train) or CSV with path/class_id")
+    parser.add_argument('out_dir')
+    parser.add_argument('--max-shard-mb', type=int, default=256)
+    parser.add_argument('--max-shard-samples', type=int, default=10000)
+    args = parser.parse_args()
+    pack_source(args.source, args.out_dir, max_shard_bytes=args.max_shard_mb * 1024 * 1024,
+                max_shard_samples=args.max_shard_samples)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import os
+import csv
+import json
+import time
+import random
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from model_utils import get_transforms, get_model_architecture
+from manifest import build_manifest
+from decoded_cache import build_decoded_cache, DecodedImageDataset
+from training_controller import TrainingController, run_epoch
+
+# Hyperparameter sweep: runs trials concurrently in a process pool with the CPU cores
+# partitioned between them. Every trial reads the same decoded-image cache, and a
+# median pruner stops trials whose validation accuracy falls behind.
+#
+#   python sweep.py --model-type brain --grid lr=0.0001,0.0003,0.001 batch_size=16,32 epochs=10
+#   python sweep.py --model-type chest --random 8 lr=loguniform:1e-5:1e-3 batch_size=choice:16,32,64
+
+INT_PARAMS = {'epochs', 'batch_size', 'patience'}
+DEFAULT_PARAMS = {'epochs': 20, 'batch_size': 32, 'lr': 0.0003, 'patience': 5}
+# Trials share the host's CPU cores (partition_cores), so they always train on CPU
+TRIAL_DEVICE = torch.device('cpu')
+
+def _check_param(name):
+    if name not in DEFAULT_PARAMS:
+        raise ValueError(f"Unknown sweep parameter '{name}'; expected one of {', '.join(DEFAULT_PARAMS)}")
+
+def _cast(name, value):
+    return int(value) if name in INT_PARAMS else float(value)
+
+# "lr=0.0001,0.0003" -> {'lr': [0.0001, 0.0003]}
+def parse_grid(specs):
+    space = {}
+    for spec in specs:
+        name, values = spec.split('=', 1)
+        _check_param(name)
+        space[name] = [_cast(name, v) for v in values.split(',')]
+    return space
+
+def grid_trials(space):
+    names = list(space.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+# "lr=loguniform:1e-5:1e-3", "epochs=int:5:20", "batch_size=choice:16,32"
+def random_trials(specs, num_trials, seed=42):
+    rng = random.Random(seed)
+    parsed = []
+    for spec in specs:
+        name, dist = spec.split('=', 1)
+        _check_param(name)
+        kind, args = dist.split(':', 1)
+        parsed.append((name, kind, args))
+    trials = []
+    for _ in range(num_trials):
+        params = {}
+        for name, kind, args in parsed:
+            if kind == 'choice':
+                params[name] = _cast(name, rng.choice(args.split(',')))
+            elif kind == 'uniform':
+                low, high = map(float, args.split(':'))
+                params[name] = _cast(name, rng.uniform(low, high))
+            elif kind == 'loguniform':
+                low, high = map(float, args.split(':'))
+                params[name] = _cast(name, float(np.exp(rng.uniform(np.log(low), np.log(high)))))
+            elif kind == 'int':
+                low, high = map(int, args.split(':'))
+                params[name] = rng.randint(low, high)
+            else:
+                raise ValueError(f"Unknown distribution '{kind}' for {name}")
+        trials.append(params)
+    return trials
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Split the host's cores evenly between concurrently running processes
+def partition_cores(num_parallel, total_cores=None):
+    total_cores = total_cores or available_cores()
+    num_parallel = max(1, min(num_parallel, total_cores))
+    return num_parallel, max(1, total_cores // num_parallel)
+
+def init_worker_threads(num_threads):
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+# Prunes a trial whose accuracy at an epoch is below the median other trials reported there
+class MedianPruner:
+    def __init__(self, manager, warmup_epochs=2, min_reports=3):
+        self.reports = manager.dict()
+        self.lock = manager.Lock()
+        self.warmup_epochs = warmup_epochs
+        self.min_reports = min_reports
+
+    def report(self, epoch, value):
+        with self.lock:
+            previous = list(self.reports.get(epoch, []))
+            self.reports[epoch] = previous + [value]
+        if epoch < self.warmup_epochs or len(previous) < self.min_reports:
+            return False
+        return value < float(np.median(previous))
+
+def run_trial(trial_id, model_type, params, cache_prefixes, out_dir, pruner):
+    params = {**DEFAULT_PARAMS, **params}
+    torch.manual_seed(42 + trial_id)
+    transforms_dict = get_transforms(model_type)
+    train_dataset = DecodedImageDataset(cache_prefixes['train'], transform=transforms_dict['train'])
+    val_dataset = DecodedImageDataset(cache_prefixes['val'], transform=transforms_dict['val'])
+    # Cores are partitioned by thread count, so data loading stays in-process
+    train_loader = DataLoader(train_dataset, batch_size=params['batch_size'], shuffle=True, num_workers=0)
+    val_loader = DataLoader(val_dataset, batch_size=params['batch_size'], shuffle=False, num_workers=0)
+
+    model = get_model_architecture(model_type, len(train_dataset.classes)).to(TRIAL_DEVICE)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=params['lr'], weight_decay=1e-5)
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=3, factor=0.1)
+    controller = TrainingController(scheduler, params['epochs'], patience=params['patience'],
+                                    cpu_cores=torch.get_num_threads())
+
+    trial_dir = os.path.join(out_dir, f"trial_{trial_id:03d}")
+    os.makedirs(trial_dir, exist_ok=True)
+    start = time.perf_counter()
+    status = 'complete'
+    best_acc, best_epoch = 0.0, -1
+    history = []
+    for epoch in range(params['epochs']):
+        controller.start_epoch()
+        train_loss, train_acc, _ = run_epoch(model, train_loader, criterion, optimizer, run_device=TRIAL_DEVICE)
+        val_loss, val_acc, _ = run_epoch(model, val_loader, criterion, run_device=TRIAL_DEVICE)
+        history.append({'epoch': epoch, 'train_loss': train_loss, 'train_acc': train_acc,
+                        'val_loss': val_loss, 'val_acc': val_acc})
+        if val_acc > best_acc:
+            best_acc, best_epoch = val_acc, epoch
+            torch.save({
+                'model_state_dict': model.state_dict(),
+                'acc': best_acc,
+                'epoch': epoch,
+                'class_to_idx': train_dataset.class_to_idx
+            }, os.path.join(trial_dir, f'best_{model_type}_model.pth'))
+        if pruner is not None and pruner.report(epoch, val_acc):
+            status = 'pruned'
+            break
+        if controller.end_epoch(val_loss):
+            status = 'early_stopped'
+            break
+    result = {
+        'trial': trial_id,
+        'params': params,
+        'status': status,
+        'epochs_run': len(history),
+        'best_val_acc': best_acc,
+        'best_epoch': best_epoch,
+        'wall_seconds': time.perf_counter() - start,
+        'history': history,
+    }
+    with open(os.path.join(trial_dir, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+# Decode each split once; trials only ever read the shared cache
+def prepare_shared_dataset(data_dir, model_type, cache_dir, num_workers=None):
+    train_manifest = build_manifest(os.path.join(data_dir, model_type, 'train'))
+    class_to_idx = train_manifest.class_to_idx
+    val_manifest = build_manifest(os.path.join(data_dir, model_type, 'val'))
+    prefixes = {}
+    for split, manifest in [('train', train_manifest), ('val', val_manifest)]:
+        prefixes[split] = build_decoded_cache(manifest.samples(class_to_idx), class_to_idx,
+                                              os.path.join(cache_dir, f"{model_type}_{split}"), num_workers=num_workers)
+    return prefixes
+
+def write_results_table(results, out_dir):
+    results = sorted(results, key=lambda r: r['best_val_acc'], reverse=True)
+    param_names = sorted({name for r in results for name in r['params']})
+    header = ['trial'] + param_names + ['status', 'epochs_run', 'best_val_acc', 'best_epoch', 'wall_seconds']
+    rows = [[r['trial']] + [r['params'].get(n) for n in param_names] +
+            [r['status'], r['epochs_run'], f"{r['best_val_acc']:.4f}", r['best_epoch'] + 1, f"{r['wall_seconds']:.1f}"]
+            for r in results]
+    csv_path = os.path.join(out_dir, 'sweep_results.csv')
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    widths = [max(len(str(x)) for x in [h] + [row[i] for row in rows]) for i, h in enumerate(header)]
+    print('  '.join(str(h).ljust(w) for h, w in zip(header, widths)))
+    for row in rows:
+        print('  '.join(str(x).ljust(w) for x, w in zip(row, widths)))
+    print(f"\nResults written to {csv_path}")
+    return csv_path
+
+def run_sweep(model_type, trials, data_dir='medical_images', out_dir='sweeps', cache_dir='decoded_cache',
+              parallel=2, prune=True, warmup_epochs=2):
+    for params in trials:
+        for name in params:
+            _check_param(name)
+    out_dir = os.path.join(out_dir, model_type)
+    os.makedirs(out_dir, exist_ok=True)
+    cache_prefixes = prepare_shared_dataset(data_dir, model_type, cache_dir)
+    # Fetch the ImageNet weights once so trials don't race on the download
+    get_model_architecture(model_type, 2)
+
+    parallel, threads = partition_cores(parallel)
+    print(f"Running {len(trials)} trials, {parallel} at a time with {threads} threads each")
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with context.Manager() as manager:
+        pruner = MedianPruner(manager, warmup_epochs=warmup_epochs) if prune else None
+        with ProcessPoolExecutor(max_workers=parallel, mp_context=context,
+                                 initializer=init_worker_threads, initargs=(threads,)) as executor:
+            futures = {executor.submit(run_trial, i, model_type, params, cache_prefixes, out_dir, pruner): i
+                       for i, params in enumerate(trials)}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    trial_id = futures[future]
+                    result = {'trial': trial_id, 'params': trials[trial_id], 'status': f'failed: {e}',
+                              'epochs_run': 0, 'best_val_acc': 0.0, 'best_epoch': -1, 'wall_seconds': 0.0}
+                print(f"Trial {result['trial']} {result['status']}: best val acc {result['best_val_acc']:.4f}")
+                results.append(result)
+    write_results_table(results, out_dir)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter sweep over epochs, batch_size and lr")
+    parser.add_argument('--model-type', required=True, choices=['chest', 'brain', 'scan_type'])
+    parser.add_argument('--data-dir', default='medical_images')
+    parser.add_argument('--out-dir', default='sweeps')
+    parser.add_argument('--cache-dir', default='decoded_cache')
+    parser.add_argument('--grid', nargs='+', help="Grid values, e.g. lr=0.0001,0.0003 batch_size=16,32")
+    parser.add_argument('--random', type=int, metavar='N', help="Sample N random trials from the space given as positional specs")
+    parser.add_argument('space', nargs='*', help="Random search space, e.g. lr=loguniform:1e-5:1e-3")
+    parser.add_argument('--parallel', type=int, default=2, help="Trials run concurrently")
+    parser.add_argument('--no-prune', action='store_true')
+    parser.add_argument('--warmup-epochs', type=int, default=2)
+    args = parser.parse_args()
+
+    if args.grid:
+        trials = grid_trials(parse_grid(args.grid))
+    elif args.random:
+        trials = random_trials(args.space, args.random)
+    else:
+        parser.error("Provide --grid or --random N with a search space")
+    run_sweep(args.model_type, trials, data_dir=args.data_dir, out_dir=args.out_dir, cache_dir=args.cache_dir,
+              parallel=args.parallel, prune=not args.no_prune, warmup_epochs=args.warmup_epochs)
+
+if __name__ == "__main__":
+    main()
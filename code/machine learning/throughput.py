@@ -0,0 +1,190 @@
+import json
+import time
+import threading
+import torch
+from model_utils import device
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Training throughput instrumentation. ThroughputMonitor wraps a DataLoader in the
+# training loop and splits every step into data wait, host-to-device copy, forward,
+# backward and optimizer time. A background thread samples the DataLoader's ready-batch
+# queue depth and worker CPU (CPU needs psutil). Steps and epochs go to a JSONL log and
+# summary() names the stage that bounds throughput.
+#
+#   monitor = ThroughputMonitor('brain_throughput.jsonl')
+#   for inputs, labels in monitor.iterate(loader, epoch, 'train'):
+#       inputs = inputs.to(device); monitor.mark('h2d')
+#       ...
+
+STAGES = ['data_wait', 'h2d', 'forward', 'backward', 'optimizer', 'other']
+
+class ThroughputMonitor:
+    def __init__(self, log_path, sample_interval=0.5, sync_cuda=None, log_steps=True):
+        self.log_path = log_path
+        self.sample_interval = sample_interval
+        # Without a sync, CUDA kernels are only launched, and their time would land on
+        # whichever later stage first blocks on them
+        self.sync_cuda = torch.cuda.is_available() if sync_cuda is None else sync_cuda
+        self.log_steps = log_steps
+        self.totals = {}
+        self.epochs = []
+        self._log = open(log_path, 'w')
+        self._stages = None
+        self._last = None
+        self._active = None
+
+    def _now(self):
+        if self.sync_cuda and device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _write(self, record):
+        self._log.write(json.dumps(record) + '\n')
+
+    # Time since the previous mark is charged to `stage`
+    def mark(self, stage):
+        now = self._now()
+        self._stages[stage] += now - self._last
+        self._last = now
+
+    # A loop that breaks early leaves its generator suspended; closing it here (or in
+    # summary) finishes that epoch's record before the next one starts
+    def iterate(self, dataloader, epoch, phase):
+        self._finish_active()
+        self._active = self._iterate(dataloader, epoch, phase)
+        return self._active
+
+    def _finish_active(self):
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+
+    def _iterate(self, dataloader, epoch, phase):
+        self._begin(dataloader, epoch, phase)
+        iterator = iter(dataloader)
+        self._start_sampler(iterator)
+        step = 0
+        try:
+            self._last = self._now()
+            while True:
+                self._stages = dict.fromkeys(STAGES, 0.0)
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    break
+                self.mark('data_wait')
+                yield batch
+                self._end_step(step, batch)
+                step += 1
+        finally:
+            self._stop_sampler()
+            self._end_epoch()
+
+    def _begin(self, dataloader, epoch, phase):
+        self._epoch = {'epoch': epoch, 'phase': phase, 'start': time.perf_counter(), 'images': 0, 'steps': 0,
+                       'stages': dict.fromkeys(STAGES, 0.0), 'queue_depth': [], 'worker_cpu': []}
+        self._dataset_timing = getattr(dataloader.dataset, 'timing', None)
+        self._timing_start = self._dataset_timing.sum(dim=0).clone() if self._dataset_timing is not None else None
+
+    def _end_step(self, step, batch):
+        self.mark('other')
+        batch_size = len(batch[1]) if isinstance(batch, (list, tuple)) else len(batch)
+        self._epoch['images'] += batch_size
+        self._epoch['steps'] += 1
+        for stage, seconds in self._stages.items():
+            self._epoch['stages'][stage] += seconds
+        if self.log_steps:
+            self._write({'type': 'step', 'epoch': self._epoch['epoch'], 'phase': self._epoch['phase'], 'step': step,
+                         'batch_size': batch_size, **{k: round(v, 6) for k, v in self._stages.items()}})
+
+    def _end_epoch(self):
+        epoch = self._epoch
+        wall = time.perf_counter() - epoch.pop('start')
+        depth, cpu = epoch.pop('queue_depth'), epoch.pop('worker_cpu')
+        record = {'type': 'epoch', **epoch, 'wall_seconds': wall,
+                  'images_per_sec': epoch['images'] / wall if wall > 0 else 0.0,
+                  'queue_depth_mean': sum(depth) / len(depth) if depth else None,
+                  'worker_cpu_mean': sum(cpu) / len(cpu) if cpu else None}
+        # Per-sample decode/transform seconds measured inside the dataset's workers
+        if self._dataset_timing is not None:
+            decode, transform, count = (self._dataset_timing.sum(dim=0) - self._timing_start).tolist()
+            if count:
+                record['decode_per_sample'] = decode / count
+                record['transform_per_sample'] = transform / count
+        self.epochs.append(record)
+        for stage, seconds in epoch['stages'].items():
+            key = (epoch['phase'], stage)
+            self.totals[key] = self.totals.get(key, 0.0) + seconds
+        self._write(record)
+        self._log.flush()
+        print(f"{epoch['phase'].capitalize()} throughput: {record['images_per_sec']:.1f} images/s, "
+              + ', '.join(f"{k} {v:.1f}s" for k, v in epoch['stages'].items() if v > 0))
+
+    # Ready batches in the worker result queue (a private DataLoader attribute, so
+    # guarded) and summed CPU percent of the worker processes
+    def _sample(self, iterator, stop):
+        workers = []
+        if psutil is not None:
+            for w in getattr(iterator, '_workers', []):
+                try:
+                    proc = psutil.Process(w.pid)
+                    proc.cpu_percent(None)
+                    workers.append(proc)
+                except Exception:
+                    pass
+        queue = getattr(iterator, '_data_queue', None)
+        while not stop.wait(self.sample_interval):
+            if queue is not None:
+                try:
+                    self._epoch['queue_depth'].append(queue.qsize())
+                except (NotImplementedError, AttributeError):
+                    queue = None
+            if workers:
+                try:
+                    self._epoch['worker_cpu'].append(sum(p.cpu_percent(None) for p in workers))
+                except Exception:
+                    workers = []
+
+    def _start_sampler(self, iterator):
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, args=(iterator, self._stop), daemon=True)
+        self._sampler.start()
+
+    def _stop_sampler(self):
+        self._stop.set()
+        self._sampler.join()
+
+    # Which stage dominates training steps, plus a hint for input-bound runs
+    def summary(self, path=None):
+        self._finish_active()
+        train = {stage: self.totals.get(('train', stage), 0.0) for stage in STAGES}
+        total = sum(train.values()) or 1.0
+        bottleneck = max(train, key=train.get)
+        train_epochs = [e for e in self.epochs if e['phase'] == 'train']
+        result = {
+            'bottleneck': bottleneck,
+            'stage_seconds': train,
+            'stage_share': {stage: seconds / total for stage, seconds in train.items()},
+            'train_images_per_sec': [e['images_per_sec'] for e in train_epochs],
+        }
+        if bottleneck == 'data_wait':
+            decode = [e['decode_per_sample'] for e in train_epochs if 'decode_per_sample' in e]
+            transform = [e['transform_per_sample'] for e in train_epochs if 'transform_per_sample' in e]
+            if decode and transform:
+                result['input_bottleneck'] = 'decode' if sum(decode) >= sum(transform) else 'transform'
+        self._write({'type': 'summary', **result})
+        self._log.flush()
+        print(f"Training bottleneck: {bottleneck} ({result['stage_share'][bottleneck]:.0%} of step time)"
+              + (f", mostly {result['input_bottleneck']}" if 'input_bottleneck' in result else ''))
+        if path:
+            with open(path, 'w') as f:
+                json.dump(result, f, indent=2)
+        return result
+
+    def close(self):
+        self._finish_active()
+        self._log.close()
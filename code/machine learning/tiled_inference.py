@@ -0,0 +1,103 @@
+import math
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+
+# Tiled high-resolution inference. Instead of squashing a scan to 224x224, the image is
+# resized with its aspect ratio kept (long side `long_side`), cut into overlapping
+# tile x tile crops, and all crops run through the model as one batch. Tile logits are
+# pooled into a scan-level prediction (max or attention pooling) and kept as a coarse
+# rows x cols map of where the predicted class fires. max_tiles bounds the batch: when
+# the grid would need more tiles the working resolution is lowered until it fits, so
+# latency stays close to that of one max_tiles forward pass.
+#
+#   predictor = TiledPredictor(model, mean, std, long_side=1024, max_tiles=16)
+#   result = predictor.predict(pil_image)
+
+POOLING = ['max', 'attention']
+
+# Tile start offsets along one axis: evenly spread, first at 0 and last flush with the edge
+def _starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    stride = tile * (1 - overlap)
+    count = math.ceil((length - tile) / stride) + 1
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+# (height, width) of the aspect-preserving resize and its tile offsets, shrunk until the
+# grid fits in max_tiles
+def plan_tiles(height, width, long_side=1024, tile=224, overlap=0.25, max_tiles=16):
+    scale = long_side / max(height, width)
+    while True:
+        h, w = max(tile, round(height * scale)), max(tile, round(width * scale))
+        ys, xs = _starts(h, tile, overlap), _starts(w, tile, overlap)
+        if len(ys) * len(xs) <= max_tiles or max(h, w) <= tile:
+            return (h, w), ys, xs
+        scale *= 0.9
+
+class TiledPredictor:
+    def __init__(self, model, mean, std, single_channel=False, long_side=1024, tile=224, overlap=0.25,
+                 max_tiles=16, pooling='max', attention_temperature=1.0):
+        if pooling not in POOLING:
+            raise ValueError(f"Unknown pooling: {pooling}")
+        self.model = model
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(-1, 1, 1)
+        self.single_channel = single_channel
+        self.long_side = long_side
+        self.tile = tile
+        self.overlap = overlap
+        self.max_tiles = max_tiles
+        self.pooling = pooling
+        self.attention_temperature = attention_temperature
+
+    # PIL image (RGB models) or 1xHxW float tensor from image_io (single-channel models)
+    # -> normalised (N, C, tile, tile) batch, the grid offsets and the working size
+    def tiles(self, image):
+        x = image if torch.is_tensor(image) else TF.to_tensor(image)
+        size, ys, xs = plan_tiles(x.shape[-2], x.shape[-1], self.long_side, self.tile, self.overlap, self.max_tiles)
+        x = TF.resize(x, list(size), antialias=True)
+        if not self.single_channel:
+            # Single-channel models normalise in their first-layer hook
+            x = (x - self.mean) / self.std
+        batch = torch.stack([x[:, y:y + self.tile, x0:x0 + self.tile] for y in ys for x0 in xs])
+        return batch, ys, xs, size
+
+    # Scan-level logits from (N, num_classes) tile logits. max: per-class maximum over
+    # tiles, so one confident tile decides. attention: parameter-free, tiles weighted by
+    # a softmax over their top logit, so confident tiles dominate without discarding
+    # the rest.
+    def pool(self, tile_logits, pooling=None):
+        pooling = pooling or self.pooling
+        if pooling not in POOLING:
+            raise ValueError(f"Unknown pooling: {pooling}")
+        if pooling == 'max':
+            return tile_logits.max(dim=0).values, None
+        weights = torch.softmax(tile_logits.max(dim=1).values / self.attention_temperature, dim=0)
+        return (weights.unsqueeze(1) * tile_logits).sum(dim=0), weights
+
+    def predict(self, image, device=None, temperature=1.0, pooling=None):
+        device = device or next(self.model.parameters()).device
+        pooling = pooling or self.pooling
+        batch, ys, xs, size = self.tiles(image)
+        with torch.no_grad():
+            tile_logits = self.model(batch.to(device)).float().cpu()
+        scan_logits, weights = self.pool(tile_logits, pooling)
+        probs = torch.softmax(scan_logits / temperature, dim=0)
+        pred_idx = int(probs.argmax())
+        tile_probs = F.softmax(tile_logits / temperature, dim=1)[:, pred_idx].view(len(ys), len(xs))
+        result = {
+            'logits': scan_logits,
+            'probabilities': probs,
+            'prediction_index': pred_idx,
+            'pooling': pooling,
+            'resized_to': list(size),
+            'tile_size': self.tile,
+            'tile_grid': [len(ys), len(xs)],
+            # Probability of the predicted class per tile, rows top to bottom
+            'tile_map': [[round(p, 4) for p in row] for row in tile_probs.tolist()],
+            'tile_boxes': [[x0, y, x0 + self.tile, y + self.tile] for y in ys for x0 in xs],
+        }
+        if weights is not None:
+            result['attention'] = [[round(w, 4) for w in row] for row in weights.view(len(ys), len(xs)).tolist()]
+        return result
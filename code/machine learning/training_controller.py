@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import math
+import torch
+from torch.utils.data import DataLoader, Subset
+from model_utils import device
+
+# One pass over a loader. Trains when an optimizer is given, otherwise evaluates.
+# Batches go to `run_device` (model_utils.device by default), where the model must be.
+def run_epoch(model, dataloader, criterion, optimizer=None, run_device=None):
+    run_device = run_device or device
+    training = optimizer is not None
+    model.train(training)
+    running_loss = 0.0
+    running_corrects = 0
+    total = 0
+    with torch.set_grad_enabled(training):
+        for inputs, labels in dataloader:
+            inputs = inputs.to(run_device)
+            labels = labels.to(run_device)
+            outputs = model(inputs)
+            loss = criterion(outputs, labels)
+            if training:
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            running_loss += loss.item() * inputs.size(0)
+            running_corrects += (outputs.argmax(1) == labels).sum().item()
+            total += inputs.size(0)
+    total = max(total, 1)
+    return running_loss / total, running_corrects / total, total
+
+# Fixed random subset of the validation set for cheap intra-epoch checks
+def subsample_loader(dataloader, num_samples, seed=42):
+    dataset = dataloader.dataset
+    if num_samples is None or num_samples >= len(dataset):
+        return dataloader
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:num_samples].tolist()
+    return DataLoader(Subset(dataset, indices), batch_size=dataloader.batch_size, shuffle=False,
+                      num_workers=dataloader.num_workers, pin_memory=dataloader.pin_memory)
+
+# Validation-driven training control: feeds the validation loss to the LR scheduler,
+# stops after `patience` checks without improvement and reports the time saved versus
+# running the full num_epochs schedule.
+#
+# By default one check happens per epoch on the full validation loss. With
+# val_every_steps set, a check runs every K training steps on a val_subsample-sized
+# subset instead, so very large training sets can stop in the middle of an epoch.
+class TrainingController:
+    def __init__(self, scheduler, num_epochs, patience=5, min_delta=0.0, val_loader=None,
+                 val_every_steps=None, val_subsample=None, cpu_cores=None):
+        self.scheduler = scheduler
+        self.num_epochs = num_epochs
+        self.patience = patience
+        self.min_delta = min_delta
+        self.val_every_steps = val_every_steps
+        self.quick_val_loader = None
+        if val_every_steps:
+            if val_loader is None:
+                raise ValueError("val_loader is required when val_every_steps is set")
+            self.quick_val_loader = subsample_loader(val_loader, val_subsample)
+        self.cpu_cores = cpu_cores if cpu_cores is not None else torch.get_num_threads()
+        self.best_loss = math.inf
+        self.bad_checks = 0
+        self.should_stop = False
+        self.global_step = 0
+        self.epochs_run = 0
+        self.epoch_times = []
+        self.checks = []
+        self._epoch_start = None
+
+    def _is_plateau_scheduler(self):
+        return isinstance(self.scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau)
+
+    def _check(self, val_loss):
+        self.checks.append({'step': self.global_step, 'epoch': self.epochs_run, 'val_loss': val_loss})
+        if self._is_plateau_scheduler():
+            self.scheduler.step(val_loss)
+        if val_loss < self.best_loss - self.min_delta:
+            self.best_loss = val_loss
+            self.bad_checks = 0
+        else:
+            self.bad_checks += 1
+            if self.patience is not None and self.bad_checks >= self.patience:
+                self.should_stop = True
+
+    def start_epoch(self):
+        self._epoch_start = time.perf_counter()
+
+    # Call after every optimizer step; returns True when training should stop now
+    def after_train_step(self, model, criterion):
+        self.global_step += 1
+        if self.quick_val_loader is None or self.global_step % self.val_every_steps != 0:
+            return False
+        val_loss, val_acc, _ = run_epoch(model, self.quick_val_loader, criterion)
+        model.train()
+        print(f'  Step {self.global_step} subsample val Loss: {val_loss:.4f} Acc: {val_acc:.4f}')
+        self._check(val_loss)
+        return self.should_stop
+
+    # Call once per epoch with the full validation loss; returns True when training should stop
+    def end_epoch(self, val_loss):
+        if self._epoch_start is not None:
+            self.epoch_times.append(time.perf_counter() - self._epoch_start)
+        self.epochs_run += 1
+        if self.quick_val_loader is None:
+            self._check(val_loss)
+        if self.scheduler is not None and not self._is_plateau_scheduler():
+            self.scheduler.step()
+        return self.should_stop
+
+    def summary(self):
+        epochs_saved = max(self.num_epochs - self.epochs_run, 0)
+        mean_epoch_seconds = sum(self.epoch_times) / len(self.epoch_times) if self.epoch_times else 0.0
+        seconds_saved = epochs_saved * mean_epoch_seconds
+        return {
+            'planned_epochs': self.num_epochs,
+            'epochs_run': self.epochs_run,
+            'epochs_saved': epochs_saved,
+            'stopped_early': self.should_stop,
+            'best_val_loss': self.best_loss if self.checks else None,
+            'mean_epoch_seconds': mean_epoch_seconds,
+            'wall_hours_saved': seconds_saved / 3600,
+            'cpu_cores': self.cpu_cores,
+            'cpu_hours_saved': seconds_saved * self.cpu_cores / 3600,
+            'checks': self.checks,
+        }
+
+    def report(self, path=None):
+        summary = self.summary()
+        print(f"Ran {summary['epochs_run']}/{summary['planned_epochs']} epochs; "
+              f"saved {summary['epochs_saved']} epochs, ~{summary['wall_hours_saved']:.2f} h wall "
+              f"/ ~{summary['cpu_hours_saved']:.2f} CPU-hours versus the fixed schedule")
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary